@@ -0,0 +1,153 @@
+"""
+Batched generation (--batch_generation): the prompts of generation tasks (SQuAD, DROP) are generated in length-sorted,
+left-padded batches (--max_tokens_per_batch padded tokens, prompt + new tokens, or per_device_eval_batch_size prompts)
+instead of one model.generate call per prompt, and the outputs are decoded with one batch_decode.
+
+Greedy decoding (the default, without --sampling/--num_beams or logits processors in the generation config) runs its
+own loop over the KV cache: a row that generates an EOS token (--eos_token or the tokenizer's) or reaches its
+max_new_tokens is retired from the batch and from the cache, so the remaining rows do not carry it until the longest one
+finishes. The other decoding strategies call model.generate on the padded batch (per-row EOS stopping, no retirement).
+
+The outputs are those of Framework.forward(..., generation=True) (up to the numerical differences of batching).
+"""
+import itertools
+import logging
+
+import numpy as np
+import torch
+
+from token_budget import token_budget_batches
+from utils import Prediction, pad_sequences
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Generation config fields (and their defaults) that add logits processors to greedy decoding
+GREEDY_DEFAULTS = {
+    "repetition_penalty": 1.0, "encoder_repetition_penalty": 1.0, "no_repeat_ngram_size": 0,
+    "encoder_no_repeat_ngram_size": 0, "bad_words_ids": None, "min_length": 0, "min_new_tokens": None,
+    "forced_bos_token_id": None, "forced_eos_token_id": None, "forced_decoder_ids": None, "suppress_tokens": None,
+    "begin_suppress_tokens": None, "exponential_decay_length_penalty": None,
+}
+
+
+def eos_token_ids(tokenizer, eos_token):
+    """
+    Tokens that end a generation: the last token of eos_token (e.g., "\n") and the tokenizer's EOS
+    """
+    return [tokenizer.encode(eos_token, add_special_tokens=False)[-1], tokenizer.eos_token_id]
+
+
+def plain_greedy(model, args):
+    """
+    Whether model.generate would pick the argmax token at every step (so that greedy_generate gives the same outputs)
+    """
+    if args.sampling or args.num_beams != 1:
+        return False
+    config = getattr(model, "generation_config", None)
+    return config is None or all(getattr(config, k, v) in (v, None) for k, v in GREEDY_DEFAULTS.items())
+
+
+def _select_rows(model, past_key_values, rows):
+    try:
+        # The model's own cache layout (as for beam search)
+        return model._reorder_cache(past_key_values, rows)
+    except (AttributeError, NotImplementedError):
+        pass
+    return tuple(tuple(t.index_select(0, rows) for t in layer) for layer in past_key_values)
+
+
+@torch.inference_mode()
+def greedy_generate(model, input_ids, attention_mask, max_new_tokens, eos_ids):
+    """
+    Greedy decoding of a left-padded batch, retiring the finished rows
+    Input:
+    - max_new_tokens: maximum number of new tokens of each row
+    Output: generated tokens of each row (with the EOS token that ended it, as model.generate)
+    """
+    outputs = [[] for _ in range(input_ids.size(0))]
+    rows = [i for i in range(input_ids.size(0)) if max_new_tokens[i] > 0]
+    if len(rows) < input_ids.size(0):
+        index = torch.tensor(rows, device=input_ids.device)
+        input_ids, attention_mask = input_ids[index], attention_mask[index]
+    eos_ids = set(eos_ids)
+    past_key_values = None
+    while rows:
+        inputs = model.prepare_inputs_for_generation(input_ids, past_key_values=past_key_values,
+                                                     attention_mask=attention_mask, use_cache=True)
+        model_outputs = model(**inputs, return_dict=True)
+        next_tokens = model_outputs.logits[:, -1].argmax(dim=-1)
+        past_key_values = model_outputs.past_key_values
+
+        keep = []
+        for j, (row, token) in enumerate(zip(rows, next_tokens.tolist())):
+            outputs[row].append(token)
+            if token not in eos_ids and len(outputs[row]) < max_new_tokens[row]:
+                keep.append(j)
+        if len(keep) == 0:
+            break
+        if len(keep) < len(rows):
+            # Retire the finished rows
+            index = torch.tensor(keep, device=input_ids.device)
+            past_key_values = _select_rows(model, past_key_values, index)
+            input_ids, attention_mask, next_tokens = input_ids[index], attention_mask[index], next_tokens[index]
+            rows = [rows[j] for j in keep]
+        input_ids = torch.cat([input_ids, next_tokens[:, None]], dim=-1)
+        attention_mask = torch.cat([attention_mask, attention_mask.new_ones((len(rows), 1))], dim=-1)
+    return outputs
+
+
+def generate_texts(model, tokenizer, prompts, args):
+    """
+    Framework.forward(prompt, generation=True) of all the prompts (lists of tokens)
+    Output: list of generated texts, in the order of prompts
+    """
+    model.eval()
+    device = model.device
+    eos_ids = eos_token_ids(tokenizer, args.eos_token)
+    greedy = plain_greedy(model, args)
+    lengths = [len(p) for p in prompts]
+    caps = [min(args.max_new_tokens, args.max_length - length) for length in lengths]
+    # A batch holds its rows until the longest prompt has generated the most new tokens
+    budget = [length + max(cap, 0) for length, cap in zip(lengths, caps)]
+    order = sorted(range(len(prompts)), key=lambda i: budget[i])
+    if args.max_tokens_per_batch is not None:
+        batches = token_budget_batches(order, budget, args.max_tokens_per_batch)
+    else:
+        batches = (order[i:i + args.per_device_eval_batch_size]
+                   for i in range(0, len(order), args.per_device_eval_batch_size))
+    if not greedy:
+        # model.generate takes one max_new_tokens: the prompts whose cap is set by max_length are generated apart
+        batches = (list(group) for batch in batches
+                   for _, group in itertools.groupby(sorted(batch, key=lambda i: caps[i]), key=lambda i: caps[i]))
+
+    generated = [None] * len(prompts)
+    for batch in batches:
+        padded, mask = pad_sequences([prompts[i] for i in batch], tokenizer.pad_token_id, max(lengths[i] for i in batch),
+                                     padding_side="left")
+        input_ids = torch.from_numpy(padded).to(device)
+        attention_mask = torch.from_numpy(mask.astype(np.int64)).to(device)
+        if greedy:
+            outputs = greedy_generate(model, input_ids, attention_mask, [caps[i] for i in batch], eos_ids)
+        else:
+            sequences = model.generate(
+                input_ids, attention_mask=attention_mask, do_sample=args.sampling, temperature=args.temperature,
+                num_beams=args.num_beams, top_p=args.top_p, top_k=args.top_k,
+                max_new_tokens=caps[batch[0]], num_return_sequences=1, eos_token_id=eos_ids,
+                pad_token_id=tokenizer.pad_token_id,
+            )
+            outputs = sequences[:, input_ids.size(1):].tolist()
+        for i, output in zip(batch, outputs):
+            generated[i] = output
+    return [text.strip() for text in tokenizer.batch_decode(generated, skip_special_tokens=True)]
+
+
+def predict_generations(model, tokenizer, args, eval_samples, prompts):
+    """
+    Batched one_step_pred for generation tasks
+    Input:
+    - prompts: encoded prompt of each eval sample
+    """
+    outputs = generate_texts(model, tokenizer, prompts, args)
+    return [Prediction(correct_candidate=eval_sample.correct_candidate, predicted_candidate=output)
+            for eval_sample, output in zip(eval_samples, outputs)]
@@ -0,0 +1,123 @@
+"""
+Padding waste and collation time of the training batches, on a synthetic mix of short (SST2-like) and long
+(BoolQ-like) classification examples.
+
+    python collate_bench.py --tokenizer facebook/opt-125m --batch_size 16
+
+- Padding waste: fraction of padding tokens in the padded batches, with the random sampler vs. the length-grouped
+  sampler (--group_by_length).
+- Collation time: the previous collators (tokenizer.pad, and per-label Python lists for NondiffCollator) vs. the
+  one-shot NumPy padding of DataCollatorWithPaddingAndNesting/NondiffCollator (outputs are checked to be identical).
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import RandomSampler
+from transformers import AutoTokenizer
+from transformers.trainer_pt_utils import LengthGroupedSampler
+
+from utils import DataCollatorWithPaddingAndNesting, NondiffCollator
+
+
+def reference_nesting_collate(tokenizer, features, pad_to_multiple_of=8):
+    """
+    DataCollatorWithPaddingAndNesting before the one-shot padding
+    """
+    features = [ff for f in features for ff in f]
+    return tokenizer.pad(features, padding=True, pad_to_multiple_of=pad_to_multiple_of, return_tensors="pt")
+
+
+def reference_nondiff_collate(tokenizer, features, pad_to_multiple_of=8, label_pad_token_id=-100):
+    """
+    NondiffCollator before the one-shot padding
+    """
+    labels = [feature["labels"] for feature in features]
+    no_labels_features = [{k: v for k, v in feature.items() if k != "labels" and k != "gold"} for feature in features]
+    batch = tokenizer.pad(no_labels_features, padding=True, pad_to_multiple_of=pad_to_multiple_of, return_tensors="pt")
+    sequence_length = batch["input_ids"].shape[1]
+    batch["labels"] = torch.tensor([[label_pad_token_id] * (sequence_length - len(label)) + list(label)
+                                    for label in labels], dtype=torch.int64)
+    batch["gold"] = [feature["gold"] for feature in features]
+    return batch
+
+
+def make_dataset(args, rng):
+    data = []
+    for _ in range(args.num_examples):
+        low, high = args.long_len if rng.random() < args.long_fraction else args.short_len
+        context = rng.integers(4, 50000, rng.integers(low, high + 1)).tolist()
+        data.append([{"input_ids": context + rng.integers(4, 50000, 2).tolist(), "labels": 0, "option_len": 2,
+                      "num_options": args.num_options} for _ in range(args.num_options)])
+    return data
+
+
+def batches(data, sampler, batch_size):
+    indices = list(sampler)
+    return [[data[i] for i in indices[start:start + batch_size]] for start in range(0, len(indices), batch_size)]
+
+
+def padding_waste(collated):
+    real = sum(int(b["attention_mask"].sum()) for b in collated)
+    total = sum(b["input_ids"].numel() for b in collated)
+    return 1 - real / total
+
+
+def timed(fn, items, repeats):
+    start = time.time()
+    for _ in range(repeats):
+        out = [fn(x) for x in items]
+    return (time.time() - start) / repeats, out
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokenizer", default="facebook/opt-125m")
+    parser.add_argument("--num_examples", type=int, default=1000)
+    parser.add_argument("--num_options", type=int, default=2)
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--short_len", type=lambda x: [int(v) for v in x.split(",")], default=[10, 30])
+    parser.add_argument("--long_len", type=lambda x: [int(v) for v in x.split(",")], default=[300, 500])
+    parser.add_argument("--long_fraction", type=float, default=0.3)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    tokenizer.padding_side = "left"
+    rng = np.random.default_rng(args.seed)
+    data = make_dataset(args, rng)
+    lengths = [max(len(option["input_ids"]) for option in example) for example in data]
+    collator = DataCollatorWithPaddingAndNesting(tokenizer, pad_to_multiple_of=8)
+
+    samplers = {
+        "random": RandomSampler(data, generator=torch.Generator().manual_seed(args.seed)),
+        "length-grouped": LengthGroupedSampler(args.batch_size, lengths=lengths,
+                                               generator=torch.Generator().manual_seed(args.seed)),
+    }
+    for name, sampler in samplers.items():
+        sampled = batches(data, sampler, args.batch_size)
+        reference_time, reference = timed(lambda b: reference_nesting_collate(tokenizer, b), sampled, args.repeats)
+        new_time, collated = timed(collator, sampled, args.repeats)
+        for r, c in zip(reference, collated):
+            assert all(torch.equal(r[k], c[k]) for k in r), "Collated batches differ"
+        print(f"{name:15s} sampler: padding waste {padding_waste(collated):.1%}, collation "
+              f"{reference_time / len(sampled) * 1000:.2f}ms/batch (tokenizer.pad) -> "
+              f"{new_time / len(sampled) * 1000:.2f}ms/batch (one-shot)")
+
+    # Non-differentiable objective: one row per example, labels padded to the batch length
+    nondiff_data = [{"input_ids": example[0]["input_ids"], "labels": example[0]["input_ids"], "gold": "answer"}
+                    for example in data]
+    sampled = batches(nondiff_data, samplers["random"], args.batch_size)
+    nondiff_collator = NondiffCollator(tokenizer, pad_to_multiple_of=8)
+    reference_time, reference = timed(lambda b: reference_nondiff_collate(tokenizer, b), sampled, args.repeats)
+    new_time, collated = timed(nondiff_collator, sampled, args.repeats)
+    for r, c in zip(reference, collated):
+        assert all(torch.equal(r[k], c[k]) for k in r if k != "gold"), "Collated batches differ"
+    print(f"NondiffCollator: {reference_time / len(sampled) * 1000:.2f}ms/batch -> "
+          f"{new_time / len(sampled) * 1000:.2f}ms/batch")
+
+
+if __name__ == "__main__":
+    main()
@@ -100,6 +100,56 @@ def _expand_mask(mask: torch.Tensor, dtype: torch.dtype, tgt_len: Optional[int]
     return inverted_mask.masked_fill(inverted_mask.to(torch.bool), torch.finfo(dtype).min)
 
 
+def prepare_decoder_attention_mask(attention_mask, input_shape, inputs_embeds, past_key_values_length=0):
+    """
+    Additive [bsz, 1, tgt_seq_len, src_seq_len] mask of the decoder layers: causal mask + padding mask (attention_mask)
+    """
+    # create causal mask
+    # [bsz, seq_len] -> [bsz, 1, tgt_seq_len, src_seq_len]
+    combined_attention_mask = None
+    if input_shape[-1] > 1:
+        combined_attention_mask = _make_causal_mask(
+            input_shape,
+            inputs_embeds.dtype,
+            device=inputs_embeds.device,
+            past_key_values_length=past_key_values_length,
+        )
+
+    if attention_mask is not None:
+        # [bsz, seq_len] -> [bsz, 1, tgt_seq_len, src_seq_len]
+        expanded_attn_mask = _expand_mask(attention_mask, inputs_embeds.dtype, tgt_len=input_shape[-1]).to(
+            inputs_embeds.device
+        )
+        combined_attention_mask = (
+            expanded_attn_mask if combined_attention_mask is None else expanded_attn_mask + combined_attention_mask
+        )
+
+    return combined_attention_mask
+
+
+def _make_segment_causal_mask(segment_ids: torch.Tensor, dtype: torch.dtype):
+    """
+    Block-diagonal causal mask of packed sequences: a token attends to the previous tokens of its own segment.
+    Input: segment_ids `[bsz, seq_len]` (1, 2, ... for the packed sequences, 0 for padding)
+    Output: `[bsz, 1, seq_len, seq_len]` additive mask
+    """
+    seq_len = segment_ids.size(-1)
+    causal = torch.ones(seq_len, seq_len, dtype=torch.bool, device=segment_ids.device).tril()
+    allowed = (segment_ids[:, :, None] == segment_ids[:, None, :]) & (segment_ids[:, None, :] > 0) & causal
+    mask = torch.zeros(allowed.shape, dtype=dtype, device=segment_ids.device).masked_fill(~allowed, torch.finfo(dtype).min)
+    return mask[:, None, :, :]
+
+
+def _segment_position_ids(segment_ids: torch.Tensor):
+    """
+    Positions restarting at 0 at the first token of each packed sequence
+    """
+    index = torch.arange(segment_ids.size(-1), device=segment_ids.device).expand_as(segment_ids)
+    starts = torch.ones_like(segment_ids, dtype=torch.bool)
+    starts[:, 1:] = segment_ids[:, 1:] != segment_ids[:, :-1]
+    return index - torch.cummax(torch.where(starts, index, torch.zeros_like(index)), dim=-1).values
+
+
 class OPTLearnedPositionalEmbedding(nn.Embedding):
     """
     This module learns positional embeddings up to a fixed maximum size.
@@ -111,8 +161,17 @@ class OPTLearnedPositionalEmbedding(nn.Embedding):
         self.offset = 2
         super().__init__(num_embeddings + self.offset, embedding_dim)
 
-    def forward(self, attention_mask: torch.LongTensor, past_key_values_length: int = 0):
+    def forward(
+        self,
+        attention_mask: torch.LongTensor,
+        past_key_values_length: int = 0,
+        position_ids: Optional[torch.LongTensor] = None,
+    ):
         """`input_ids_shape` is expected to be [bsz x seqlen]."""
+        if position_ids is not None:
+            # Explicit positions (packed sequences)
+            return super().forward(position_ids + self.offset)
+
         attention_mask = attention_mask.long()
 
         # create positions depending on attention_mask
@@ -535,27 +594,7 @@ class OPTDecoder(OPTPreTrainedModel):
 
     # Copied from transformers.models.bart.modeling_bart.BartDecoder._prepare_decoder_attention_mask
     def _prepare_decoder_attention_mask(self, attention_mask, input_shape, inputs_embeds, past_key_values_length):
-        # create causal mask
-        # [bsz, seq_len] -> [bsz, 1, tgt_seq_len, src_seq_len]
-        combined_attention_mask = None
-        if input_shape[-1] > 1:
-            combined_attention_mask = _make_causal_mask(
-                input_shape,
-                inputs_embeds.dtype,
-                device=inputs_embeds.device,
-                past_key_values_length=past_key_values_length,
-            )
-
-        if attention_mask is not None:
-            # [bsz, seq_len] -> [bsz, 1, tgt_seq_len, src_seq_len]
-            expanded_attn_mask = _expand_mask(attention_mask, inputs_embeds.dtype, tgt_len=input_shape[-1]).to(
-                inputs_embeds.device
-            )
-            combined_attention_mask = (
-                expanded_attn_mask if combined_attention_mask is None else expanded_attn_mask + combined_attention_mask
-            )
-
-        return combined_attention_mask
+        return prepare_decoder_attention_mask(attention_mask, input_shape, inputs_embeds, past_key_values_length)
 
     def forward(
         self,
@@ -568,6 +607,8 @@ class OPTDecoder(OPTPreTrainedModel):
         output_attentions: Optional[bool] = None,
         output_hidden_states: Optional[bool] = None,
         return_dict: Optional[bool] = None,
+        position_ids: Optional[torch.LongTensor] = None,
+        segment_ids: Optional[torch.LongTensor] = None,
     ) -> Union[Tuple, BaseModelOutputWithPast]:
         r"""
         Args:
@@ -615,6 +656,12 @@ class OPTDecoder(OPTPreTrainedModel):
                 for more detail.
             return_dict (`bool`, *optional*):
                 Whether or not to return a [`~utils.ModelOutput`] instead of a plain tuple.
+            position_ids (`torch.LongTensor` of shape `(batch_size, sequence_length)`, *optional*):
+                Positions of the tokens. Computed from `attention_mask` (or `segment_ids`) by default.
+            segment_ids (`torch.LongTensor` of shape `(batch_size, sequence_length)`, *optional*):
+                Packed sequences (MeZO added): index (1, 2, ...) of the sequence each token belongs to, 0 for padding.
+                Tokens only attend to the previous tokens of their own sequence and positions restart at every
+                sequence, so each packed sequence gets the same outputs as on its own.
         """
         output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
         output_hidden_states = (
@@ -646,10 +693,17 @@ class OPTDecoder(OPTPreTrainedModel):
         # embed positions
         if attention_mask is None:
             attention_mask = torch.ones(batch_size, mask_seq_length, device=inputs_embeds.device)
-        causal_attention_mask = self._prepare_decoder_attention_mask(
-            attention_mask, input_shape, inputs_embeds, past_key_values_length
-        )
-        pos_embeds = self.embed_positions(attention_mask, past_key_values_length)
+        if segment_ids is not None:
+            if past_key_values_length > 0:
+                raise ValueError("Packed sequences (segment_ids) do not support past_key_values")
+            causal_attention_mask = _make_segment_causal_mask(segment_ids, inputs_embeds.dtype)
+            if position_ids is None:
+                position_ids = _segment_position_ids(segment_ids)
+        else:
+            causal_attention_mask = self._prepare_decoder_attention_mask(
+                attention_mask, input_shape, inputs_embeds, past_key_values_length
+            )
+        pos_embeds = self.embed_positions(attention_mask, past_key_values_length, position_ids=position_ids)
 
         if self.project_in is not None:
             inputs_embeds = self.project_in(inputs_embeds)
@@ -781,6 +835,8 @@ class OPTModel(OPTPreTrainedModel):
         output_attentions: Optional[bool] = None,
         output_hidden_states: Optional[bool] = None,
         return_dict: Optional[bool] = None,
+        position_ids: Optional[torch.LongTensor] = None,
+        segment_ids: Optional[torch.LongTensor] = None,
     ) -> Union[Tuple, BaseModelOutputWithPast]:
         output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
         output_hidden_states = (
@@ -800,6 +856,8 @@ class OPTModel(OPTPreTrainedModel):
             output_attentions=output_attentions,
             output_hidden_states=output_hidden_states,
             return_dict=return_dict,
+            position_ids=position_ids,
+            segment_ids=segment_ids,
         )
 
         if not return_dict:
@@ -857,6 +915,8 @@ class OPTForCausalLM(OPTPreTrainedModel):
         output_attentions: Optional[bool] = None,
         output_hidden_states: Optional[bool] = None,
         return_dict: Optional[bool] = None,
+        position_ids: Optional[torch.LongTensor] = None,
+        segment_ids: Optional[torch.LongTensor] = None,
     ) -> Union[Tuple, CausalLMOutputWithPast]:
         r"""
         Args:
@@ -912,6 +972,8 @@ class OPTForCausalLM(OPTPreTrainedModel):
                 for more detail.
             return_dict (`bool`, *optional*):
                 Whether or not to return a [`~utils.ModelOutput`] instead of a plain tuple.
+            position_ids, segment_ids (`torch.LongTensor` of shape `(batch_size, sequence_length)`, *optional*):
+                Packed sequences, see [`OPTDecoder.forward`].
 
         Returns:
 
@@ -951,6 +1013,8 @@ class OPTForCausalLM(OPTPreTrainedModel):
                 output_attentions=output_attentions,
                 output_hidden_states=output_hidden_states,
                 return_dict=return_dict,
+                position_ids=position_ids,
+                segment_ids=segment_ids,
             )
 
         logits = self.lm_head(outputs[0]).contiguous()
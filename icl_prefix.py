@@ -0,0 +1,88 @@
+"""
+Demonstration-prefix KV cache (--icl_prefix_cache): with one demonstration set for all the eval samples
+(--train_set_seed/--num_train_sets), every prompt starts with the same demonstration tokens. They are run through the
+model once; their past_key_values are then shared by batches of the (right-padded) continuations, i.e., the eval
+sample and candidate of each prompt. The cost of ICL evaluation goes from samples x candidates x prompt tokens to
+prompt + samples x candidates x continuation tokens.
+
+The log-probabilities are those of Framework.forward (up to the numerical differences of batching).
+"""
+import logging
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from token_budget import score_options
+from utils import pad_sequences
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def shared_prefix_length(sequences, option_lens):
+    """
+    Number of first tokens shared by all the sequences, and followed by at least one token before the options (so
+    that the log-probabilities of the option tokens all come from the continuations)
+    """
+    if len(sequences) == 0 or min(option_lens) <= 0:
+        return 0
+    length = min(len(s) - k - 1 for s, k in zip(sequences, option_lens))
+    first = sequences[0]
+    for sequence in sequences[1:]:
+        length = min(length, len(sequence))
+        mismatch = np.flatnonzero(np.asarray(first[:length]) != np.asarray(sequence[:length]))
+        if len(mismatch) > 0:
+            length = int(mismatch[0])
+    return max(length, 0)
+
+
+@torch.inference_mode()
+def score_options_with_prefix(model, sequences, option_lens, prefix_len, batch_size, pad_token_id, max_tokens=None):
+    """
+    token_budget.score_options with the first prefix_len tokens run once: the sequences that start with the prefix of
+    sequences[0] (and have at least one token between it and their options) are scored as batch_size continuations of
+    its past_key_values, the others with score_options (max_tokens, one sequence per batch by default)
+    Output: list of CPU tensors, in the order of sequences
+    """
+    model.eval()
+    device = model.device
+    prefix = list(sequences[0][:prefix_len])
+    shared, others = [], []
+    for i, (sequence, option_len) in enumerate(zip(sequences, option_lens)):
+        if option_len > 0 and len(sequence) - option_len - 1 >= prefix_len and list(sequence[:prefix_len]) == prefix:
+            shared.append(i)
+        else:
+            others.append(i)
+
+    results = [None] * len(sequences)
+    if len(others) > 0:
+        for i, log_probs in zip(others, score_options(model, [sequences[i] for i in others],
+                                                      [option_lens[i] for i in others], max_tokens or 0,
+                                                      pad_token_id)):
+            results[i] = log_probs
+    if len(shared) == 0:
+        return results
+
+    past_key_values = model(input_ids=torch.tensor([prefix], device=device), use_cache=True).past_key_values
+    # Continuations of similar lengths together
+    shared.sort(key=lambda i: len(sequences[i]))
+    for start in range(0, len(shared), batch_size):
+        batch = shared[start:start + batch_size]
+        continuations = [sequences[i][prefix_len:] for i in batch]
+        lengths = [len(c) for c in continuations]
+        padded, mask = pad_sequences(continuations, pad_token_id, max(lengths), padding_side="right")
+        input_ids = torch.from_numpy(padded).to(device)
+        attention_mask = torch.cat([torch.ones(len(batch), prefix_len, dtype=torch.long, device=device),
+                                    torch.from_numpy(mask.astype(np.int64)).to(device)], dim=1)
+        batch_past = tuple(tuple(t.expand(len(batch), *t.shape[1:]) for t in layer) for layer in past_key_values)
+        logits = model(input_ids=input_ids, attention_mask=attention_mask, past_key_values=batch_past,
+                       use_cache=False).logits
+        log_probs = F.log_softmax(logits, dim=-1)
+        for row, i in enumerate(batch):
+            # The option tokens are the last option_len tokens of the continuation, each predicted at the position
+            # before it
+            k, length = option_lens[i], lengths[row]
+            option = input_ids[row, length - k:length]
+            results[i] = log_probs[row, length - k - 1:length - 1].gather(-1, option[:, None]).squeeze(-1).cpu()
+    return results
@@ -0,0 +1,61 @@
+"""
+Check the startup cost of the common ZO path with `python -X importtime`.
+
+    python importtime_budget.py                      # import run, check against the default budget
+    python importtime_budget.py --module trainer --budget_ms 4000 --top 30
+
+Fails (exit code 1) if the cumulative import time is over budget, or if any of the heavy optional dependencies
+(which should only be imported by the code paths that need them) is imported at startup.
+"""
+import argparse
+import subprocess
+import sys
+
+# Only needed by linear probing, wandb reporting, FSDP/sharded DDP, apex AMP, profiling, ...
+LAZY_MODULES = ["wandb", "sklearn", "scipy", "torchprofile", "fairscale", "apex", "deepspeed"]
+
+
+def measure(module, python=sys.executable):
+    """
+    Output: {module directly imported by `module`: cumulative us}, total us, set of all imported modules
+    """
+    proc = subprocess.run([python, "-X", "importtime", "-c", f"import {module}"], capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{proc.stderr[-2000:]}")
+
+    per_package, imported, total = {}, set(), 0
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative_us, name = line[len("import time:"):].split("|")
+        imported.add(name.strip())
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 0:
+            total += int(cumulative_us)
+        elif depth == 1:
+            # Direct imports of the measured module
+            per_package[name.strip()] = per_package.get(name.strip(), 0) + int(cumulative_us)
+    return per_package, total, imported
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--module", default="run")
+    parser.add_argument("--budget_ms", type=float, default=4000)
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+
+    per_package, total, imported = measure(args.module)
+    print(f"import {args.module}: {total / 1000:.0f}ms (budget {args.budget_ms:.0f}ms)")
+    for name, us in sorted(per_package.items(), key=lambda x: -x[1])[:args.top]:
+        print(f"  {us / 1000:8.1f}ms  {name}")
+
+    eager = sorted(m for m in LAZY_MODULES if m in imported)
+    if eager:
+        print(f"Imported at startup but should be lazy: {', '.join(eager)}")
+    if eager or total / 1000 > args.budget_ms:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+import contextlib
+import json
+import logging
+import os
+import time
+import tracemalloc
+from collections import OrderedDict, defaultdict
+
+import torch
+from torch import nn
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def _rss_bytes():
+    """
+    Current resident set size of this process (falls back to the lifetime peak if /proc is not available)
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _accelerator_devices():
+    if torch.cuda.is_available():
+        return list(range(torch.cuda.device_count()))
+    return []
+
+
+def tensor_bytes(obj):
+    """
+    Return {device: bytes} held by the tensors in obj (a tensor, module, dict, list or tuple of those).
+    Storages shared between several tensors (e.g., tied embeddings) are only counted once.
+    """
+    seen = set()
+    total = defaultdict(int)
+
+    def _visit(x):
+        if isinstance(x, torch.Tensor):
+            if x.device.type == "meta":
+                return
+            storage = x.untyped_storage()
+            key = (str(x.device), storage.data_ptr())
+            if key in seen:
+                return
+            seen.add(key)
+            total[str(x.device)] += storage.nbytes()
+        elif isinstance(x, nn.Module):
+            for t in x.parameters():
+                _visit(t)
+            for t in x.buffers():
+                _visit(t)
+        elif isinstance(x, dict):
+            for v in x.values():
+                _visit(v)
+        elif isinstance(x, (list, tuple)):
+            for v in x:
+                _visit(v)
+
+    _visit(obj)
+    return dict(total)
+
+
+class PhaseMemoryTracker:
+    """
+    Record peak and steady-state memory for each training phase (perturb, forward, update, dizo, eval, ...)
+    and the size of named buffers (parameter copy, grad_buffer, DiZO base model, logits, ...).
+    - CPU: tracemalloc (Python-side allocations) and process RSS
+    - Accelerators: torch.cuda peak/current allocated memory, per device
+    Phases can be nested; the peak of a nested phase is folded into its parent.
+    """
+
+    def __init__(self, enabled=True, trace_python=True):
+        self.enabled = enabled
+        self.trace_python = trace_python and enabled
+        self.devices = _accelerator_devices()
+        self.stats = OrderedDict()
+        self.buffers = OrderedDict()
+        self._stack = []
+        if self.trace_python and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def _accel_peak(self):
+        return {d: torch.cuda.max_memory_allocated(d) for d in self.devices}
+
+    def _accel_current(self):
+        return {d: torch.cuda.memory_allocated(d) for d in self.devices}
+
+    def _reset_peaks(self):
+        for d in self.devices:
+            torch.cuda.reset_peak_memory_stats(d)
+        if self.trace_python:
+            tracemalloc.reset_peak()
+
+    def _fold_into(self, frame):
+        # Fold the peaks observed since the last reset into a frame
+        for d, v in self._accel_peak().items():
+            frame["accel_peak"][d] = max(frame["accel_peak"].get(d, 0), v)
+        if self.trace_python:
+            frame["py_peak"] = max(frame["py_peak"], tracemalloc.get_traced_memory()[1])
+        frame["rss_peak"] = max(frame["rss_peak"], _rss_bytes())
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        if self._stack:
+            self._fold_into(self._stack[-1])
+        for d in self.devices:
+            torch.cuda.synchronize(d)
+        self._reset_peaks()
+        frame = {"name": name, "accel_peak": {}, "py_peak": 0, "rss_peak": _rss_bytes(), "start": time.time()}
+        self._stack.append(frame)
+        try:
+            yield
+        finally:
+            for d in self.devices:
+                torch.cuda.synchronize(d)
+            self._stack.pop()
+            self._fold_into(frame)
+            if self._stack:
+                parent = self._stack[-1]
+                for d, v in frame["accel_peak"].items():
+                    parent["accel_peak"][d] = max(parent["accel_peak"].get(d, 0), v)
+                parent["py_peak"] = max(parent["py_peak"], frame["py_peak"])
+                parent["rss_peak"] = max(parent["rss_peak"], frame["rss_peak"])
+            self._update_stats(frame)
+
+    def _update_stats(self, frame):
+        s = self.stats.setdefault(frame["name"], {
+            "count": 0, "time": 0.0, "rss_peak": 0, "rss_steady": 0, "py_peak": 0, "py_steady": 0,
+            "accel_peak": {}, "accel_steady": {},
+        })
+        s["count"] += 1
+        s["time"] += time.time() - frame["start"]
+        s["rss_peak"] = max(s["rss_peak"], frame["rss_peak"])
+        s["rss_steady"] = _rss_bytes()
+        s["py_peak"] = max(s["py_peak"], frame["py_peak"])
+        if self.trace_python:
+            s["py_steady"] = tracemalloc.get_traced_memory()[0]
+        for d, v in frame["accel_peak"].items():
+            s["accel_peak"][d] = max(s["accel_peak"].get(d, 0), v)
+        s["accel_steady"] = self._accel_current()
+
+    def record_buffer(self, name, obj, device="cpu"):
+        """
+        Attribute the bytes held by obj to a named buffer. obj is a tensor/module/container, or an int number
+        of bytes for transient buffers that are never held by the caller (e.g., logits); device is only used
+        in the latter case. Only the largest size observed for each name is kept.
+        """
+        if not self.enabled:
+            return
+        nbytes = {str(device): obj} if isinstance(obj, int) else tensor_bytes(obj)
+        prev = self.buffers.get(name, {})
+        self.buffers[name] = {d: max(v, prev.get(d, 0)) for d, v in {**prev, **nbytes}.items()}
+
+    def summary(self):
+        return {"phases": self.stats, "buffers": self.buffers}
+
+    def log_summary(self):
+        if not self.enabled:
+            return
+        gb = 1024 ** 3
+        for name, s in self.stats.items():
+            accel = ", ".join(f"gpu{d} peak {s['accel_peak'][d] / gb:.2f}GB steady {s['accel_steady'].get(d, 0) / gb:.2f}GB"
+                              for d in s["accel_peak"])
+            logger.info(f"[Memory] {name} (x{s['count']}, {s['time']:.2f}s): rss peak {s['rss_peak'] / gb:.2f}GB "
+                        f"steady {s['rss_steady'] / gb:.2f}GB, python peak {s['py_peak'] / gb:.3f}GB"
+                        + (f", {accel}" if accel else ""))
+        for name, per_device in sorted(self.buffers.items(), key=lambda x: -sum(x[1].values())):
+            logger.info(f"[Memory] buffer {name}: " + ", ".join(f"{d} {v / gb:.3f}GB" for d, v in per_device.items()))
+
+    def save(self, path):
+        if not self.enabled:
+            return
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=4)
@@ -0,0 +1,91 @@
+import logging
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class DeviceRingBuffer:
+    """
+    Accumulate per-step training metrics (loss, projected gradients, ...) on the device they are computed on,
+    without any host synchronization. Values are only copied to the host by flush(), which should be called at
+    logging/eval boundaries.
+    Input:
+    - capacity: number of steps kept on device; when full, the buffer flushes itself (one sync)
+    - fields: dict of field name -> number of values per step (e.g., {"loss": 1, "projected_grad": 3})
+    - device: device of the tensors that will be pushed
+    - host_fields: names of scalar values that are already on the host (e.g., lr, wall time), kept in numpy
+    """
+
+    def __init__(self, capacity, fields, device, dtype=torch.float32, host_fields=()):
+        self.capacity = capacity
+        self.fields = dict(fields)
+        self.device = device
+        self.buffers = {name: torch.zeros(capacity, width, device=device, dtype=dtype)
+                        for name, width in self.fields.items()}
+        self.steps = np.zeros(capacity, dtype=np.int64)  # Step ids are host-side ints, no need to put them on device
+        self.host_buffers = {name: np.full(capacity, np.nan) for name in host_fields}
+        self.num_pending = 0
+        self.start = 0
+        self.overflow = []  # Host copies produced by automatic flushes, handed out by the next flush()
+
+    def push(self, step, host_values=None, **values):
+        """
+        Record the values of one step. Values can be 0-d/1-d tensors (on any device) or Python numbers;
+        host_values is a dict of Python numbers for the host_fields.
+        """
+        if self.num_pending == self.capacity:
+            self.overflow.append(self._flush_pending())
+        idx = (self.start + self.num_pending) % self.capacity
+        for name, value in values.items():
+            buf = self.buffers[name]
+            if isinstance(value, (list, tuple)):
+                value = torch.stack([torch.as_tensor(v, device=buf.device) for v in value])
+            buf[idx].copy_(torch.as_tensor(value).detach().reshape(-1), non_blocking=True)
+        for name, value in (host_values or {}).items():
+            self.host_buffers[name][idx] = value
+        self.steps[idx] = step
+        self.num_pending += 1
+
+    def _flush_pending(self):
+        idx = (np.arange(self.num_pending) + self.start) % self.capacity
+        index = torch.from_numpy(idx).to(self.device)
+        # One device->host transfer for all fields
+        flat = torch.cat([buf.index_select(0, index) for buf in self.buffers.values()], dim=1).float().cpu().numpy()
+        out, col = {"step": self.steps[idx].copy()}, 0
+        out.update({name: buf[idx].copy() for name, buf in self.host_buffers.items()})
+        for name, width in self.fields.items():
+            out[name] = flat[:, col:col + width]
+            col += width
+        for buf in self.host_buffers.values():
+            buf[idx] = np.nan
+        self.start = (self.start + self.num_pending) % self.capacity
+        self.num_pending = 0
+        return out
+
+    def flush(self):
+        """
+        Copy all the pending values to the host and return them as a dict of numpy arrays:
+        "step" and host fields -> (n,), and field name -> (n, width). Non-finite values are kept as they are.
+        """
+        chunks = self.overflow
+        self.overflow = []
+        if self.num_pending > 0:
+            chunks.append(self._flush_pending())
+        if len(chunks) == 0:
+            out = {"step": np.zeros(0, dtype=np.int64)}
+            out.update({name: np.zeros(0) for name in self.host_buffers})
+            out.update({name: np.zeros((0, width), dtype=np.float32) for name, width in self.fields.items()})
+            return out
+        return {k: np.concatenate([c[k] for c in chunks]) for k in chunks[0]}
+
+
+def accumulate_finite(total, value, fallback):
+    """
+    total += value if value is finite else fallback, without synchronizing with the host
+    (replaces the `torch.isnan(x) or torch.isinf(x)` check of the original training loop)
+    """
+    value = value.detach().to(total.device)
+    return total.add_(torch.where(torch.isfinite(value), value, fallback))
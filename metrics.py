@@ -1,5 +1,6 @@
 import numpy as np
 import collections
+import functools
 import re
 import string
 from collections import Counter
@@ -56,6 +57,16 @@ def calculate_metric(predictions, metric_name):
         return np.mean(f1)
 
 
+@functools.lru_cache(maxsize=65536)
+def gold_bags(gold):
+    """
+    Normalized token multisets (and their sizes) of the gold answers (tuple) of a sample: the non-differentiable
+    objective computes F1 against the same training samples at every step, so they are normalized once
+    """
+    bags = [Counter(normalize_answer(ans).split()) for ans in gold]
+    return [(bag, sum(bag.values())) for bag in bags]
+
+
 def f1(pred, gold):
     """
     This separate F1 function is used as non-differentiable metric for SQuAD
@@ -64,15 +75,15 @@ def f1(pred, gold):
         return int(normalize_answer(gold[0]) == normalize_answer(pred))
     else:
         all_f1s = []
-        for ans in gold:
-            prediction_tokens = normalize_answer(pred).split()
-            ground_truth_tokens = normalize_answer(ans).split()
-            common = Counter(prediction_tokens) & Counter(ground_truth_tokens)
+        prediction_tokens = Counter(normalize_answer(pred).split())
+        num_prediction_tokens = sum(prediction_tokens.values())
+        for ground_truth_tokens, num_ground_truth_tokens in gold_bags(tuple(gold)):
+            common = prediction_tokens & ground_truth_tokens
             num_same = sum(common.values())
             if num_same == 0:
                 all_f1s.append(0)
             else:
-                precision = 1.0 * num_same / len(prediction_tokens)
-                recall = 1.0 * num_same / len(ground_truth_tokens)
+                precision = 1.0 * num_same / num_prediction_tokens
+                recall = 1.0 * num_same / num_ground_truth_tokens
                 all_f1s.append((2 * precision * recall) / (precision + recall))
         return np.max(all_f1s)
\ No newline at end of file
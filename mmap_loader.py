@@ -0,0 +1,260 @@
+"""
+Zero-copy model loading.
+
+The checkpoint files (safetensors, or zipfile torch checkpoints) are memory-mapped privately (copy-on-write) and the
+model parameters are views into the mappings, so loading does not read the weights up front, frozen weights stay
+backed by the page cache (shared by all the processes that map the same files), and nothing requires CUDA.
+Only trainable parameters need private memory: call materialize_trainable() once LoRA/prefix/head tuning has set
+requires_grad.
+"""
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import struct
+
+import torch
+from packaging import version
+from torch import nn
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64, "F32": torch.float32, "F16": torch.float16, "BF16": torch.bfloat16,
+    "I64": torch.int64, "I32": torch.int32, "I16": torch.int16, "I8": torch.int8, "U8": torch.uint8, "BOOL": torch.bool,
+}
+SAFETENSORS_NAMES = {v: k for k, v in SAFETENSORS_DTYPES.items()}
+
+# torch.load(..., mmap=True) and Module.load_state_dict(..., assign=True)
+MIN_TORCH_VERSION = "2.1"
+
+CHECKPOINT_NAMES = [
+    ("model.safetensors.index.json", "model.safetensors"),
+    ("pytorch_model.bin.index.json", "pytorch_model.bin"),
+]
+
+
+def _find_checkpoint_files(folder):
+    for index_name, single_name in CHECKPOINT_NAMES:
+        index_file = os.path.join(folder, index_name)
+        if os.path.exists(index_file):
+            with open(index_file) as f:
+                shards = sorted(set(json.load(f)["weight_map"].values()))
+            return [os.path.join(folder, shard) for shard in shards]
+        if os.path.exists(os.path.join(folder, single_name)):
+            return [os.path.join(folder, single_name)]
+    return []
+
+
+def resolve_checkpoint_files(model_name, cache_dir=None):
+    """
+    Return the checkpoint files of a local model directory or a HuggingFace Hub model (safetensors preferred)
+    """
+    if os.path.isdir(model_name):
+        files = _find_checkpoint_files(model_name)
+    else:
+        from huggingface_hub import snapshot_download
+        files = []
+        for patterns in (["*.json", "*.safetensors"], ["*.json", "*.bin"]):
+            folder = snapshot_download(model_name, cache_dir=cache_dir, allow_patterns=patterns)
+            files = _find_checkpoint_files(folder)
+            if files:
+                break
+    if not files:
+        raise FileNotFoundError(f"No safetensors/pytorch_model.bin checkpoint found for {model_name}")
+    return files
+
+
+def mmap_safetensors(path):
+    """
+    Return {name: tensor} where every tensor is a view into a private memory mapping of the safetensors file
+    (writes, if any, are copy-on-write and never reach the file)
+    """
+    with open(path, "rb") as f:
+        header_len = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_len))
+    header.pop("__metadata__", None)
+
+    storage = torch.UntypedStorage.from_file(path, shared=False, nbytes=os.path.getsize(path))
+    data = torch.empty(0, dtype=torch.uint8).set_(storage)
+    start = 8 + header_len
+    tensors = {}
+    for name, info in header.items():
+        begin, end = info["data_offsets"]
+        dtype = SAFETENSORS_DTYPES[info["dtype"]]
+        raw = data[start + begin:start + end]
+        if (start + begin) % dtype.itemsize != 0:
+            # Not aligned for a zero-copy dtype view (does not happen with files written by safetensors)
+            raw = raw.clone()
+        tensors[name] = raw.view(dtype).reshape(info["shape"])
+    return tensors
+
+
+def save_safetensors(tensors, path):
+    """
+    Write {name: tensor} as a safetensors file. Tensors are laid out by decreasing element size so that every one of
+    them is aligned for zero-copy views (see mmap_safetensors).
+    """
+    names = sorted(tensors, key=lambda n: (-tensors[n].element_size(), n))
+    header, offset = {}, 0
+    for name in names:
+        t = tensors[name]
+        header[name] = {"dtype": SAFETENSORS_NAMES[t.dtype], "shape": list(t.shape),
+                        "data_offsets": [offset, offset + t.nbytes]}
+        offset += t.nbytes
+    header = json.dumps(header).encode("utf-8")
+    header += b" " * (-len(header) % 8)
+    with open(path, "wb") as f:
+        f.write(struct.pack("<Q", len(header)) + header)
+        for name in names:
+            t = tensors[name].detach().cpu().contiguous()
+            if t.nbytes:
+                f.write(t.reshape(-1).view(torch.uint8).numpy())
+
+
+def check_torch_version():
+    """
+    Raise a clear error (instead of a TypeError deep in loading) if torch is too old for memory-mapped loading
+    """
+    if version.parse(torch.__version__).release < version.parse(MIN_TORCH_VERSION).release:
+        raise RuntimeError(f"--mmap_load/--shared_base_dir need torch >= {MIN_TORCH_VERSION} (memory-mapped torch.load "
+                           f"and load_state_dict(assign=True)), found {torch.__version__}")
+
+
+def mmap_checkpoint(path):
+    if path.endswith(".safetensors"):
+        return mmap_safetensors(path)
+    # Zipfile torch checkpoints can be memory-mapped by torch.load directly
+    return torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+
+
+@contextlib.contextmanager
+def init_empty_weights():
+    """
+    Create the parameters of the modules built in this context on the meta device (no memory, no init cost).
+    Buffers are created as usual, as non-persistent ones (e.g., rotary embeddings) are not in the checkpoints.
+    """
+    register_parameter = nn.Module.register_parameter
+
+    def register_empty_parameter(module, name, param):
+        register_parameter(module, name, param)
+        if param is not None:
+            module._parameters[name] = nn.Parameter(param.to("meta"), requires_grad=param.requires_grad)
+
+    nn.Module.register_parameter = register_empty_parameter
+    try:
+        yield
+    finally:
+        nn.Module.register_parameter = register_parameter
+
+
+def load_model_mmap(model_name, config, model_cls=None, torch_dtype=None, cache_dir=None):
+    """
+    Build the model on the meta device and point its parameters to memory-mapped checkpoint tensors.
+    Input:
+    - model_cls: model class (e.g., ht_opt.OPTForCausalLM); AutoModelForCausalLM by default
+    - torch_dtype: parameters whose checkpoint dtype differs are converted, which costs private memory for them
+    Output: model (on CPU), with model.mmap_data_ptrs set to the data pointers of the mapped tensors
+    """
+    check_torch_version()
+    state_dict = {}
+    for path in resolve_checkpoint_files(model_name, cache_dir=cache_dir):
+        state_dict.update(mmap_checkpoint(path))
+
+    with init_empty_weights():
+        if model_cls is None:
+            from transformers import AutoModelForCausalLM
+            model = AutoModelForCausalLM.from_config(config, torch_dtype=torch_dtype)
+        else:
+            model = model_cls._from_config(config, torch_dtype=torch_dtype)
+
+    # Checkpoints may or may not include the base model prefix (e.g., "model." for OPT)
+    expected = set(model.state_dict().keys())
+    prefix = model.base_model_prefix + "."
+    converted_bytes = 0
+    mapped_ptrs = set()
+    for key in list(state_dict.keys()):
+        tensor = state_dict.pop(key)
+        if key not in expected:
+            if prefix + key in expected:
+                key = prefix + key
+            elif key.startswith(prefix) and key[len(prefix):] in expected:
+                key = key[len(prefix):]
+        if torch_dtype is not None and tensor.is_floating_point() and tensor.dtype != torch_dtype:
+            tensor = tensor.to(torch_dtype)
+            converted_bytes += tensor.nbytes
+        else:
+            mapped_ptrs.add(tensor.data_ptr())
+        state_dict[key] = tensor
+
+    result = model.load_state_dict(state_dict, strict=False, assign=True)
+    model.tie_weights()
+    if result.unexpected_keys:
+        logger.warning(f"Unused checkpoint weights: {result.unexpected_keys}")
+    still_empty = [n for n, p in model.named_parameters() if p.device.type == "meta"]
+    if still_empty:
+        raise ValueError(f"Weights missing from the checkpoint of {model_name}: {still_empty}")
+
+    model.eval()
+    model.mmap_data_ptrs = mapped_ptrs
+    mapped_bytes = sum(p.nbytes for p in model.parameters() if p.data_ptr() in model.mmap_data_ptrs)
+    logger.info(f"Memory-mapped {mapped_bytes / 1024 ** 3:.2f}GB of weights from {model_name}"
+                + (f" ({converted_bytes / 1024 ** 3:.2f}GB converted to {torch_dtype})" if converted_bytes else ""))
+    return model
+
+
+def materialize_trainable(model):
+    """
+    Give the trainable parameters their own writable memory (frozen ones stay mapped). Parameter objects are kept,
+    so tied weights stay tied.
+    """
+    mapped = getattr(model, "mmap_data_ptrs", set())
+    copied_bytes = 0
+    for p in model.parameters():
+        if p.requires_grad and p.data_ptr() in mapped:
+            mapped.discard(p.data_ptr())
+            p.data = p.data.clone()
+            copied_bytes += p.nbytes
+    logger.info(f"Materialized {copied_bytes / 1024 ** 3:.3f}GB of trainable weights")
+    return model
+
+
+def publish_shared_base(model_name, config, shared_dir, model_cls=None, torch_dtype=None, cache_dir=None):
+    """
+    Publish the base weights of a model (converted to torch_dtype) as one safetensors file under shared_dir
+    (e.g., on /dev/shm), once for all the processes of a sweep: the first process writes it, the others wait on a
+    file lock and reuse it. Loading the returned directory with load_model_mmap(..., torch_dtype) is then zero-copy,
+    so concurrent runs share a single copy of the frozen weights.
+    Output: directory of the published weights
+    """
+    from filelock import FileLock
+
+    check_torch_version()
+
+    key = json.dumps([os.path.abspath(model_name) if os.path.isdir(model_name) else model_name,
+                      str(torch_dtype), getattr(model_cls, "__name__", None), config.to_json_string()])
+    name = "{}-{}".format(os.path.basename(model_name.rstrip("/")), hashlib.sha1(key.encode("utf-8")).hexdigest()[:12])
+    folder = os.path.join(shared_dir, name)
+    os.makedirs(shared_dir, exist_ok=True)
+
+    with FileLock(folder + ".lock"):
+        if not os.path.exists(os.path.join(folder, "model.safetensors")):
+            logger.info(f"Publishing the base weights of {model_name} to {folder}")
+            model = load_model_mmap(model_name, config, model_cls=model_cls, torch_dtype=torch_dtype,
+                                    cache_dir=cache_dir)
+            # Tied weights are saved once; load_model_mmap ties them again
+            tensors, seen = {}, set()
+            for n, t in model.state_dict().items():
+                if t.data_ptr() not in seen or t.nbytes == 0:
+                    seen.add(t.data_ptr())
+                    tensors[n] = t
+            tmp_folder = folder + ".tmp"
+            os.makedirs(tmp_folder, exist_ok=True)
+            save_safetensors(tensors, os.path.join(tmp_folder, "model.safetensors"))
+            os.replace(tmp_folder, folder)
+            del model, tensors
+        else:
+            logger.info(f"Attaching to the published base weights in {folder}")
+    return folder
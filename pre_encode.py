@@ -0,0 +1,138 @@
+"""
+Pre-encoding of whole splits (Framework.train): the same outputs as calling encode_prompt on every sample, with
+- --fast_encode: all the prompts of a split tokenized in one batched call of the fast (Rust) tokenizer, and the option
+  lengths read from the character offsets of the options in the prompts instead of encoding the (un)verbalized
+  prompts again. The fast tokenizer is first checked against the slow one (exact token ids and option lengths) on
+  the first samples of the split, and the slow one is used if they differ.
+- --encode_workers: the samples split across a pool of (forked) processes.
+"""
+import logging
+import multiprocessing
+import os
+
+from transformers import AutoTokenizer
+
+from utils import encode_prompt, prompt_texts, truncate_encodings
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Encoding job inherited by the forked workers (so that the task, tokenizers and samples are not pickled)
+_JOB = None
+
+
+def load_fast_tokenizer(tokenizer):
+    """
+    Fast tokenizer with the same vocabulary as the (slow) tokenizer, or None if there is none
+    """
+    try:
+        fast_tokenizer = AutoTokenizer.from_pretrained(tokenizer.name_or_path, use_fast=True)
+    except Exception as e:
+        logger.warning(f"No fast tokenizer for {tokenizer.name_or_path}: {e}")
+        return None
+    return fast_tokenizer if fast_tokenizer.is_fast else None
+
+
+def option_len_from_offsets(final_prompt, offsets, unverbalized_eval_prompt, verbalized_eval_prompt):
+    """
+    Number of tokens of final_prompt (character offsets of its tokens) that belong to the option, i.e., that the
+    verbalized eval prompt adds to the unverbalized one. None if the option does not start on a token boundary.
+    """
+    if not verbalized_eval_prompt.startswith(unverbalized_eval_prompt):
+        return None
+    option = verbalized_eval_prompt[len(unverbalized_eval_prompt):]
+    if not final_prompt.endswith(option):
+        return None
+    boundary = len(final_prompt) - len(option)
+    if any(start < boundary < end for start, end in offsets):
+        return None
+    return sum(1 for start, _ in offsets if start >= boundary)
+
+
+def fast_encode_prompts(task, template, train_samples, samples, tokenizer, fast_tokenizer, max_length, sfc=False,
+                        icl_sfc=False, generation=False, generation_with_gold=False, max_new_tokens=None):
+    """
+    encode_prompt for all the samples, with one batched call of the fast tokenizer
+    Output: list of (encodings, option_lens), one per sample
+    """
+    texts = [prompt_texts(task, template, train_samples, sample, sfc=sfc, icl_sfc=icl_sfc, generation=generation,
+                          generation_with_gold=generation_with_gold) for sample in samples]
+    batch = fast_tokenizer([p for final_prompts, _ in texts for p in final_prompts], add_special_tokens=False,
+                           return_offsets_mapping=True)
+
+    results, unaligned = [], []
+    k = 0
+    for final_prompts, option_texts in texts:
+        encodings, option_lens = [], []
+        for j, final_prompt in enumerate(final_prompts):
+            # Special tokens as the slow tokenizer adds them (e.g., the fixed OPT BOS id)
+            encodings.append(tokenizer.build_inputs_with_special_tokens(batch["input_ids"][k]))
+            if option_texts is None:
+                option_lens.append(0)
+            else:
+                option_len = option_len_from_offsets(final_prompt, batch["offset_mapping"][k], option_texts[0],
+                                                     option_texts[1][j])
+                if option_len is None:
+                    unaligned.append((len(results), j, option_texts[0], option_texts[1][j]))
+                option_lens.append(option_len)
+            k += 1
+        encodings = truncate_encodings(encodings, tokenizer, max_length, generation=generation,
+                                       max_new_tokens=max_new_tokens)
+        results.append((encodings, option_lens))
+
+    if unaligned:
+        # Options that do not start on a token boundary: difference of the token counts, as encode_prompt
+        counts = fast_tokenizer([u for _, _, u, _ in unaligned] + [v for _, _, _, v in unaligned],
+                                add_special_tokens=False)["input_ids"]
+        for i, (n, j, _, _) in enumerate(unaligned):
+            results[n][1][j] = len(counts[len(unaligned) + i]) - len(counts[i])
+    return results
+
+
+def _encode(samples, fast_tokenizer):
+    job = _JOB
+    if fast_tokenizer is not None:
+        return fast_encode_prompts(job["task"], job["template"], job["train_samples"], samples, job["tokenizer"],
+                                   fast_tokenizer, **job["kwargs"])
+    return [encode_prompt(job["task"], job["template"], job["train_samples"], sample, job["tokenizer"], **job["kwargs"])
+            for sample in samples]
+
+
+def _encode_chunk(bounds):
+    return _encode(_JOB["samples"][bounds[0]:bounds[1]], _JOB["fast_tokenizer"])
+
+
+def encode_split(task, template, samples, tokenizer, max_length, fast_tokenizer=None, num_workers=0, num_check=64,
+                 train_samples=(), **kwargs):
+    """
+    Same as [encode_prompt(task, template, train_samples, sample, tokenizer, max_length, **kwargs) for sample in samples]
+    Input:
+    - fast_tokenizer: batched fast tokenization (checked against the slow tokenizer on the first num_check samples;
+      num_check=0 if it has already been checked)
+    - num_workers: number of processes
+    """
+    global _JOB
+    _JOB = {"task": task, "template": template, "train_samples": list(train_samples), "tokenizer": tokenizer,
+            "kwargs": dict(kwargs, max_length=max_length), "samples": samples, "fast_tokenizer": None}
+    try:
+        if fast_tokenizer is not None and num_check > 0:
+            checked = _encode(samples[:num_check], None)
+            if _encode(samples[:num_check], fast_tokenizer) != checked:
+                logger.warning("The fast tokenizer does not match the slow one on this split, using the slow one")
+                fast_tokenizer = None
+            elif len(samples) <= num_check:
+                return checked
+
+        if num_workers <= 1 or len(samples) < 2 * num_workers or "fork" not in multiprocessing.get_all_start_methods():
+            return _encode(samples, fast_tokenizer)
+
+        _JOB["fast_tokenizer"] = fast_tokenizer
+        # The workers are the parallelism (Rust threads do not survive the fork anyway)
+        os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+        # A few chunks per worker to balance the load
+        size = -(-len(samples) // (4 * num_workers))
+        bounds = [(start, min(start + size, len(samples))) for start in range(0, len(samples), size)]
+        with multiprocessing.get_context("fork").Pool(num_workers) as pool:
+            return [result for chunk in pool.map(_encode_chunk, bounds) for result in chunk]
+    finally:
+        _JOB = None
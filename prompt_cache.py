@@ -0,0 +1,104 @@
+"""
+Demonstration token cache (--cache_demonstrations): encode_prompt tokenizes the whole demonstration block again for
+every eval sample and every candidate. DemonstrationCache tokenizes each demonstration once and assembles the prompts
+by concatenating the cached tokens, then truncates them from the known lengths (copying only the kept tokens).
+
+A prompt "d_1<sep>d_2<sep>...<sep>d_k<sep>e" is tokenized as the pieces d_1, <sep>d_2, ..., <sep>d_k, <sep>e: each piece
+starts with the separator (whitespace) right after a demonstration that ends with a non-whitespace character, which is
+a pre-tokenization boundary of byte-level BPE tokenizers (GPT-2/OPT), so the concatenation is exactly the tokenization
+of the whole prompt. This is checked against encode_prompt on the first prompts, and encode_prompt is used instead if
+they differ (e.g., SentencePiece tokenizers).
+"""
+import logging
+
+from utils import encode_prompt, eval_prompt_texts, keeps_first_token, option_lengths
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def tail(pieces, n):
+    """
+    Last n tokens of the concatenation of pieces (lists of tokens), copying only those
+    """
+    kept = []
+    for piece in reversed(pieces):
+        if n <= 0:
+            break
+        kept.append(piece[-n:] if n < len(piece) else piece)
+        n -= len(piece)
+    return [token for piece in reversed(kept) for token in piece]
+
+
+class DemonstrationCache:
+    """
+    encode_prompt with the tokens of the demonstrations cached (by their verbalized text)
+    Input:
+    - num_check: number of prompts checked against encode_prompt
+    """
+
+    def __init__(self, task, template, tokenizer, num_check=32):
+        self.task = task
+        self.template = template
+        self.tokenizer = tokenizer
+        self.num_check = num_check
+        self.pieces = {}
+        self.enabled = True
+        # Special tokens around the tokens of a text (e.g., the BOS of OPT)
+        sentinel = tokenizer.build_inputs_with_special_tokens([-1])
+        self.prefix, self.suffix = sentinel[:sentinel.index(-1)], sentinel[sentinel.index(-1) + 1:]
+
+    def _piece(self, text):
+        tokens = self.pieces.get(text)
+        if tokens is None:
+            tokens = self.pieces[text] = self.tokenizer.encode(text, add_special_tokens=False)
+        return tokens
+
+    def _truncate(self, pieces, max_length):
+        """
+        truncate_encodings (without the warning) of the concatenation of pieces
+        """
+        length = sum(len(piece) for piece in pieces)
+        if keeps_first_token(self.tokenizer):
+            # encoding[0:1] + encoding[1:][-(max_length - 1):]
+            i = next((i for i, piece in enumerate(pieces) if len(piece) > 0), 0)
+            rest = [pieces[i][1:]] + pieces[i + 1:]
+            return pieces[i][0:1] + tail(rest, len(range(max(length - 1, 0))[-(max_length - 1):]))
+        # encoding[-max_length:]
+        return tail(pieces, len(range(length)[-max_length:]))
+
+    def encode_prompt(self, train_samples, eval_sample, max_length, sfc=False, icl_sfc=False, generation=False,
+                      generation_with_gold=False, max_new_tokens=None):
+        """
+        Same as utils.encode_prompt(task, template, train_samples, eval_sample, tokenizer, max_length, ...)
+        """
+        kwargs = dict(sfc=sfc, icl_sfc=icl_sfc, generation=generation, generation_with_gold=generation_with_gold,
+                      max_new_tokens=max_new_tokens)
+        demonstrations = [self.template.verbalize(sample, sample.correct_candidate).strip() for sample in train_samples]
+        eval_prompts, option_texts = eval_prompt_texts(self.template, eval_sample, sfc=sfc, icl_sfc=icl_sfc,
+                                                       generation=generation, generation_with_gold=generation_with_gold)
+        # Prompts without demonstrations, or whose pieces would not be split as in prompt_texts
+        eval_prompts = [eval_prompt.rstrip(' ') for eval_prompt in eval_prompts]
+        if not self.enabled or sfc or len(demonstrations) == 0 or "" in demonstrations or "" in eval_prompts:
+            return encode_prompt(self.task, self.template, train_samples, eval_sample, self.tokenizer, max_length,
+                                 **kwargs)
+
+        sep = self.task.train_sep
+        pieces = [self.prefix, self._piece(demonstrations[0])] + [self._piece(sep + d) for d in demonstrations[1:]]
+        candidates = [pieces + [self.tokenizer.encode(sep + eval_prompt, add_special_tokens=False), self.suffix]
+                      for eval_prompt in eval_prompts]
+        limit = max_length - max_new_tokens if generation and max_new_tokens is not None else max_length
+        if any(sum(len(piece) for piece in candidate) > limit for candidate in candidates):
+            logger.warn("Exceed max length")
+        encodings = [self._truncate(candidate, limit) for candidate in candidates]
+        option_lens = option_lengths(option_texts, self.tokenizer)
+
+        if self.num_check > 0:
+            self.num_check -= 1
+            expected = encode_prompt(self.task, self.template, train_samples, eval_sample, self.tokenizer, max_length,
+                                     **kwargs)
+            if (encodings, option_lens) != expected:
+                logger.warning("The cached demonstration tokens do not match encode_prompt, not using the cache")
+                self.enabled = False
+                return expected
+        return encodings, option_lens
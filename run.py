@@ -20,17 +20,16 @@ from tasks import get_task
 import json
 import torch.nn.functional as F
 from torch.utils.data import Dataset
-from torch.distributed.fsdp.fully_sharded_data_parallel import FullyShardedDataParallel as FSDP
 from metrics import calculate_metric
 from utils import *
 from trainer import OurTrainer
+from pre_encode import encode_split, load_fast_tokenizer
+from token_cache import TokenCache
+from streaming import StreamingTrainDataset, stream_files
+from prompt_cache import DemonstrationCache
 import random
-import wandb
 import copy
 from torch import nn
-from huggingface_hub import login
-login(token="")
-from dataset import FewShotDataset, OurInputFeatures
 
 #os.environ["CUDA_VISIBLE_DEVICES"] = "0,1,2,3"
 os.environ["CUDA_VISIBLE_DEVICES"] = "3,4"
@@ -41,6 +40,7 @@ os.environ["CUDA_VISIBLE_DEVICES"] = "3,4"
 class OurArguments(TrainingArguments):
     # dataset and sampling strategy
     task_name: str = "SST2"  # task name should match the string before Dataset in the Dataset class name. We support the following task_name: SST2, RTE, CB, BoolQ, WSC, WIC, MultiRC, Copa, ReCoRD, SQuAD, DROP
+    columnar_samples: bool = False  # store the sampled splits as columns (tasks.SampleStore) instead of one Sample object per row
 
     # Number of examples
     num_train: int = 0  # ICL mode: number of demonstrations; training mode: number of training samples
@@ -57,6 +57,8 @@ class OurArguments(TrainingArguments):
     load_int8: bool = False  # load model parameters as int8
     max_length: int = 2048  # max length the model can take
     no_auto_device: bool = False  # do not load model by auto device; should turn this on when using FSDP
+    mmap_load: bool = False  # memory-map the checkpoint (zero-copy, no CUDA needed; the model stays on CPU unless the trainer moves it); only trainable parameters get their own memory
+    shared_base_dir: str = None  # (implies mmap_load) publish the base weights once under this directory (e.g., /dev/shm/zo_base) and share them read-only across concurrent runs
 
     # Calibration
     sfc: bool = False  # whether to use SFC calibration
@@ -119,10 +121,53 @@ class OurArguments(TrainingArguments):
 
     # Non-diff objective
     non_diff: bool = False  # use non-differentiable objective (only support F1 for SQuAD for now)
+    non_diff_answer_margin: int = None  # (non_diff) generate at most the gold answer length + this many tokens (instead of max_new_tokens)
 
     # Auto saving when interrupted
     save_on_interrupt: bool = False  # save model when interrupted (useful for long training)
 
+    # Multi-process ZO (launch with torchrun; on CPU add --no_cuda --xpu_backend gloo)
+    zo_parallel: str = "none"  # none / direction (ranks evaluate different directions on the same batch) / data (ranks evaluate the same directions on different shards); only projected gradients are all-reduced / pipeline (ranks hold consecutive blocks of layers, see zo_pipeline.py)
+    zo_pipeline_micro_batches: int = 1  # (pipeline) number of micro-batches each perturbed forward is split into
+
+    # Token-budget batching (see token_budget.py)
+    max_tokens_per_batch: int = None  # batch training examples and eval candidates by padded tokens (rows x length) instead of per_device_train_batch_size; ZO projected gradients are scaled by #examples / per_device_train_batch_size
+
+    # Pre-encoding (see pre_encode.py)
+    fast_encode: bool = False  # tokenize the training/dev splits in batches with the fast tokenizer (checked for exact parity against the slow one; option lengths from character offsets)
+    encode_workers: int = 0  # number of processes to encode the training/dev splits with
+
+    # Streaming training data (see streaming.py)
+    train_stream: str = None  # comma-separated globs of JSONL/Arrow shards (rows of the task's dataset) streamed as training data instead of the sampled train set; requires max_steps
+    stream_buffer_size: int = 10000  # rows in the shuffle buffer of each data loader worker
+
+    # ICL prompts
+    cache_demonstrations: bool = False  # tokenize each demonstration once and assemble the ICL prompts from the cached tokens (see prompt_cache.py)
+    batch_generation: bool = False  # generate the outputs of generation tasks (SQuAD, DROP) for batches of left-padded prompts (max_tokens_per_batch prompt + new tokens, or per_device_eval_batch_size prompts); greedy decoding retires the rows that end (see batch_generation.py)
+    icl_prefix_cache: bool = False  # with one demonstration set for all the eval samples, run the demonstrations once and score the candidates as batches (per_device_eval_batch_size) of continuations of their KV cache (see icl_prefix.py)
+
+    # Token cache (see token_cache.py)
+    token_cache_dir: str = None  # cache the task samples and their tokens on disk (keyed by task, task loader and template sources, tokenizer contents, max_length, max_new_tokens, seed, columnar_samples) and memory-map them in later runs
+
+    # Data loading (see prefetch.py)
+    device_prefetch: bool = False  # collate the next training batch in a background thread (plus --dataloader_num_workers workers), pin it and copy it to the device on a side stream during the current step
+
+    # Sequence packing
+    pack_sequences: bool = False  # (ZO, OPT, LM-style objectives) pack the training examples of a batch into rows of --max_length tokens, with a block-diagonal causal mask and per-example positions (ht_opt.py)
+
+    # Compiled ZO forward (see zo_compile.py)
+    zo_compile: bool = False  # torch.compile the ZO forward and loss; training batches are padded to --compile_length_buckets, unsupported cases run eagerly
+    compile_length_buckets: str = "32,64,96,128,192,256,384,512"  # comma-separated padded sequence lengths (longer batches run eagerly)
+    compile_cache_dir: str = None  # persistent inductor cache directory, so that compiled graphs are reused across runs
+
+    # Memory accounting
+    track_memory: bool = False  # record per-phase (perturb/forward/update/dizo/eval) peak memory and named buffer sizes
+    telemetry_queue_size: int = 1024  # max number of metric records waiting for the background telemetry writer
+    telemetry_drop_policy: str = "drop_oldest"  # when the telemetry queue of the wandb/logger sinks is full: drop_oldest / drop_newest / block (the run log and JSONL are written synchronously and never drop)
+
+    # HuggingFace Hub
+    hf_token: str = None  # log in to the HuggingFace Hub (for gated models) before loading the model
+
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -138,11 +183,59 @@ def set_seed(seed: int):
     torch.cuda.manual_seed_all(seed)
 
 
+def convert_samples(task, samples, encoded, args):
+    """
+    Convert samples to HF-compatible dataset
+    Input:
+    - encoded: encode_prompt outputs (encodings, option_lens) of each sample, without demonstrations and with the gold
+      answers of generation tasks (see pre_encode.encode_split)
+    """
+    data = []
+    for sample, (encoded_candidates, option_lens) in zip(samples, encoded):
+        if task.generation:
+            correct_candidate_id = 0
+        elif isinstance(sample.correct_candidate, list):
+            correct_candidate_id = sample.candidates.index(sample.correct_candidate[0])
+        else:
+            correct_candidate_id = sample.candidates.index(sample.correct_candidate)
+
+        if args.non_diff:
+            # For non-differentiable objective, there is no teacher forcing thus the
+            # current answer part is removed
+            encoded_candidates[correct_candidate_id] = encoded_candidates[correct_candidate_id][
+                                                       :-option_lens[correct_candidate_id]]
+
+        if args.train_as_classification:
+            # For classification, we provide the label as the correct candidate id
+            data.append([{"input_ids": encoded_candidates[_i], "labels": correct_candidate_id,
+                          "option_len": option_lens[_i], "num_options": len(sample.candidates)} for _i in
+                         range(len(encoded_candidates))])
+        elif args.only_train_option:
+            # Otherwise, it is just LM-style teacher forcing
+            if args.non_diff:
+                # For non-differentiable objective, we need to provide the gold answer to calculate F1/acc
+                data.append({"input_ids": encoded_candidates[correct_candidate_id],
+                             "labels": encoded_candidates[correct_candidate_id],
+                             "option_len": option_lens[correct_candidate_id], "gold": sample.correct_candidate})
+            else:
+                data.append({"input_ids": encoded_candidates[correct_candidate_id],
+                             "labels": encoded_candidates[correct_candidate_id],
+                             "option_len": option_lens[correct_candidate_id]})
+        else:
+            data.append({"input_ids": encoded_candidates[correct_candidate_id],
+                         "labels": encoded_candidates[correct_candidate_id]})
+    return data
+
+
 class Framework:
 
-    def __init__(self, args, task):
+    def __init__(self, args, task, token_cache=None):
         self.args = args
         self.task = task
+        self.token_cache = token_cache
+        self.fast_tokenizer = None
+        self.demonstration_cache = None
+        self.sfc_cache = ScoreCache()
         self.model, self.tokenizer = self.load_model()
 
     def load_model(self):
@@ -151,19 +244,54 @@ class Framework:
         """
 
         with count_time("Loading model with FP%d" % (16 if self.args.load_float16 else 32)):
-            free_in_GB = int(torch.cuda.mem_get_info()[0] / 1024 ** 3)
             config = AutoConfig.from_pretrained(self.args.model_name)
+            if self.args.pack_sequences:
+                if config.model_type != "opt":
+                    raise NotImplementedError("--pack_sequences is only implemented for OPT (ht_opt.py)")
+                if self.args.trainer != "zo" or self.args.train_as_classification or self.args.non_diff \
+                        or self.args.zo_parallel == "pipeline":
+                    raise ValueError("--pack_sequences only supports ZO training of LM-style objectives (no "
+                                     "--train_as_classification/--non_diff/--zo_parallel pipeline)")
+            if self.args.icl_prefix_cache and self.args.prefix_tuning:
+                raise ValueError("--icl_prefix_cache does not support --prefix_tuning (the prefixes are already in "
+                                 "the past key values)")
             if self.args.untie_emb:
                 # Untie embeddings/LM head
                 logger.warn("Untie embeddings and LM head")
                 config.tie_word_embeddings = False
-            if self.args.head_tuning:
+            torch_dtype = torch.float32
+            if self.args.load_float16:
+                torch_dtype = torch.float16
+            elif self.args.load_bfloat16:
+                torch_dtype = torch.bfloat16
+            if self.args.mmap_load or self.args.shared_base_dir is not None:
+                # Zero-copy loading on CPU; the trainer moves the model to the accelerator if there is one
+                from mmap_loader import load_model_mmap, publish_shared_base
+                model_cls = None
+                if self.args.head_tuning or self.args.pack_sequences:
+                    from ht_opt import OPTForCausalLM as model_cls
+                model_dir = self.args.model_name
+                if self.args.shared_base_dir is not None:
+                    model_dir = publish_shared_base(self.args.model_name, config, self.args.shared_base_dir,
+                                                    model_cls=model_cls, torch_dtype=torch_dtype, cache_dir="llm_weight")
+                model = load_model_mmap(model_dir, config, model_cls=model_cls, torch_dtype=torch_dtype,
+                                        cache_dir="llm_weight")
+            elif self.args.head_tuning:
                 # Head tuning
                 from ht_opt import OPTForCausalLM
                 model = OPTForCausalLM.from_pretrained(
                     self.args.model_name,
                     config=config,
                 )
+            elif self.args.pack_sequences:
+                # Packed sequences need the segment-aware attention mask and positions of ht_opt
+                from ht_opt import OPTForCausalLM
+                model = OPTForCausalLM.from_pretrained(
+                    self.args.model_name,
+                    config=config,
+                    cache_dir="llm_weight",
+                    torch_dtype=torch_dtype,
+                )
             elif self.args.no_auto_device:
                 # No auto device (use for FSDP)
                 model = AutoModelForCausalLM.from_pretrained(
@@ -172,18 +300,17 @@ class Framework:
                 )
             else:
                 # Auto device loading
-                torch_dtype = torch.float32
-                if self.args.load_float16:
-                    torch_dtype = torch.float16
-                elif self.args.load_bfloat16:
-                    torch_dtype = torch.bfloat16
+                max_memory = None
+                if torch.cuda.is_available():
+                    free_in_GB = int(torch.cuda.mem_get_info()[0] / 1024 ** 3)
+                    max_memory = {i: f'{free_in_GB - 10}GB' for i in range(torch.cuda.device_count())}
                 model = AutoModelForCausalLM.from_pretrained(
                     self.args.model_name,
                     cache_dir = "llm_weight",
                     config=config,
-                    device_map="auto",
+                    device_map="auto" if torch.cuda.is_available() else None,
                     torch_dtype=torch_dtype,
-                    max_memory={i: f'{free_in_GB - 10}GB' for i in range(torch.cuda.device_count())},
+                    max_memory=max_memory,
                     #max_memory={0: "30GB", 1: "30GB", 2: "30GB", 3: "30GB"},
                     load_in_8bit=self.args.load_int8,
                 )
@@ -221,6 +348,21 @@ class Framework:
                 else:
                     logger.info(f"Only tuning {n}")
 
+        if self.args.trainer == "zo" and self.args.zo_parallel == "pipeline":
+            # Keep only this rank's stage (with mmap_load, the layers of the other stages are never read)
+            import torch.distributed as dist
+            device = self.args.device  # Initializes the process group under torchrun
+            if dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1:
+                from zo_pipeline import partition_model
+                comm_device = torch.device("cpu") if dist.get_backend() == "gloo" else device
+                partition_model(model, dist.get_rank(), dist.get_world_size(), comm_device,
+                                micro_batches=self.args.zo_pipeline_micro_batches)
+
+        if self.args.mmap_load or self.args.shared_base_dir is not None:
+            # Frozen weights stay memory-mapped (page cache backed, shared with other processes)
+            from mmap_loader import materialize_trainable
+            materialize_trainable(model)
+
         return model, tokenizer
 
     def forward(self, input_ids, option_len=None, generation=False):
@@ -229,7 +371,7 @@ class Framework:
         For generation tasks, return the generated text.
         This function is only for inference
         """
-        input_ids = torch.tensor([input_ids]).to(self.model.device)
+        input_ids = torch.tensor(np.asarray(input_ids, dtype=np.int64)[None]).to(self.model.device)
 
         if generation:
             args = self.args
@@ -248,15 +390,9 @@ class Framework:
         else:
             with torch.inference_mode():
                 self.model.eval()
-                logits = self.model(input_ids=input_ids).logits
-            labels = input_ids[0, 1:]
-            logits = logits[0, :-1]
-            log_probs = F.log_softmax(logits, dim=-1)
-
-            selected_log_probs = log_probs[torch.arange(len(labels)).to(labels.device), labels]
-            selected_log_probs = selected_log_probs.cpu().detach()
-            # Only return the option (candidate) part
-            return selected_log_probs[-option_len:]
+                # Only return the option (candidate) part
+                selected_log_probs = token_log_probs(self.model, input_ids, last=option_len)
+            return selected_log_probs[0].cpu().detach()
 
     # def one_step_pred(self, train_samples, eval_sample, verbose=False):
     #     """
@@ -305,9 +441,43 @@ class Framework:
 
     #     return Prediction(correct_candidate=correct_candidate_id, predicted_candidate=int(np.argmax(scores)))
     
-    def one_step_pred(self, train_samples, eval_sample, verbose=False):
+    def encode_samples(self, samples, generation_with_gold=False):
+        """
+        encode_prompt outputs of samples without demonstrations (pre_encode.encode_split), read from/saved to the
+        token cache
+        """
+        variant = "gold" if generation_with_gold and self.task.generation else "prompt"
+        encoded = self.token_cache.get(samples, variant) if self.token_cache is not None else None
+        if encoded is None:
+            if self.args.fast_encode and self.fast_tokenizer is None:
+                self.fast_tokenizer = load_fast_tokenizer(self.tokenizer)
+            encoded = encode_split(
+                self.task, self.task.get_template(), samples, self.tokenizer, max_length=self.args.max_length,
+                fast_tokenizer=self.fast_tokenizer, num_workers=self.args.encode_workers,
+                generation=self.task.generation, generation_with_gold=generation_with_gold,
+                max_new_tokens=self.args.max_new_tokens
+            )
+            if self.token_cache is not None:
+                self.token_cache.put(samples, variant, encoded)
+        return encoded
+
+    def encode_prompt(self, train_samples, eval_sample, **kwargs):
+        """
+        encode_prompt (max_length, generation and max_new_tokens from the arguments and the task), with the tokens of the
+        demonstrations cached with --cache_demonstrations (see prompt_cache.py)
+        """
+        kwargs = dict(dict(max_length=self.args.max_length, generation=self.task.generation,
+                           max_new_tokens=self.args.max_new_tokens), **kwargs)
+        if self.args.cache_demonstrations:
+            if self.demonstration_cache is None:
+                self.demonstration_cache = DemonstrationCache(self.task, self.task.get_template(), self.tokenizer)
+            return self.demonstration_cache.encode_prompt(train_samples, eval_sample, **kwargs)
+        return encode_prompt(self.task, self.task.get_template(), train_samples, eval_sample, self.tokenizer, **kwargs)
+
+    def one_step_pred(self, train_samples, eval_sample, verbose=False, encoded=None):
         """
         Return the prediction on the eval sample. In ICL, use train_samples as demonstrations
+        encoded: encode_prompt outputs of the sample if already encoded (see encode_samples)
         """
         verbose = verbose or self.args.verbose
         if verbose:
@@ -316,21 +486,15 @@ class Framework:
             logger.info(f"Correct candidate: {eval_sample.correct_candidate}")
 
         # Encode (add prompt and tokenize) the sample; if multiple-choice/classification, encode all candidates (options)
-        encoded_candidates, option_lens = encode_prompt(
-            self.task, self.task.get_template(), train_samples, eval_sample, self.tokenizer,
-            max_length=self.args.max_length,
-            generation=self.task.generation, max_new_tokens=self.args.max_new_tokens
-        )
+        if encoded is not None:
+            encoded_candidates, option_lens = encoded
+        else:
+            encoded_candidates, option_lens = self.encode_prompt(train_samples, eval_sample)
 
         # Calibration
         if self.args.sfc or self.args.icl_sfc:
-            sfc_encoded_candidates, sfc_option_lens = encode_prompt(self.task, self.task.get_template(),
-                                                                    train_samples, eval_sample, self.tokenizer,
-                                                                    max_length=self.args.max_length,
-                                                                    sfc=self.args.sfc, icl_sfc=self.args.icl_sfc,
-                                                                    generation=self.task.generation,
-                                                                    max_new_tokens=self.args.max_new_tokens
-                                                                    )
+            sfc_encoded_candidates, sfc_option_lens = self.encode_prompt(train_samples, eval_sample,
+                                                                         sfc=self.args.sfc, icl_sfc=self.args.icl_sfc)
 
         outputs = []
         if self.task.generation:
@@ -355,8 +519,9 @@ class Framework:
                     logger.info(f"Log probabilities of the option tokens: {selected_log_probs}")
 
                 if self.args.sfc or self.args.icl_sfc:
-                    sfc_selected_log_probs = self.forward(sfc_encoded_candidates[candidate_id],
-                                                          option_len=sfc_option_lens[candidate_id])
+                    # Calibration prompts shared by several eval samples are scored once (see utils.ScoreCache)
+                    sfc_selected_log_probs = self.sfc_cache.score(sfc_encoded_candidates[candidate_id],
+                                                                  sfc_option_lens[candidate_id], self.forward)
                     if verbose:
                         logger.info("=== Candidate %d (without context) SFC ===" % candidate_id)
                         logger.info(
@@ -397,18 +562,47 @@ class Framework:
 
         # Prediction loop
         predictions = []
+        self.sfc_cache.clear()
+        shared_demonstrations = not one_train_set_per_eval_sample and len(train_samples) > 0
+        if not self.task.generation and (self.args.max_tokens_per_batch is not None or
+                                         (self.args.icl_prefix_cache and shared_demonstrations)):
+            # Batched scoring of all the candidates within a token budget, or as continuations of the demonstrations
+            from token_budget import predict_candidates
+            train_sets = train_samples if one_train_set_per_eval_sample else [train_samples] * len(eval_samples)
+            predictions, _ = predict_candidates(self.model, self.tokenizer, self.task, self.args, train_sets, eval_samples,
+                                                encode=self.encode_prompt)
+            eval_samples = []
+        elif self.task.generation and self.args.batch_generation:
+            # Generation for batches of prompts (see batch_generation.py)
+            from batch_generation import predict_generations
+            if not one_train_set_per_eval_sample and len(train_samples) == 0:
+                encoded = self.encode_samples(eval_samples)
+            else:
+                encoded = [self.encode_prompt(train_samples[eval_id] if one_train_set_per_eval_sample else train_samples,
+                                              eval_sample) for eval_id, eval_sample in enumerate(eval_samples)]
+            predictions = predict_generations(self.model, self.tokenizer, self.args, eval_samples,
+                                              [encoded_candidates[0] for encoded_candidates, _ in encoded])
+            eval_samples = []
+        encoded = [None] * len(eval_samples)
+        if not one_train_set_per_eval_sample and len(train_samples) == 0 and len(eval_samples) > 0:
+            # No demonstrations: the eval samples are encoded (or read from the token cache) all at once
+            encoded = self.encode_samples(eval_samples)
         for eval_id, eval_sample in enumerate(tqdm(eval_samples)):
             predictions.append(
                 self.one_step_pred(train_samples[eval_id] if one_train_set_per_eval_sample else train_samples,
-                                   eval_sample, verbose=False)
+                                   eval_sample, verbose=False, encoded=encoded[eval_id])
             )
 
+        if self.sfc_cache.hits > 0:
+            logger.info(f"{len(self.sfc_cache.scores)} distinct calibration prompts ({self.sfc_cache.hits} reused)")
+        self.sfc_cache.clear()
+
         # Calculate metrics
         metric_name = getattr(self.task, "metric_name", "accuracy")
         metrics = {metric_name: calculate_metric(predictions, metric_name)}
         return metrics
 
-    def train(self, train_samples, eval_samples):
+    def train(self, train_samples, eval_samples, callbacks=None):
         """
         Training function
         """
@@ -427,53 +621,29 @@ class Framework:
                 return self.data[idx]
 
         def _convert(samples):
-            """
-            Convert samples to HF-compatible dataset
-            """
-            data = []
-            for sample in samples:
-                encoded_candidates, option_lens = encode_prompt(
-                    self.task, self.task.get_template(), [], sample, self.tokenizer,
-                    max_length=self.args.max_length, generation=self.task.generation, generation_with_gold=True,
-                    max_new_tokens=self.args.max_new_tokens
-                )
-                if self.task.generation:
-                    correct_candidate_id = 0
-                elif isinstance(sample.correct_candidate, list):
-                    correct_candidate_id = sample.candidates.index(sample.correct_candidate[0])
-                else:
-                    correct_candidate_id = sample.candidates.index(sample.correct_candidate)
-
-                if self.args.non_diff:
-                    # For non-differentiable objective, there is no teacher forcing thus the
-                    # current answer part is removed
-                    encoded_candidates[correct_candidate_id] = encoded_candidates[correct_candidate_id][
-                                                               :-option_lens[correct_candidate_id]]
-
-                if self.args.train_as_classification:
-                    # For classification, we provide the label as the correct candidate id
-                    data.append([{"input_ids": encoded_candidates[_i], "labels": correct_candidate_id,
-                                  "option_len": option_lens[_i], "num_options": len(sample.candidates)} for _i in
-                                 range(len(encoded_candidates))])
-                elif self.args.only_train_option:
-                    # Otherwise, it is just LM-style teacher forcing
-                    if self.args.non_diff:
-                        # For non-differentiable objective, we need to provide the gold answer to calculate F1/acc
-                        data.append({"input_ids": encoded_candidates[correct_candidate_id],
-                                     "labels": encoded_candidates[correct_candidate_id],
-                                     "option_len": option_lens[correct_candidate_id], "gold": sample.correct_candidate})
-                    else:
-                        data.append({"input_ids": encoded_candidates[correct_candidate_id],
-                                     "labels": encoded_candidates[correct_candidate_id],
-                                     "option_len": option_lens[correct_candidate_id]})
-                else:
-                    data.append({"input_ids": encoded_candidates[correct_candidate_id],
-                                 "labels": encoded_candidates[correct_candidate_id]})
-            return data
-
-        with count_time("Tokenizing training samples"):
-            train_dataset = HFDataset(_convert(train_samples))
-            eval_dataset = HFDataset(_convert(eval_samples))
+            return convert_samples(self.task, samples, self.encode_samples(samples, generation_with_gold=True), self.args)
+
+        if self.args.train_stream is not None:
+            # The training examples are read, templated and tokenized on the fly (see streaming.py)
+            if self.args.max_steps <= 0:
+                raise ValueError("--train_stream has no length: set --max_steps")
+            if self.args.group_by_length or self.args.max_tokens_per_batch is not None:
+                raise ValueError("--train_stream does not support --group_by_length/--max_tokens_per_batch (they need "
+                                 "the lengths of all the examples)")
+            if self.args.fast_encode and self.fast_tokenizer is None:
+                self.fast_tokenizer = load_fast_tokenizer(self.tokenizer)
+            if self.args.dataloader_num_workers > 0:
+                # The data loader workers are the parallelism (as in pre_encode.encode_split)
+                os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+            train_dataset = StreamingTrainDataset(
+                stream_files(self.args.train_stream), self.task, self.tokenizer, self.args, convert_samples,
+                fast_tokenizer=self.fast_tokenizer, buffer_size=self.args.stream_buffer_size,
+                seed=self.args.seed if self.args.data_seed is None else self.args.data_seed
+            )
+        else:
+            with count_time("Tokenizing training samples"):
+                train_dataset = HFDataset(_convert(train_samples))
+                eval_dataset = HFDataset(_convert(eval_samples))
 
         if self.args.only_train_option and not self.args.non_diff and self.args.trainer != "zo":
             # If --only_train_option and not with a non-differentiable objective, we wrap the forward function
@@ -488,18 +658,26 @@ class Framework:
 
         self.tokenizer.padding_side = "left"
 
+        data_collator = DataCollatorWithPaddingAndNesting(self.tokenizer, pad_to_multiple_of=8) \
+            if self.args.train_as_classification else collator(self.tokenizer, pad_to_multiple_of=8)
+        if self.args.pack_sequences:
+            data_collator = PackingCollator(self.tokenizer, pack_length=self.args.max_length)
+        elif self.args.zo_compile and self.args.trainer == "zo":
+            # A few fixed lengths instead of every multiple of 8, so the compiled forward does not keep recompiling
+            data_collator = LengthBucketCollator(data_collator, [int(b) for b in self.args.compile_length_buckets.split(",")])
+
         trainer = OurTrainer(
             model=self.model,
             args=self.args,
             train_dataset=train_dataset,
             eval_dataset=eval_samples,
             tokenizer=self.tokenizer,
-            data_collator=DataCollatorWithPaddingAndNesting(self.tokenizer,
-                                                            pad_to_multiple_of=8) if self.args.train_as_classification else collator(
-                self.tokenizer, pad_to_multiple_of=8),
+            data_collator=data_collator,
         )
         if self.args.save_on_interrupt:
             trainer.add_callback(SIGUSR1Callback())
+        for callback in callbacks or []:
+            trainer.add_callback(callback)
 
         # Resume training from a last checkpoint
         last_checkpoint = None
@@ -552,16 +730,29 @@ def result_file_tag(args):
 
 def main():
     args = parse_args()
+    if args.hf_token is not None:
+        from huggingface_hub import login
+        login(token=args.hf_token)
 
     set_seed(args.seed)
     # print(args.seed)
     # input()
-    task = get_task(args.task_name)
+    task = get_task(args.task_name, seed=args.seed, columnar=args.columnar_samples)
+    # Initialize trainer and load model
+    framework = Framework(args, task)
+    if args.token_cache_dir is not None:
+        # Samples (and their tokens, see Framework.encode_samples) of a previous run with the same key (which hashes
+        # the tokenizer contents, hence after loading it)
+        token_cache = TokenCache(args.token_cache_dir, args, task, framework.tokenizer)
+        cached_samples = token_cache.load_samples()
+        if cached_samples is not None:
+            task.samples = cached_samples
+        else:
+            token_cache.save_samples(task.samples)
+        framework.token_cache = token_cache
 
     # train_sets = task.sample_train_sets(num_train=args.num_train, num_dev=args.num_dev, num_eval=args.num_eval, num_train_sets=args.num_train_sets, seed=args.train_set_seed)
     train_sets = [task.samples['train']]
-    # Initialize trainer and load model
-    framework = Framework(args, task)
 
     if args.train_set_seed is not None or args.num_train_sets is not None:
         # Eval samples share one (or multiple) training set(s)
@@ -0,0 +1,119 @@
+"""
+Append-only binary run log.
+
+File layout:
+- 8 bytes magic (b"ZORUNLOG") + 8 bytes little-endian header length
+- JSON header: {"version", "columns" (numpy dtype descr), "metadata"}, space padded so records are 64-byte aligned
+- fixed-size records (one numpy structured dtype row each), only ever appended
+
+The log can be read while the run is in progress (a partially written trailing record is ignored) and is loaded
+zero-copy with numpy.memmap, e.g., for plotting:
+
+    log = load_run_log("<output_dir>/loss_acc/SST2_zo_ft_enhanced_None/run_log_seed_0.bin")
+    train = log[np.isnan(log["eval_metric"])]
+    plt.plot(train["step"], train["loss"])
+"""
+import json
+import logging
+import os
+import struct
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+MAGIC = b"ZORUNLOG"
+VERSION = 1
+ALIGNMENT = 64
+
+
+def run_log_dtype(num_directions=0):
+    """
+    Columns of the training run log. Step rows have eval_metric = NaN; eval rows have loss = NaN.
+    """
+    columns = [("step", "<i8"), ("loss", "<f4")]
+    if num_directions > 0:
+        columns.append(("projected_grad", "<f4", (num_directions,)))
+    columns += [("lr", "<f8"), ("eval_metric", "<f4"), ("time", "<f8")]
+    return np.dtype(columns)
+
+
+def _descr_to_dtype(descr):
+    return np.dtype([tuple(c[:2]) + ((tuple(c[2]),) if len(c) > 2 else ()) for c in descr])
+
+
+def _read_header(f):
+    prefix = f.read(16)
+    if len(prefix) < 16 or prefix[:8] != MAGIC:
+        raise ValueError("Not a run log (bad magic)")
+    header_len = struct.unpack("<Q", prefix[8:])[0]
+    header = json.loads(f.read(header_len).decode("utf-8"))
+    return header, 16 + header_len
+
+
+class RunLogWriter:
+    """
+    Append records to a run log. With append=True (e.g., when resuming from a checkpoint) and an existing file
+    with the same columns, new records are appended to it; otherwise the file is (re)created.
+    """
+
+    def __init__(self, path, dtype, metadata=None, append=False):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+        if append and os.path.exists(path) and os.path.getsize(path) > 0:
+            with open(path, "rb") as f:
+                header, offset = _read_header(f)
+            if _descr_to_dtype(header["columns"]) != self.dtype:
+                raise ValueError(f"Run log {path} exists with different columns")
+            # Drop a partially written trailing record
+            size = os.path.getsize(path)
+            valid = offset + (size - offset) // self.dtype.itemsize * self.dtype.itemsize
+            if valid != size:
+                os.truncate(path, valid)
+        else:
+            header = json.dumps({"version": VERSION, "columns": self.dtype.descr, "metadata": metadata or {}})
+            header = header.encode("utf-8")
+            header += b" " * (-(16 + len(header)) % ALIGNMENT)
+            with open(path, "wb") as f:
+                f.write(MAGIC + struct.pack("<Q", len(header)) + header)
+
+        self.file = open(path, "ab", buffering=0)
+
+    def append(self, **columns):
+        """
+        Append len(columns["step"]) records; missing columns are filled with NaN (or 0 for integer columns).
+        """
+        n = len(columns["step"])
+        if n == 0:
+            return
+        records = np.zeros(n, dtype=self.dtype)
+        for name in self.dtype.names:
+            if name in columns:
+                records[name] = np.asarray(columns[name]).reshape(records[name].shape)
+            elif self.dtype[name].base.kind == "f":
+                records[name] = np.nan
+        self.file.write(records.tobytes())
+
+    def close(self):
+        self.file.close()
+
+
+def load_run_log(path):
+    """
+    Memory-map a run log (zero-copy) as a numpy structured array. Safe to call while the run is still writing.
+    """
+    with open(path, "rb") as f:
+        header, offset = _read_header(f)
+    dtype = _descr_to_dtype(header["columns"])
+    n = (os.path.getsize(path) - offset) // dtype.itemsize
+    if n == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=(n,))
+
+
+def load_run_log_metadata(path):
+    with open(path, "rb") as f:
+        return _read_header(f)[0]["metadata"]
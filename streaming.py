@@ -0,0 +1,169 @@
+"""
+Streaming training data (--train_stream): instead of task.samples["train"], the training examples are read from JSONL
+or Arrow shards (rows of the task's HF dataset, as build_sample takes them) and are never materialized: each DataLoader
+worker reads its share of the shards, shuffles the rows with a bounded buffer, and applies the template and the
+tokenization (pre_encode.encode_split) chunk by chunk. Memory depends on the buffer and chunk sizes, not on the
+corpus size. The dataset has no length: training stops at --max_steps, and the shards are read again (reshuffled)
+when they run out before that.
+"""
+import glob
+import inspect
+import json
+import logging
+import random
+
+import pyarrow as pa
+from torch.utils.data import IterableDataset, get_worker_info
+
+from pre_encode import encode_split
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def stream_files(patterns):
+    """
+    Shards matching comma-separated glob patterns
+    """
+    files = sorted(f for pattern in patterns.split(",") for f in glob.glob(pattern.strip()))
+    if len(files) == 0:
+        raise ValueError(f"No training shards match {patterns}")
+    return files
+
+
+def read_rows(path):
+    """
+    Rows (dicts) of a JSONL file (one example per line) or an Arrow file (IPC stream or file format, e.g., the
+    data-*.arrow files of Dataset.save_to_disk), one record batch at a time
+    """
+    if path.endswith(".arrow"):
+        with pa.memory_map(path) as source:
+            try:
+                reader = pa.ipc.open_stream(source)
+                batches = iter(reader)
+            except pa.ArrowInvalid:
+                source.seek(0)
+                reader = pa.ipc.open_file(source)
+                batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+            for batch in batches:
+                yield from batch.to_pylist()
+    else:
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def shuffle_buffer(items, buffer_size, rng):
+    """
+    Approximate shuffle with at most buffer_size items in memory: each incoming item replaces a random one of the
+    buffer, which is yielded
+    """
+    buffer = []
+    for item in items:
+        if len(buffer) < buffer_size:
+            buffer.append(item)
+            continue
+        i = rng.randrange(buffer_size)
+        yield buffer[i]
+        buffer[i] = item
+    rng.shuffle(buffer)
+    yield from buffer
+
+
+def chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class StreamingTrainDataset(IterableDataset):
+    """
+    Training examples (convert_samples outputs) of the rows of the shards
+    Input:
+    - convert: run.convert_samples (samples, encode_prompt outputs -> training examples)
+    - fast_tokenizer: see pre_encode.encode_split
+    - buffer_size: rows in the shuffle buffer of each worker
+    - chunk_size: rows templated and tokenized at once
+    """
+
+    def __init__(self, files, task, tokenizer, args, convert, fast_tokenizer=None, buffer_size=10000, chunk_size=256,
+                 seed=0):
+        self.files = files
+        self.task = task
+        self.tokenizer = tokenizer
+        self.args = args
+        self.convert = convert
+        self.fast_tokenizer = fast_tokenizer
+        self.buffer_size = buffer_size
+        self.chunk_size = chunk_size
+        self.seed = seed
+        self.epoch = 0
+        self.with_index = len(inspect.signature(task.build_sample).parameters) > 1
+
+    def set_epoch(self, epoch):
+        # Called by the training loop before each pass, so that every pass has its own order
+        self.epoch = epoch
+
+    def _rows(self, shard, num_shards, rng):
+        """
+        Rows of this worker: whole files if there are enough of them, every num_shards-th row otherwise
+        """
+        files = list(self.files)
+        rng.shuffle(files)
+        if len(files) >= num_shards:
+            for path in files[shard::num_shards]:
+                yield from enumerate(read_rows(path))
+        else:
+            for path in files:
+                for idx, row in enumerate(read_rows(path)):
+                    if idx % num_shards == shard:
+                        yield idx, row
+
+    def _build(self, rows):
+        samples = []
+        for idx, row in rows:
+            if self.task.keep_example(row):
+                samples.append(self.task.build_sample(row, idx) if self.with_index else self.task.build_sample(row))
+        return samples
+
+    def __iter__(self):
+        info = get_worker_info()
+        shard, num_shards = (0, 1) if info is None else (info.id, info.num_workers)
+        # Same file order in all the workers (they take different files), different buffer draws
+        file_rng = random.Random(self.seed * 100003 + self.epoch)
+        rng = random.Random((self.seed * 100003 + self.epoch) * 1009 + shard)
+        rows = shuffle_buffer(self._rows(shard, num_shards, file_rng), self.buffer_size, rng)
+        fast_tokenizer = None
+        for chunk in chunks(rows, self.chunk_size):
+            samples = self._build(chunk)
+            if fast_tokenizer is None and self.fast_tokenizer is not None:
+                fast_tokenizer = self._check_fast_tokenizer(samples)
+            yield from self._encode(samples, fast_tokenizer)
+
+    def _check_fast_tokenizer(self, samples, num_check=64):
+        """
+        The fast tokenizer if it matches the slow one on the first samples of the stream (see pre_encode.encode_split),
+        False otherwise
+        """
+        if len(samples) == 0:
+            return None
+        if self._encode(samples[:num_check], self.fast_tokenizer) != self._encode(samples[:num_check], None):
+            logger.warning("The fast tokenizer does not match the slow one on the training stream, using the slow one")
+            return False
+        return self.fast_tokenizer
+
+    def _encode(self, samples, fast_tokenizer):
+        if len(samples) == 0:
+            return []
+        encoded = encode_split(
+            self.task, self.task.get_template(), samples, self.tokenizer, max_length=self.args.max_length,
+            fast_tokenizer=fast_tokenizer or None, num_check=0, generation=self.task.generation,
+            generation_with_gold=True, max_new_tokens=self.args.max_new_tokens
+        )
+        return self.convert(self.task, samples, encoded, self.args)
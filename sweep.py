@@ -0,0 +1,152 @@
+"""
+In-process sweep: the model (and tokenizer) is loaded once and the runs are trained back to back, each one starting
+from a snapshot of the trainable parameters, instead of one run.py process and one model load per configuration.
+
+    python sweep.py --sweep_file sweep.json --halving_eta 3 --halving_rungs 500,1500 <run.py arguments>
+
+sweep.json is a list of run.py argument overrides, one per run, e.g.,
+    [{"seed": 0, "learning_rate": 1e-7, "zo_eps": 1e-3}, {"seed": 1, "learning_rate": 1e-6, "zo_eps": 1e-3}]
+The data of each run is sampled with its own seed exactly as run.py does (tasks are cached per seed).
+
+Successive halving (--halving_eta > 1): runs are sequential, so instead of training all the runs up to a rung
+before promoting the best 1/eta of them, a run is stopped at a rung (the first dev eval at or after the rung step)
+if its dev metric is not in the top 1/eta of the runs that reached this rung before it, itself included.
+"""
+import dataclasses
+import json
+import logging
+import math
+import os
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+
+from transformers import HfArgumentParser, TrainerCallback
+
+from run import Framework, OurArguments, set_seed
+from tasks import get_task
+from utils import write_metrics_to_file
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+@dataclass
+class SweepArguments:
+    sweep_file: str = None  # JSON list of argument overrides, one per run
+    halving_eta: int = 0  # successive halving: keep the top 1/eta runs at each rung (0 or 1: no early stopping)
+    halving_rungs: str = "500,1500,4500"  # comma-separated training steps at which runs are compared
+
+
+class SuccessiveHalvingCallback(TrainerCallback):
+    """
+    Stop the run at a rung if its dev metric is not in the top 1/eta of the runs that reached the rung so far.
+    history ({rung: [metric]}) is shared by all the runs of the sweep.
+    """
+
+    def __init__(self, history, rungs, eta, metric_name):
+        self.history = history
+        self.rungs = sorted(rungs)
+        self.eta = eta
+        self.metric_name = metric_name
+        self.evals = []
+        self.stopped_at = None
+        self._next_rung = 0
+
+    def on_evaluate(self, args, state, control, metrics=None, **kwargs):
+        metric = metrics[self.metric_name]
+        self.evals.append((state.global_step, metric))
+        while self._next_rung < len(self.rungs) and state.global_step >= self.rungs[self._next_rung]:
+            rung = self.rungs[self._next_rung]
+            self._next_rung += 1
+            scores = sorted(self.history[rung] + [metric], reverse=True)
+            self.history[rung].append(metric)
+            if metric < scores[math.ceil(len(scores) / self.eta) - 1]:
+                logger.info(f"Successive halving: stopping at step {state.global_step} (rung {rung}), "
+                            f"{self.metric_name} {metric} < {scores[math.ceil(len(scores) / self.eta) - 1]}")
+                self.stopped_at = state.global_step
+                control.should_training_stop = True
+                break
+        return control
+
+
+def snapshot_trainable(model):
+    """
+    Copy the trainable parameters to CPU memory (the frozen ones are never modified by training)
+    """
+    return {n: p.detach().to("cpu", copy=True) for n, p in model.named_parameters() if p.requires_grad}
+
+
+def restore_trainable(model, snapshot):
+    for n, p in model.named_parameters():
+        if n in snapshot:
+            p.data.copy_(snapshot[n])
+
+
+def main():
+    parser = HfArgumentParser((OurArguments, SweepArguments))
+    args, sweep_args = parser.parse_args_into_dataclasses()
+    with open(sweep_args.sweep_file) as f:
+        runs = json.load(f)
+    rungs = [int(r) for r in sweep_args.halving_rungs.split(",")] if sweep_args.halving_eta > 1 else []
+
+    tasks = {}
+
+    def _get_task(seed):
+        # Same sampling as run.py: set the seed, then load the task
+        if seed not in tasks:
+            set_seed(seed)
+            tasks[seed] = get_task(args.task_name, seed=seed, columnar=args.columnar_samples)
+        return tasks[seed]
+
+    load_start = time.time()
+    framework = Framework(args, _get_task(args.seed))
+    load_time = time.time() - load_start
+    model = framework.model
+    snapshot = snapshot_trainable(model)
+    metric_name = getattr(framework.task, "metric_name", "accuracy")
+
+    history = defaultdict(list)
+    results = []
+    for run_id, overrides in enumerate(runs):
+        run_args = dataclasses.replace(args, output_dir=os.path.join(args.output_dir, f"run{run_id}"), **overrides)
+        logger.info(f"===== Sweep run {run_id}/{len(runs)}: {overrides} =====")
+
+        # Reset the model to its initial state
+        restore_trainable(model, snapshot)
+        if hasattr(model, "original_forward"):
+            model.forward = model.original_forward
+        framework.model, framework.args = model, run_args
+        framework.task = _get_task(run_args.seed)
+        set_seed(run_args.seed)
+
+        task = framework.task
+        train_samples, eval_samples = task.samples['train'], task.samples['test']
+        dev_samples = task.samples['valid'] if run_args.num_dev is not None else None
+
+        callbacks = []
+        if rungs:
+            callbacks.append(SuccessiveHalvingCallback(history, rungs, sweep_args.halving_eta, metric_name))
+        start = time.time()
+        framework.train(train_samples, dev_samples if dev_samples is not None else eval_samples, callbacks=callbacks)
+
+        result = {"run": run_id, "overrides": overrides, "train_time": time.time() - start}
+        if callbacks:
+            result["dev_evals"] = callbacks[0].evals
+            result["stopped_at"] = callbacks[0].stopped_at
+        if not run_args.no_eval and result.get("stopped_at") is None:
+            result["metrics"] = framework.evaluate([], eval_samples)
+        logger.info(result)
+        results.append(result)
+
+    summary = {"load_time": load_time, "runs": results}
+    os.makedirs(args.output_dir, exist_ok=True)
+    write_metrics_to_file(summary, os.path.join(args.output_dir, "sweep_results.json"))
+    for result in results:
+        logger.info(f"run {result['run']} {result['overrides']}: "
+                    + (f"stopped at step {result['stopped_at']}" if result.get("stopped_at") is not None
+                       else f"{result.get('metrics')}"))
+
+
+if __name__ == "__main__":
+    main()
@@ -10,13 +10,19 @@ import random
 import datasets
 import sys
 import numpy as np
+import pyarrow as pa
 import logging
+from collections.abc import Mapping, Sequence
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 
-def get_task(task_name):
+def get_task(task_name, seed=0, columnar=False):
+    """
+    seed: seed of the train/valid samples drawn from the full splits
+    columnar: store the splits as SampleStores instead of lists of Samples
+    """
     aa = task_name.split("__")
     if len(aa) == 2:
         task_group, subtask = aa
@@ -24,7 +30,8 @@ def get_task(task_name):
         task_group = aa[0]
         subtask = None
     class_ = getattr(sys.modules[__name__], f"{task_group}Dataset")
-    instance = class_(subtask)
+    instance = class_(subtask, seed=seed)
+    instance.columnar = columnar
     return instance
 
 
@@ -36,10 +43,143 @@ class Sample:
     candidates: List[str] = None
 
 
+class _Constant:
+    """
+    Column with the same value in every row (e.g., the candidates of a classification task)
+    """
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+
+def _column(values):
+    """
+    Compact column of per-row values: a NumPy array for numbers, the value itself when it is the same in every row,
+    an Arrow array otherwise (dictionary-encoded for repetitive strings; a list if Arrow cannot type the values)
+    """
+    if len(values) == 0:
+        return []
+    kinds = {type(v) for v in values}
+    if len(kinds) == 1 and kinds <= {int, float, bool}:
+        return np.asarray(values)
+    if all(v == values[0] for v in values):
+        return _Constant(values[0])
+    try:
+        column = pa.array(values)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+        return list(values)
+    if pa.types.is_string(column.type) and 2 * len(set(values)) <= len(values):
+        # e.g., the SQuAD/DROP passages, shared by several questions: each one is stored once
+        column = column.dictionary_encode()
+    return column
+
+
+def _cell(column, row):
+    if isinstance(column, np.ndarray):
+        return column[row].item()
+    if isinstance(column, _Constant):
+        return list(column.value) if isinstance(column.value, list) else column.value
+    if isinstance(column, pa.Array):
+        return column[row].as_py()
+    return column[row]
+
+
+class SampleStore(Sequence):
+    """
+    Columnar split (--columnar_samples): the fields of the samples, and each key of their data, are stored as one
+    column each (see _column) instead of one Sample object and one data dict per row. Indexing returns SampleViews,
+    which read the columns on access.
+    """
+
+    def __init__(self, samples):
+        """
+        samples: iterable of Samples (e.g., a generator, so that they are not all alive at once)
+        """
+        fields = {"id": [], "correct_candidate": [], "candidates": []}
+        data = []
+        for sample in samples:
+            for name, values in fields.items():
+                values.append(getattr(sample, name))
+            data.append(sample.data)
+        self.data_keys = list(dict.fromkeys(k for d in data for k in d))
+        self.columns = {name: _column(values) for name, values in fields.items()}
+        for key in self.data_keys:
+            self.columns["data", key] = _column([d.get(key) for d in data])
+        self.num_rows = len(data)
+
+    def __len__(self):
+        return self.num_rows
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [SampleView(self, row) for row in range(*index.indices(self.num_rows))]
+        if index < 0:
+            index += self.num_rows
+        if not 0 <= index < self.num_rows:
+            raise IndexError(index)
+        return SampleView(self, index)
+
+
+class SampleView:
+    """
+    Row of a SampleStore, with the attributes of Sample
+    """
+    __slots__ = ("store", "row")
+
+    def __init__(self, store, row):
+        self.store = store
+        self.row = row
+
+    @property
+    def id(self):
+        return _cell(self.store.columns["id"], self.row)
+
+    @property
+    def data(self):
+        return RowData(self.store, self.row)
+
+    @property
+    def correct_candidate(self):
+        return _cell(self.store.columns["correct_candidate"], self.row)
+
+    @property
+    def candidates(self):
+        return _cell(self.store.columns["candidates"], self.row)
+
+    def __repr__(self):
+        return (f"SampleView(id={self.id!r}, data={dict(self.data)!r}, correct_candidate={self.correct_candidate!r}, "
+                f"candidates={self.candidates!r})")
+
+
+class RowData(Mapping):
+    """
+    sample.data of a SampleView
+    """
+    __slots__ = ("store", "row")
+
+    def __init__(self, store, row):
+        self.store = store
+        self.row = row
+
+    def __getitem__(self, key):
+        column = self.store.columns.get(("data", key))
+        if column is None:
+            raise KeyError(key)
+        return _cell(column, self.row)
+
+    def __iter__(self):
+        return iter(self.store.data_keys)
+
+    def __len__(self):
+        return len(self.store.data_keys)
+
+
 class Dataset:
     mixed_set = False
     train_sep = "\n\n"
     generation = False  # whether this is a generation task
+    columnar = False  # whether the splits are SampleStores (set by get_task)
 
     def __init__(self, subtask=None, **kwargs) -> None:
         self.subtask = subtask
@@ -50,6 +190,24 @@ class Dataset:
     def load_dataset():
         raise NotImplementedError
 
+    def defer_load_dataset(self, *args, **kwargs):
+        """
+        Load the dataset (load_dataset(*args, **kwargs)) when the samples are first accessed, e.g., never when they
+        come from the token cache
+        """
+        self._load_args = (args, kwargs)
+
+    @property
+    def samples(self):
+        if "_samples" not in self.__dict__:
+            args, kwargs = self._load_args
+            self.load_dataset(*args, **kwargs)
+        return self._samples
+
+    @samples.setter
+    def samples(self, samples):
+        self._samples = samples
+
     def get_template(self, template_version=0):
         templates = {0: Template}
         return templates[template_version]
@@ -57,6 +215,31 @@ class Dataset:
     def build_sample(self, example):
         return
 
+    def keep_example(self, example):
+        """
+        Whether a row of the dataset can be a sample (e.g., for streamed training rows, see streaming.py)
+        """
+        return True
+
+    def sample_split(self, split, num, rng, keep=None, with_index=False):
+        """
+        Draw num rows (all of them if there are fewer) of an HF split and build the samples of those rows only: the
+        other rows are never read from Arrow
+        Input:
+        - rng: random.Random, seeded by load_dataset
+        - keep: boolean mask of the rows that can be drawn (e.g., the labeled ones)
+        - with_index: pass the row index to build_sample
+        Output: list (SampleStore if self.columnar) of samples, in the drawn order
+        """
+        rows = np.arange(len(split)) if keep is None else np.flatnonzero(keep)
+        indices = [int(rows[i]) for i in rng.sample(range(len(rows)), min(num, len(rows)))]
+        examples = split.select(indices)
+        if with_index:
+            samples = (self.build_sample(example, idx) for example, idx in zip(examples, indices))
+        else:
+            samples = (self.build_sample(example) for example in examples)
+        return SampleStore(samples) if self.columnar else list(samples)
+
     def sample_train_sets(self, num_train=32, num_dev=None, num_eval=None, num_train_sets=None, seed=None):
         if seed is not None:
             # one train/demo set using the designated seed
@@ -109,17 +292,16 @@ class SST2Dataset(Dataset):
     train_sep = "\n\n"
 
     def __init__(self, subtask=None, **kwargs) -> None:
-        self.load_dataset(subtask, **kwargs)
+        self.defer_load_dataset(subtask, **kwargs)
 
-    def load_dataset(self, path, **kwargs):
+    def load_dataset(self, path, seed=0, **kwargs):
         d = load_dataset('glue', 'sst2')
         train_d = d["train"]
         validation_d = d["validation"]
 
-        train_samples = [self.build_sample(example) for example in train_d]
-        valid_samples = [self.build_sample(example) for example in validation_d]
-        train_samples = random.sample(train_samples, 1000)
-        valid_samples = random.sample(valid_samples, 500)
+        rng = random.Random(seed)
+        train_samples = self.sample_split(train_d, 1000, rng)
+        valid_samples = self.sample_split(validation_d, 500, rng)
 
         # train_samples = [self.build_sample(example) for example in train_d][:1000]
         # valid_samples = [self.build_sample(example) for example in validation_d][:100]
@@ -139,17 +321,16 @@ class SST5Dataset(Dataset):
     train_sep = "\n\n"
 
     def __init__(self, subtask=None, **kwargs) -> None:
-        self.load_dataset(subtask, **kwargs)
+        self.defer_load_dataset(subtask, **kwargs)
 
-    def load_dataset(self, path=None, **kwargs):
+    def load_dataset(self, path=None, seed=0, **kwargs):
         d = load_dataset("SetFit/sst5")
         train_d = d["train"]
         validation_d = d["test"]  
 
-        train_samples = [self.build_sample(example) for example in train_d]
-        valid_samples = [self.build_sample(example) for example in validation_d]
-        train_samples = random.sample(train_samples, 1000)
-        valid_samples = random.sample(valid_samples, 500)
+        rng = random.Random(seed)
+        train_samples = self.sample_split(train_d, 1000, rng)
+        valid_samples = self.sample_split(validation_d, 500, rng)
 
         self.samples = {"train": train_samples, "valid": valid_samples, "test": valid_samples}
 
@@ -164,26 +345,25 @@ class SNLIDataset(Dataset):
     train_sep = "\n\n"
 
     def __init__(self, subtask=None, **kwargs) -> None:
-        self.load_dataset(subtask, **kwargs)
+        self.defer_load_dataset(subtask, **kwargs)
 
-    def load_dataset(self, path=None, **kwargs):
+    def load_dataset(self, path=None, seed=0, **kwargs):
         d = load_dataset('snli')  
         train_d = d["train"]
         validation_d = d["validation"]
 
-        
-        train_d = [ex for ex in train_d if ex["label"] != -1]
-        validation_d = [ex for ex in validation_d if ex["label"] != -1]
-
-        train_samples = [self.build_sample(example) for example in train_d]
-        valid_samples = [self.build_sample(example) for example in validation_d]
-
-        train_samples = random.sample(train_samples, 1000)
-        valid_samples = random.sample(valid_samples, 500)
+        # Only the labeled rows (see keep_example)
+        rng = random.Random(seed)
+        train_samples = self.sample_split(train_d, 1000, rng, keep=np.asarray(train_d["label"]) != -1)
+        valid_samples = self.sample_split(validation_d, 500, rng, keep=np.asarray(validation_d["label"]) != -1)
 
         test_samples = valid_samples
         self.samples = {"train": train_samples, "valid": valid_samples, "test": test_samples}
 
+    def keep_example(self, example):
+        # label -1: no gold label
+        return example["label"] != -1
+
     def build_sample(self, example):
         label = int(example["label"])
         id = example.get("pairID") or example.get("idx") or hash(example["premise"] + example["hypothesis"])
@@ -213,18 +393,16 @@ class TRECDataset(Dataset):
     }
 
     def __init__(self, subtask=None, **kwargs) -> None:
-        self.load_dataset(subtask, **kwargs)
+        self.defer_load_dataset(subtask, **kwargs)
 
-    def load_dataset(self, path=None, **kwargs):
+    def load_dataset(self, path=None, seed=0, **kwargs):
         d = load_dataset('trec')
         train_d = d["train"]
         test_d = d["test"]
 
-        train_samples = [self.build_sample(example) for example in train_d]
-        valid_samples = [self.build_sample(example) for example in test_d]  
-
-        train_samples = random.sample(train_samples, 500)
-        valid_samples = random.sample(valid_samples, 250)
+        rng = random.Random(seed)
+        train_samples = self.sample_split(train_d, 500, rng)
+        valid_samples = self.sample_split(test_d, 250, rng)
 
         self.samples = {"train": train_samples, "valid": valid_samples, "test": valid_samples}
 
@@ -247,17 +425,16 @@ class MNLIDataset(Dataset):
     train_sep = "\n\n"
 
     def __init__(self, subtask=None, **kwargs) -> None:
-        self.load_dataset(subtask, **kwargs)
+        self.defer_load_dataset(subtask, **kwargs)
 
-    def load_dataset(self, path=None, **kwargs):
+    def load_dataset(self, path=None, seed=0, **kwargs):
         d = load_dataset('glue', 'mnli')
         train_d = d["train"]
         validation_d = d["validation_matched"] 
 
-        train_samples = [self.build_sample(example) for example in train_d]
-        valid_samples = [self.build_sample(example) for example in validation_d]
-        train_samples = random.sample(train_samples, 1000)
-        valid_samples = random.sample(valid_samples, 500)
+        rng = random.Random(seed)
+        train_samples = self.sample_split(train_d, 1000, rng)
+        valid_samples = self.sample_split(validation_d, 500, rng)
 
         test_samples = valid_samples
         self.samples = {"train": train_samples, "valid": valid_samples, "test": test_samples}
@@ -279,17 +456,15 @@ class CopaDataset(Dataset):
     mixed_set = False
 
     def __init__(self, subtask=None, **kwargs) -> None:
-        self.load_dataset(subtask, **kwargs)
+        self.defer_load_dataset(subtask, **kwargs)
 
-    def load_dataset(self, path, **kwargs):
+    def load_dataset(self, path, seed=0, **kwargs):
         train_examples = load_dataset('super_glue', "copa")["train"]
         valid_examples = load_dataset('super_glue', "copa")["validation"]
 
-        train_samples = [self.build_sample(example) for example in train_examples]
-        valid_samples = [self.build_sample(example) for example in valid_examples]
-
-        train_samples = random.sample(train_samples, min(1000, len(train_samples)))
-        valid_samples = random.sample(valid_samples, min(500, len(valid_samples)))
+        rng = random.Random(seed)
+        train_samples = self.sample_split(train_examples, 1000, rng)
+        valid_samples = self.sample_split(valid_examples, 500, rng)
         test_samples = valid_samples
         self.samples = {"train": train_samples, "valid": valid_samples, "test": test_samples}
 
@@ -311,19 +486,17 @@ class CopaDataset(Dataset):
 
 class BoolQDataset(Dataset):
     def __init__(self, subtask=None, **kwargs) -> None:
-        self.load_dataset(subtask, **kwargs)
+        self.defer_load_dataset(subtask, **kwargs)
 
-    def load_dataset(self, path, **kwargs):
+    def load_dataset(self, path, seed=0, **kwargs):
         d = load_dataset("boolq")
         train_set = d["train"]
         valid_set = d["validation"]
 
 
-        train_samples = [self.build_sample(example) for example in train_set]
-        valid_samples = [self.build_sample(example) for example in valid_set]
-
-        train_samples = random.sample(train_samples, min(1000, len(train_samples)))
-        valid_samples = random.sample(valid_samples, min(500, len(valid_samples)))
+        rng = random.Random(seed)
+        train_samples = self.sample_split(train_set, 1000, rng)
+        valid_samples = self.sample_split(valid_set, 500, rng)
         test_samples = valid_samples
 
         self.samples = {"train": train_samples, "valid": valid_samples, "test":test_samples}
@@ -345,18 +518,16 @@ class BoolQDataset(Dataset):
 class MultiRCDataset(Dataset):
 
     def __init__(self, subtask=None, **kwargs) -> None:
-        self.load_dataset(subtask, **kwargs)
+        self.defer_load_dataset(subtask, **kwargs)
 
-    def load_dataset(self, path, **kwargs):
+    def load_dataset(self, path, seed=0, **kwargs):
         d = load_dataset("super_glue", "multirc")
         train_set = d["train"]
         valid_set = d["validation"]
 
-        train_samples = [self.build_sample(example) for example in train_set]
-        valid_samples = [self.build_sample(example) for example in valid_set]
-
-        train_samples = random.sample(train_samples, min(1000, len(train_samples)))
-        valid_samples = random.sample(valid_samples, min(500, len(valid_samples)))
+        rng = random.Random(seed)
+        train_samples = self.sample_split(train_set, 1000, rng)
+        valid_samples = self.sample_split(valid_set, 500, rng)
         test_samples = valid_samples
         self.samples = {"train": train_samples, "valid": valid_samples, "test": test_samples}
 
@@ -377,18 +548,16 @@ class MultiRCDataset(Dataset):
 class CBDataset(Dataset):
 
     def __init__(self, subtask=None, **kwargs) -> None:
-        self.load_dataset(subtask, **kwargs)
+        self.defer_load_dataset(subtask, **kwargs)
 
-    def load_dataset(self, path, **kwargs):
+    def load_dataset(self, path, seed=0, **kwargs):
         d = load_dataset("super_glue", "cb")
         train_set = d["train"]
         valid_set = d["validation"]
 
-        train_samples = [self.build_sample(example) for example in train_set]
-        valid_samples = [self.build_sample(example) for example in valid_set]
-
-        train_samples = random.sample(train_samples, min(1000, len(train_samples)))
-        valid_samples = random.sample(valid_samples, min(500, len(valid_samples)))
+        rng = random.Random(seed)
+        train_samples = self.sample_split(train_set, 1000, rng)
+        valid_samples = self.sample_split(valid_set, 500, rng)
         test_samples = valid_samples
 
         self.samples = {"train": train_samples, "valid": valid_samples, "test": test_samples}
@@ -410,18 +579,16 @@ class CBDataset(Dataset):
 class WICDataset(Dataset):
 
     def __init__(self, subtask=None, **kwargs) -> None:
-        self.load_dataset(subtask, **kwargs)
+        self.defer_load_dataset(subtask, **kwargs)
 
-    def load_dataset(self, path, **kwargs):
+    def load_dataset(self, path, seed=0, **kwargs):
         d = load_dataset("super_glue", "wic")
         train_set = d["train"]
         valid_set = d["validation"]
 
-        train_samples = [self.build_sample(example) for example in train_set]
-        valid_samples = [self.build_sample(example) for example in valid_set]
-
-        train_samples = random.sample(train_samples, min(1000, len(train_samples)))
-        valid_samples = random.sample(valid_samples, min(500, len(valid_samples)))
+        rng = random.Random(seed)
+        train_samples = self.sample_split(train_set, 1000, rng)
+        valid_samples = self.sample_split(valid_set, 500, rng)
         test_samples = valid_samples
 
         self.samples = {"train": train_samples, "valid": valid_samples, "test": test_samples}
@@ -443,18 +610,16 @@ class WICDataset(Dataset):
 class WSCDataset(Dataset):
 
     def __init__(self, subtask=None, **kwargs) -> None:
-        self.load_dataset(subtask, **kwargs)
+        self.defer_load_dataset(subtask, **kwargs)
 
-    def load_dataset(self, path, **kwargs):
+    def load_dataset(self, path, seed=0, **kwargs):
         d = load_dataset("super_glue", "wsc.fixed")
         train_set = d["train"]
         valid_set = d["validation"]
 
-        train_samples = [self.build_sample(example) for example in train_set]
-        valid_samples = [self.build_sample(example) for example in valid_set]
-
-        train_samples = random.sample(train_samples, min(1000, len(train_samples)))
-        valid_samples = random.sample(valid_samples, min(500, len(valid_samples)))
+        rng = random.Random(seed)
+        train_samples = self.sample_split(train_set, 1000, rng)
+        valid_samples = self.sample_split(valid_set, 500, rng)
         test_samples = valid_samples
         self.samples = {"train": train_samples, "valid": valid_samples, "test": test_samples}
 
@@ -475,18 +640,16 @@ class WSCDataset(Dataset):
 class ReCoRDDataset(Dataset):
 
     def __init__(self, subtask=None, **kwargs) -> None:
-        self.load_dataset(subtask, **kwargs)
+        self.defer_load_dataset(subtask, **kwargs)
 
-    def load_dataset(self, path, **kwargs):
+    def load_dataset(self, path, seed=0, **kwargs):
         d = load_dataset("super_glue", "record")
         train_set = d["train"]
         valid_set = d["validation"]
 
-        train_samples = [self.build_sample(example) for example in train_set]
-        valid_samples = [self.build_sample(example) for example in valid_set]
-
-        train_samples = random.sample(train_samples, min(1000, len(train_samples)))
-        valid_samples = random.sample(valid_samples, min(500, len(valid_samples)))
+        rng = random.Random(seed)
+        train_samples = self.sample_split(train_set, 1000, rng)
+        valid_samples = self.sample_split(valid_set, 500, rng)
         test_samples = valid_samples
 
         self.samples = {"train": train_samples, "valid": valid_samples, "test":test_samples}
@@ -508,18 +671,17 @@ class ReCoRDDataset(Dataset):
 class RTEDataset(Dataset):
 
     def __init__(self, subtask=None, **kwargs) -> None:
-        self.load_dataset(subtask, **kwargs)
+        self.defer_load_dataset(subtask, **kwargs)
 
-    def load_dataset(self, path, **kwargs):
+    def load_dataset(self, path, seed=0, **kwargs):
         d = load_dataset("super_glue", "rte")
         train_set = d["train"]
         valid_set = d["validation"]
 
 
-        train_samples = [self.build_sample(example) for example in train_set]
-        valid_samples = [self.build_sample(example) for example in valid_set]
-        train_samples = random.sample(train_samples, 1000)
-        valid_samples = random.sample(valid_samples, min(500, len(valid_samples)))
+        rng = random.Random(seed)
+        train_samples = self.sample_split(train_set, 1000, rng)
+        valid_samples = self.sample_split(valid_set, 500, rng)
 
         test_set = valid_set
         self.samples = {"train": train_samples, "valid": valid_samples, "test": test_set}
@@ -543,18 +705,16 @@ class SQuADDataset(Dataset):
     generation = True
 
     def __init__(self, subtask=None, **kwargs) -> None:
-        self.load_dataset()
+        self.defer_load_dataset(**kwargs)
 
-    def load_dataset(self):
+    def load_dataset(self, seed=0, **kwargs):
         dataset = load_dataset("squad")
         train_examples = dataset["train"]
         valid_examples = dataset["validation"]
 
-        train_samples = [self.build_sample(example, idx) for idx, example in enumerate(train_examples)]
-        valid_samples = [self.build_sample(example, idx) for idx, example in enumerate(valid_examples)]
-
-        train_samples = random.sample(train_samples, min(1000, len(train_samples)))
-        valid_samples = random.sample(valid_samples, min(500, len(valid_samples)))
+        rng = random.Random(seed)
+        train_samples = self.sample_split(train_examples, 1000, rng, with_index=True)
+        valid_samples = self.sample_split(valid_examples, 500, rng, with_index=True)
         test_samples = valid_samples
 
         self.samples = {"train": train_samples, "valid": valid_samples, "test": test_samples}
@@ -584,18 +744,16 @@ class DROPDataset(Dataset):
     generation = True
 
     def __init__(self, subtask=None, **kwargs) -> None:
-        self.load_dataset()
+        self.defer_load_dataset(**kwargs)
 
-    def load_dataset(self):
+    def load_dataset(self, seed=0, **kwargs):
         dataset = load_dataset("drop")
         train_examples = dataset["train"]
         valid_examples = dataset["validation"]
 
-        train_samples = [self.build_sample(example, idx) for idx, example in enumerate(train_examples)]
-        valid_samples = [self.build_sample(example, idx) for idx, example in enumerate(valid_examples)]
-
-        train_samples = random.sample(train_samples, min(1000, len(train_samples)))
-        valid_samples = random.sample(valid_samples, min(500, len(valid_samples)))
+        rng = random.Random(seed)
+        train_samples = self.sample_split(train_examples, 1000, rng, with_index=True)
+        valid_samples = self.sample_split(valid_examples, 500, rng, with_index=True)
         test_samples = valid_samples
 
         self.samples = {"train": train_samples, "valid": valid_samples, "test": test_samples}
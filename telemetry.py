@@ -0,0 +1,219 @@
+"""
+Non-blocking telemetry: metrics are put on a bounded in-memory queue and written to the slow sinks (wandb, logger) by a
+background thread, so that they (e.g., wandb on a shared cluster) never stall training. The local sinks (run log,
+JSONL) are cheap appends and are written synchronously by emit(): they are the authoritative history and never lose a
+record when the queue is full.
+
+Records are (kind, payload) pairs:
+- "train": dict of numpy arrays flushed from the DeviceRingBuffer ("step", "loss", "projected_grad", "lr", "time")
+- "eval": {"step", "metric_name", "metric", "time"}
+- "log": dict that is printed by the logger sink
+"""
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+DROP_POLICIES = ("drop_oldest", "drop_newest", "block")
+
+
+def _to_builtin(x):
+    if isinstance(x, np.ndarray):
+        return x.tolist()
+    if isinstance(x, np.generic):
+        return x.item()
+    return x
+
+
+class Sink:
+    """
+    Base class of the telemetry sinks. write() is only called from the writer thread, or from the thread that calls
+    Telemetry.emit() for synchronous sinks (local appends that must not be dropped).
+    """
+    synchronous = False
+
+    def write(self, kind, payload):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class JSONLSink(Sink):
+    """
+    One JSON line per step (train records are split into rows) or per eval/log record. Always available offline.
+    """
+    synchronous = True
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.file = open(path, "a")
+
+    def write(self, kind, payload):
+        if kind == "train":
+            names = [k for k in payload if k != "step"]
+            for i, step in enumerate(payload["step"]):
+                row = {"kind": kind, "step": int(step)}
+                row.update({k: _to_builtin(payload[k][i]) for k in names})
+                self.file.write(json.dumps(row) + "\n")
+        else:
+            self.file.write(json.dumps({"kind": kind, **{k: _to_builtin(v) for k, v in payload.items()}}) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class RunLogSink(Sink):
+    """
+    Append train/eval records to a run_log.RunLogWriter
+    """
+    synchronous = True
+
+    def __init__(self, run_log):
+        self.run_log = run_log
+
+    def write(self, kind, payload):
+        if kind == "train":
+            self.run_log.append(**payload)
+        elif kind == "eval":
+            self.run_log.append(step=[payload["step"]], eval_metric=[payload["metric"]], time=[payload["time"]])
+
+    def close(self):
+        self.run_log.close()
+
+
+class WandbSink(Sink):
+    """
+    Log eval results to wandb. Only enabled if wandb is installed and a run has been initialized.
+    """
+
+    def __init__(self):
+        try:
+            import wandb
+        except ImportError:
+            wandb = None
+        self.wandb = wandb if wandb is not None and wandb.run is not None else None
+
+    @property
+    def enabled(self):
+        return self.wandb is not None
+
+    def write(self, kind, payload):
+        if kind == "eval":
+            self.wandb.log({"Eval accuracy": payload["metric"], "global_step": payload["step"]})
+
+
+class LoggerSink(Sink):
+    def write(self, kind, payload):
+        if kind == "log":
+            logger.info(payload)
+
+
+class Telemetry:
+    """
+    Bounded queue + background writer thread in front of the asynchronous sinks; the synchronous ones are written
+    directly.
+    Input:
+    - sinks: list of Sink
+    - max_queue: maximum number of pending records
+    - policy: what emit() does when the queue is full (only the asynchronous sinks miss the dropped records):
+      "drop_oldest" (default) discards the oldest pending record, "drop_newest" discards the new record,
+      "block" waits for the writer (only for debugging, as it can stall training)
+    """
+
+    def __init__(self, sinks, max_queue=1024, policy="drop_oldest"):
+        assert policy in DROP_POLICIES, f"Unknown telemetry drop policy {policy}"
+        self.sinks = [sink for sink in sinks if not sink.synchronous]
+        self.synchronous_sinks = [sink for sink in sinks if sink.synchronous]
+        self.policy = policy
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.num_dropped = 0
+        self.num_errors = 0
+        self._stop = object()
+        self.thread = threading.Thread(target=self._run, name="telemetry", daemon=True)
+        self.thread.start()
+
+    def emit(self, kind, payload):
+        """
+        Write a record to the synchronous sinks and queue it for the others without blocking (unless policy is
+        "block"). Payloads must not be modified afterwards.
+        """
+        for sink in self.synchronous_sinks:
+            self._write(sink, kind, payload)
+        if len(self.sinks) == 0:
+            return
+        if self.policy == "block":
+            self.queue.put((kind, payload))
+            return
+        try:
+            self.queue.put_nowait((kind, payload))
+        except queue.Full:
+            self.num_dropped += 1
+            if self.policy == "drop_oldest":
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    pass
+                try:
+                    self.queue.put_nowait((kind, payload))
+                except queue.Full:
+                    pass
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is self._stop:
+                break
+            kind, payload = item
+            for sink in self.sinks:
+                self._write(sink, kind, payload)
+
+    def _write(self, sink, kind, payload):
+        try:
+            sink.write(kind, payload)
+        except Exception as e:
+            self.num_errors += 1
+            logger.warning(f"Telemetry sink {type(sink).__name__} failed: {e}")
+
+    def close(self, timeout=60):
+        """
+        Write the pending records and close the sinks
+        """
+        start = time.time()
+        try:
+            self.queue.put(self._stop, timeout=timeout)
+        except queue.Full:
+            # The writer is stalled on a sink: drop the oldest pending records to make room for the stop marker
+            while True:
+                try:
+                    self.queue.get_nowait()
+                    self.num_dropped += 1
+                except queue.Empty:
+                    pass
+                try:
+                    self.queue.put_nowait(self._stop)
+                    break
+                except queue.Full:
+                    pass
+        self.thread.join(max(timeout - (time.time() - start), 0))
+        sinks = self.synchronous_sinks
+        if self.thread.is_alive():
+            # The asynchronous sinks are still in use by the (daemon) writer thread, leave them open
+            logger.warning(f"Telemetry writer did not finish within {time.time() - start:.0f}s")
+        else:
+            sinks = sinks + self.sinks
+        for sink in sinks:
+            try:
+                sink.close()
+            except Exception as e:
+                logger.warning(f"Telemetry sink {type(sink).__name__} failed to close: {e}")
+        if self.num_dropped > 0:
+            logger.warning(f"Telemetry dropped {self.num_dropped} records (queue full)")
@@ -0,0 +1,164 @@
+"""
+Token-budget batching (--max_tokens_per_batch): batches are sized by their padded number of tokens (rows x longest
+sequence) instead of a fixed number of examples, so short examples are batched many at a time and long ones a few at a
+time, within the same memory.
+
+- Training: TokenBudgetBatchSampler groups the examples drawn by the usual sampler (random or --group_by_length).
+  The options of a classification example are its rows, and they always stay in one batch.
+  OurTrainer scales the ZO projected gradients by #examples / per_device_train_batch_size (_zo_loss_weight), so that
+  every example has the same weight in the ZO gradient estimate as with fixed-size batches (the logged loss is not
+  scaled).
+- Evaluation: predict_candidates scores all the candidates of all the eval samples (classification/multiple-choice)
+  in length-sorted, left-padded batches, instead of one forward per candidate (or, with --icl_prefix_cache, as
+  continuations of the shared demonstrations, see icl_prefix.py).
+"""
+import logging
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+from utils import Prediction, encode_prompt, pad_sequences, sequence_key, token_log_probs
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def token_budget_batches(order, lengths, max_tokens, rows=None):
+    """
+    Group indices (in the given order) into batches whose padded size (number of rows x longest length) is at most
+    max_tokens; an index longer than the budget gets a batch of its own.
+    Input:
+    - lengths: length of each index
+    - rows: number of rows (e.g., options) of each index, 1 by default
+    """
+    batch, longest, num_rows = [], 0, 0
+    for i in order:
+        new_longest = max(longest, lengths[i])
+        new_rows = num_rows + (1 if rows is None else rows[i])
+        if batch and new_longest * new_rows > max_tokens:
+            yield batch
+            batch, new_longest, new_rows = [], lengths[i], (1 if rows is None else rows[i])
+        batch.append(i)
+        longest, num_rows = new_longest, new_rows
+    if batch:
+        yield batch
+
+
+class TokenBudgetBatchSampler(Sampler):
+    """
+    Batch sampler over the examples drawn by `sampler`, with at most max_tokens padded tokens per batch
+    """
+
+    def __init__(self, sampler, lengths, max_tokens, rows=None):
+        self.sampler = sampler
+        self.lengths = lengths
+        self.max_tokens = max_tokens
+        self.rows = rows
+
+    def __iter__(self):
+        return token_budget_batches(iter(self.sampler), self.lengths, self.max_tokens, rows=self.rows)
+
+    def __len__(self):
+        # Count the batches of the next pass without consuming the sampler's randomness (exact when the sampler
+        # has its own generator, as with a data_seed/seeded sampler)
+        generator = getattr(self.sampler, "generator", None)
+        state = generator.get_state() if generator is not None else None
+        num_batches = sum(1 for _ in iter(self))
+        if state is not None:
+            generator.set_state(state)
+        return num_batches
+
+
+@torch.inference_mode()
+def score_options(model, sequences, option_lens, max_tokens, pad_token_id):
+    """
+    Log-probabilities of the last option_lens[i] tokens of each sequence (what Framework.forward returns for one
+    sequence), with length-sorted, left-padded batches of at most max_tokens padded tokens.
+    Output: list of CPU tensors, in the order of sequences
+    """
+    model.eval()
+    device = model.device
+    lengths = [len(s) for s in sequences]
+    order = sorted(range(len(sequences)), key=lambda i: lengths[i])
+    results = [None] * len(sequences)
+    for batch in token_budget_batches(order, lengths, max_tokens):
+        length = max(lengths[i] for i in batch)
+        padded, mask = pad_sequences([sequences[i] for i in batch], pad_token_id, length, padding_side="left")
+        input_ids = torch.from_numpy(padded).to(device)
+        # Left padding right-aligns the sequences: the options are in the last k positions
+        k = max(option_lens[i] for i in batch)
+        selected = token_log_probs(model, input_ids, torch.from_numpy(mask.astype(np.int64)).to(device), last=k).cpu()
+        for row, i in enumerate(batch):
+            results[i] = selected[row, k - option_lens[i]:]
+    return results
+
+
+def predict_candidates(model, tokenizer, task, args, train_sets, eval_samples, encode=None):
+    """
+    Token-budget batched one_step_pred for classification/multiple-choice tasks.
+    Input:
+    - train_sets: demonstrations of each eval sample (lists of train samples, possibly all the same)
+    - encode: encode_prompt(train_samples, eval_sample, **kwargs) of the task, tokenizer and arguments (e.g.,
+      Framework.encode_prompt); utils.encode_prompt by default
+    Output: predictions, and the option log-probabilities of each candidate of each eval sample
+    """
+    calibrate = args.sfc or args.icl_sfc
+    if encode is None:
+        template = task.get_template()
+
+        def encode(train_samples, eval_sample, **kwargs):
+            return encode_prompt(task, template, train_samples, eval_sample, tokenizer, max_length=args.max_length,
+                                 generation=task.generation, max_new_tokens=args.max_new_tokens, **kwargs)
+
+    sequences, option_lens, requests = [], [], []
+    calibration = {}  # sequence_key -> index in sequences
+    for train_samples, eval_sample in zip(train_sets, eval_samples):
+        encoded_candidates, candidate_option_lens = encode(train_samples, eval_sample)
+        first = len(sequences)
+        sequences.extend(encoded_candidates)
+        option_lens.extend(candidate_option_lens)
+        sfc_indices = None
+        if calibrate:
+            sfc_encoded_candidates, sfc_option_lens = encode(train_samples, eval_sample, sfc=args.sfc,
+                                                             icl_sfc=args.icl_sfc)
+            # Calibration prompts that do not depend on the eval sample (or only on its demonstrations) are scored once
+            sfc_indices = []
+            for sequence, option_len in zip(sfc_encoded_candidates, sfc_option_lens):
+                key = sequence_key(sequence, option_len)
+                if key not in calibration:
+                    calibration[key] = len(sequences)
+                    sequences.append(sequence)
+                    option_lens.append(option_len)
+                sfc_indices.append(calibration[key])
+        requests.append((first, sfc_indices, len(encoded_candidates)))
+
+    if getattr(args, "icl_prefix_cache", False):
+        # The demonstrations shared by all the prompts are run once (see icl_prefix.py)
+        from icl_prefix import score_options_with_prefix, shared_prefix_length
+        prefix_len = shared_prefix_length([sequences[first + c] for first, _, num_candidates in requests
+                                           for c in range(num_candidates)],
+                                          [option_lens[first + c] for first, _, num_candidates in requests
+                                           for c in range(num_candidates)])
+        log_probs = score_options_with_prefix(model, sequences, option_lens, prefix_len, args.per_device_eval_batch_size,
+                                              tokenizer.pad_token_id, max_tokens=args.max_tokens_per_batch)
+    else:
+        log_probs = score_options(model, sequences, option_lens, args.max_tokens_per_batch, tokenizer.pad_token_id)
+
+    predictions, candidate_log_probs = [], []
+    for eval_sample, (first, sfc_indices, num_candidates) in zip(eval_samples, requests):
+        candidates = range(num_candidates)
+        if calibrate:
+            # Calibrated probabilities (surface form competition), as in one_step_pred
+            scores = [log_probs[first + c].sum().item() - log_probs[sfc_indices[c]].sum().item()
+                      for c in candidates]
+        else:
+            scores = [log_probs[first + c].mean().item() for c in candidates]
+
+        if isinstance(eval_sample.correct_candidate, list):
+            correct_candidate_id = [eval_sample.candidates.index(c) for c in eval_sample.correct_candidate]
+        else:
+            correct_candidate_id = eval_sample.candidates.index(eval_sample.correct_candidate)
+        predictions.append(Prediction(correct_candidate=correct_candidate_id, predicted_candidate=int(np.argmax(scores))))
+        candidate_log_probs.append([log_probs[first + c] for c in candidates])
+    return predictions, candidate_log_probs
@@ -0,0 +1,164 @@
+"""
+Persistent token cache (--token_cache_dir): the samples of a task (after the seeded subsampling of tasks.py) and their
+encode_prompt outputs are stored on disk under a key that hashes everything they depend on (task/subtask, source of
+the task loader and template classes, tokenizer contents, max_length, max_new_tokens, sampling seed, sample
+representation). Later runs with the same key (e.g., sweeps over learning rates) skip loading the dataset, building
+the samples and tokenizing them: the tokens are memory-mapped and the training examples are zero-copy views into them.
+
+Layout of <token_cache_dir>/<key>/:
+- key.json: the hashed fields
+- samples.pkl: task.samples (all the splits)
+- <split>.<variant>.tokens.npy: token ids of all the candidates of the split, concatenated (int32)
+- <split>.<variant>.candidates.npy: offset of each candidate in tokens (+ the end)
+- <split>.<variant>.samples.npy: offset of the first candidate of each sample (+ the end)
+- <split>.<variant>.option_lens.npy: option length of each candidate
+where variant is "gold" (generation tasks, with the gold answers as in Framework.train) or "prompt" (everything else).
+"""
+import hashlib
+import inspect
+import json
+import logging
+import os
+import pickle
+import tempfile
+
+import numpy as np
+import transformers
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+FORMAT_VERSION = 2
+ARRAYS = ["tokens", "candidates", "samples", "option_lens"]  # option_lens is written last and marks a complete entry
+
+
+def _atomic_write(path, write):
+    """
+    Write a file through a temporary file in the same directory, so that concurrent runs never see a partial file
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def source_digest(cls):
+    """
+    Digest of the source of a class and of its bases (other than object), e.g., a task loader or a template
+    """
+    digest = hashlib.sha256()
+    for klass in cls.__mro__[:-1]:
+        try:
+            source = inspect.getsource(klass)
+        except (OSError, TypeError):
+            source = f"{klass.__module__}.{klass.__qualname__}"
+        digest.update(source.encode())
+    return digest.hexdigest()
+
+
+def tokenizer_digest(tokenizer):
+    """
+    Digest of the tokenizer contents: class, init arguments (files by content), special tokens, vocabulary (with the
+    added tokens), BPE merges or SentencePiece model. Not its path, which may hold a different tokenizer later.
+    """
+    digest = hashlib.sha256(type(tokenizer).__name__.encode())
+    for key, value in sorted(tokenizer.init_kwargs.items()):
+        if key == "name_or_path":
+            continue
+        if isinstance(value, str) and os.path.isfile(value):
+            with open(value, "rb") as f:
+                value = hashlib.sha256(f.read()).hexdigest()
+        digest.update(f"{key}={value}\n".encode())
+    special = {name: getattr(tokenizer, f"{name}_id") for name in tokenizer.SPECIAL_TOKENS_ATTRIBUTES
+               if name != "additional_special_tokens"}
+    digest.update(json.dumps(special, sort_keys=True, default=str).encode())
+    # The loaded vocabulary itself (the file paths are not in init_kwargs when the tokenizer is built directly)
+    digest.update(json.dumps(sorted(tokenizer.get_vocab().items())).encode())
+    if hasattr(tokenizer, "bpe_ranks"):
+        digest.update(json.dumps(sorted((list(k), v) for k, v in tokenizer.bpe_ranks.items())).encode())
+    if hasattr(tokenizer, "sp_model"):
+        digest.update(tokenizer.sp_model.serialized_model_proto())
+    return digest.hexdigest()
+
+
+class TokenCache:
+    """
+    Cache entry of one (task, template, tokenizer, max_length, max_new_tokens, seed)
+    """
+
+    def __init__(self, cache_dir, args, task, tokenizer):
+        template = type(task.get_template())
+        self.fields = {
+            "version": FORMAT_VERSION,
+            "task": args.task_name,
+            "task_loader": source_digest(type(task)),
+            "template": f"{template.__module__}.{template.__qualname__}",
+            "template_source": source_digest(template),
+            "tokenizer": tokenizer_digest(tokenizer),
+            "transformers": transformers.__version__,
+            "max_length": args.max_length,
+            "max_new_tokens": args.max_new_tokens,
+            "seed": args.seed,
+            # task.samples is pickled as lists of Samples or as SampleStores (--columnar_samples)
+            "columnar": getattr(args, "columnar_samples", False),
+        }
+        self.key = hashlib.sha256(json.dumps(self.fields, sort_keys=True).encode()).hexdigest()[:16]
+        self.path = os.path.join(cache_dir, self.key)
+        self.samples = None
+
+    def load_samples(self):
+        """
+        Output: the cached task.samples, or None
+        """
+        path = os.path.join(self.path, "samples.pkl")
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            self.samples = pickle.load(f)
+        logger.info(f"Loaded the samples from the token cache {self.path}")
+        return self.samples
+
+    def save_samples(self, samples):
+        self.samples = samples
+        os.makedirs(self.path, exist_ok=True)
+        _atomic_write(os.path.join(self.path, "key.json"), lambda f: f.write(json.dumps(self.fields, indent=4).encode()))
+        _atomic_write(os.path.join(self.path, "samples.pkl"), lambda f: pickle.dump(samples, f, pickle.HIGHEST_PROTOCOL))
+
+    def _prefix(self, samples, variant):
+        # Splits are recognized by identity: they are the lists of self.samples
+        for split, split_samples in (self.samples or {}).items():
+            if split_samples is samples:
+                return os.path.join(self.path, f"{split}.{variant}")
+        return None
+
+    def get(self, samples, variant):
+        """
+        Output: encode_prompt outputs (encodings, option_lens) of each sample, with the encodings as read-only views
+        of the memory-mapped tokens; None if they are not cached
+        """
+        prefix = self._prefix(samples, variant)
+        if prefix is None or not os.path.exists(f"{prefix}.option_lens.npy"):
+            return None
+        tokens, candidates, sample_offsets, option_lens = [np.load(f"{prefix}.{name}.npy", mmap_mode="r")
+                                                           for name in ARRAYS]
+        candidates, sample_offsets, option_lens = candidates.tolist(), sample_offsets.tolist(), option_lens.tolist()
+        return [([tokens[candidates[c]:candidates[c + 1]] for c in range(sample_offsets[i], sample_offsets[i + 1])],
+                 option_lens[sample_offsets[i]:sample_offsets[i + 1]]) for i in range(len(samples))]
+
+    def put(self, samples, variant, encoded):
+        prefix = self._prefix(samples, variant)
+        if prefix is None:
+            return
+        encodings = [e for sample_encodings, _ in encoded for e in sample_encodings]
+        arrays = {
+            "tokens": np.fromiter((t for e in encodings for t in e), dtype=np.int32),
+            "candidates": np.cumsum([0] + [len(e) for e in encodings], dtype=np.int64),
+            "samples": np.cumsum([0] + [len(e) for e, _ in encoded], dtype=np.int64),
+            "option_lens": np.array([l for _, lens in encoded for l in lens], dtype=np.int32),
+        }
+        for name in ARRAYS:
+            _atomic_write(f"{prefix}.{name}.npy", lambda f: np.save(f, arrays[name]))
@@ -23,7 +23,6 @@ import inspect
 import math
 import os
 import random
-import wandb
 import re
 import shutil
 import sys
@@ -40,7 +39,6 @@ from lr_scheduler import zo_lr_scheduler
 
 from tqdm.auto import tqdm
 from transformers import Trainer
-from sklearn.linear_model import LinearRegression, LogisticRegression, LogisticRegressionCV
 from collections import deque
 
 # Integrations must be imported before ML frameworks:
@@ -64,11 +62,10 @@ import torch
 import torch.distributed as dist
 from packaging import version
 from torch import nn
-from torch.utils.data import DataLoader, Dataset, RandomSampler, SequentialSampler
+from torch.utils.data import DataLoader, Dataset, IterableDataset, RandomSampler, SequentialSampler
 from torch.utils.data.distributed import DistributedSampler
 from torch.amp import autocast
 
-from huggingface_hub import Repository
 
 from transformers import __version__
 from transformers.configuration_utils import PretrainedConfig
@@ -158,8 +155,6 @@ from transformers.utils import (
     logging,
 )
 from transformers.utils.generic import ContextManagers
-from scipy.special import loggamma
-from Hessian_smooth_scheduler import Hessian_smooth_scheduler
 
 from transformers.modeling_outputs import CausalLMOutputWithPast
 from torch.nn import CrossEntropyLoss
@@ -175,11 +170,7 @@ if is_in_notebook():
 
     DEFAULT_PROGRESS_CALLBACK = NotebookProgressCallback
 
-if is_apex_available():
-    from apex import amp
-
-if is_datasets_available():
-    import datasets
+# apex, fairscale, sklearn, ... are only imported by the code paths that use them (see importtime_budget.py)
 import torch.optim as optim
 
 if is_torch_tpu_available(check_device=False):
@@ -187,15 +178,10 @@ if is_torch_tpu_available(check_device=False):
     import torch_xla.debug.metrics as met
     import torch_xla.distributed.parallel_loader as pl
 
-if is_fairscale_available():
-    dep_version_check("fairscale")
-    import fairscale
-    from fairscale.nn.data_parallel import FullyShardedDataParallel as FullyShardedDDP
-    from fairscale.nn.data_parallel import ShardedDataParallel as ShardedDDP
-    from fairscale.nn.wrap import auto_wrap
-    from fairscale.optim import OSS
-    from fairscale.optim.grad_scaler import ShardedGradScaler
-from utils import encode_prompt, Prediction
+from utils import encode_prompt, option_len_loss, packed_lm_loss, Prediction, ScoreCache, token_log_probs
+from batch_generation import eos_token_ids, greedy_generate, plain_greedy, predict_generations
+from token_budget import TokenBudgetBatchSampler, predict_candidates
+from prefetch import DevicePrefetcher
 
 if is_sagemaker_mp_enabled():
     import smdistributed.modelparallel.torch as smp
@@ -210,8 +196,6 @@ else:
 if TYPE_CHECKING:
     import optuna
 
-from torch.profiler import profile, ProfilerActivity, tensorboard_trace_handler
-
 logger = logging.get_logger(__name__)
 
 # Name of the files used for checkpointing
@@ -225,7 +209,10 @@ from tasks import get_task
 import torch.nn.functional as F
 from metrics import calculate_metric
 from collections import defaultdict
-from torchprofile import profile_macs
+from memory_tracker import PhaseMemoryTracker
+from metric_buffer import DeviceRingBuffer, accumulate_finite
+from run_log import RunLogWriter, run_log_dtype
+from telemetry import JSONLSink, LoggerSink, RunLogSink, Telemetry, WandbSink
 
 
 # DiZO added
@@ -343,49 +330,8 @@ class DiZO(nn.Module):
             return outputs
         logits = outputs.logits
 
-        # Shift so that tokens < n predict n
-        shift_logits = logits[..., :-1, :].contiguous()
-        # Here we use input_ids (which should always = labels) bc sometimes labels are correct candidate IDs
-        shift_labels = torch.clone(input_ids)[..., 1:].contiguous()
-        shift_labels[shift_labels == self.config.pad_token_id] = -100
-
-        # Apply option len (do not calculate loss on the non-option part)
-        if option_len is not None:
-            for _i, _len in enumerate(option_len):
-                shift_labels[_i, :-_len] = -100
-
-        # Calculate the loss
-        loss_fct = CrossEntropyLoss(ignore_index=-100)
-        if num_options is not None:
-            # Train as a classification tasks
-            log_probs = F.log_softmax(shift_logits, dim=-1)
-            mask = shift_labels != -100  # Option part
-            shift_labels[~mask] = 0  # So that it doesn't mess up with indexing
-
-            selected_log_probs = torch.gather(log_probs, dim=-1, index=shift_labels.unsqueeze(-1)).squeeze(
-                -1)  # (bsz x num_options, len)
-            selected_log_probs = (selected_log_probs * mask).sum(-1) / mask.sum(-1)  # (bsz x num_options)
-
-            if any([x != num_options[0] for x in num_options]):
-                # Multi choice tasks with different number of options
-                loss = 0
-                start_id = 0
-                count = 0
-                while start_id < len(num_options):
-                    end_id = start_id + num_options[start_id]
-                    _logits = selected_log_probs[start_id:end_id].unsqueeze(0)  # (1, num_options)
-                    _labels = labels[start_id:end_id][0].unsqueeze(0)  # (1)
-                    loss = loss_fct(_logits, _labels) + loss
-                    count += 1
-                    start_id = end_id
-                loss = loss / count
-            else:
-                num_options = num_options[0]
-                selected_log_probs = selected_log_probs.view(-1, num_options)  # (bsz, num_options)
-                labels = labels.view(-1, num_options)[:, 0]  # Labels repeat so we only take the first one
-                loss = loss_fct(selected_log_probs, labels)
-        else:
-            loss = loss_fct(shift_logits.view(-1, self.config.vocab_size), shift_labels.view(-1))
+        loss = option_len_loss(logits, input_ids, labels, option_len=option_len, num_options=num_options,
+                               pad_token_id=self.config.pad_token_id)
 
         if not return_dict:
             output = (logits,) + outputs[1:]
@@ -603,7 +549,8 @@ class dizo_trainer():
             norm_mode,
             proj_lr,
             max_iters,
-            exclude_list=[]
+            exclude_list=[],
+            prefetch=False
     ) -> None:
         # super().__init__(model=None, model_init=None)
         self.device = torch.device("cuda")
@@ -613,41 +560,46 @@ class dizo_trainer():
         self.dizo = DiZO(base_model, norm_mode=norm_mode, exclude_list=exclude_list).to(base_model.device)
         self.pre_trained = base_model
         self.pgm_optimizer = torch.optim.Adam(self.dizo.parameters(), lr=self.proj_lr)
-        self.pgmloader = pgmloader
+        # With prefetch, the batches come already on the device (see prefetch.py)
+        self.pgmloader = DevicePrefetcher(pgmloader, self.device) if prefetch else pgmloader
         self.dataset_iterator = iter(self.pgmloader)
         self.criterion = torch.nn.CrossEntropyLoss()
         self.i = 0
+        self.memory_tracker = PhaseMemoryTracker(enabled=False)
+
+    def _next_batch(self):
+        """
+        Next batch of the (cycled) DiZO data loader, on the device
+        """
+        try:
+            data = next(self.dataset_iterator)
+        except StopIteration:
+            self.dataset_iterator = iter(self.pgmloader)
+            data = next(self.dataset_iterator)
+
+        for each in data:
+            data[each] = data[each].to(self.device)
+        return data
 
     def dizo_bayesian_search(self, model, base_model, apply=False):
         if not apply:
 
-            try:
-                data = next(self.dataset_iterator)
-            except StopIteration:
-                self.dataset_iterator = iter(self.pgmloader)
-                data = next(self.dataset_iterator)
-
-            for each in data:
-                data[each] = data[each].to(self.device)
-            # data = self._prepare_inputs(data)
+            data = self._next_batch()
 
         self.dizo(model, self.pre_trained, apply=True)
 
     def dizo_zo_iters(self, model, base_model, apply=False):
+        with self.memory_tracker.phase("dizo"):
+            self._dizo_zo_iters(model, base_model, apply=apply)
+
+    def _dizo_zo_iters(self, model, base_model, apply=False):
         if not apply:
             self.count = 0
             self.dizo = self.dizo.to(self.device)
             self.dizo.init = True
             while self.count < self.max_iters:
 
-                try:
-                    data = next(self.dataset_iterator)
-                except StopIteration:
-                    self.dataset_iterator = iter(self.pgmloader)
-                    data = next(self.dataset_iterator)
-
-                for each in data:
-                    data[each] = data[each].to(self.device)
+                data = self._next_batch()
 
                 self.dizo.zo_forward(model, base_model, x=data)
                 self.dizo.init = False
@@ -657,21 +609,17 @@ class dizo_trainer():
         self.i += 1
 
     def dizo_iters(self, model, base_model, apply=False):
+        with self.memory_tracker.phase("dizo"):
+            self._dizo_iters(model, base_model, apply=apply)
+
+    def _dizo_iters(self, model, base_model, apply=False):
         if not apply:
             self.count = 0
             self.dizo = self.dizo.to(self.device)
 
             while self.count < self.max_iters:
 
-                try:
-                    data = next(self.dataset_iterator)
-                except StopIteration:
-                    self.dataset_iterator = iter(self.pgmloader)
-                    data = next(self.dataset_iterator)
-
-                for each in data:
-                    data[each] = data[each].to(self.device)
-                # data = self._prepare_inputs(data)
+                data = self._next_batch()
 
                 pgm_loss = self.dizo(model, base_model, x=data)
                 self.pgm_optimizer.zero_grad()
@@ -711,6 +659,13 @@ def kernel_function(r, t, beta=4):
 class OurTrainer(Trainer):
     from transformers.trainer_pt_utils import _get_learning_rate, log_metrics, metrics_format, save_metrics, save_state
 
+    # kerzoo: number of random directions (z) sampled per step (per rank with --zo_parallel direction)
+    zo_num_directions = 3
+    zo_total_directions = zo_num_directions
+    zo_parallel = None
+    zo_compiled_forward = None
+    zo_rank = 0
+
     def _inner_training_loop(
             self, batch_size=None, args=None, resume_from_checkpoint=None, trial=None, ignore_keys_for_eval=None
     ):
@@ -724,7 +679,7 @@ class OurTrainer(Trainer):
         self._train_batch_size = batch_size
         # Data loader and number of training steps
         train_dataloader = self.get_train_dataloader()
-        self.task = get_task(self.args.task_name)
+        self.task = get_task(self.args.task_name, seed=self.args.seed)
         self.objective = 0
         # MeZO added: Linear probing
         if self.args.linear_probing:
@@ -779,6 +734,8 @@ class OurTrainer(Trainer):
             tol = 0.01 if self.args.lp_early_stopping else 1e-4  # 1e-4 is scipy default
             max_iter = 1000 if self.args.lp_early_stopping else 5000
 
+            from sklearn.linear_model import LogisticRegressionCV
+
             logger.info("Fitting logistic regression...")
             reg = LogisticRegressionCV(max_iter=max_iter, fit_intercept=use_bias, multi_class="multinomial",
                                        random_state=0, tol=tol, n_jobs=-1).fit(features, targets)
@@ -1018,6 +975,12 @@ class OurTrainer(Trainer):
             self.named_parameters_to_optim = self.named_parameters_to_optim[1:]
 
         self.named_parameters_to_optim_copy = [(name, param.clone()) for name, param in self.named_parameters_to_optim]
+
+        # Per-phase memory accounting
+        self.memory_tracker = PhaseMemoryTracker(enabled=args.track_memory)
+        self.memory_tracker.record_buffer("model", self.model)
+        self.memory_tracker.record_buffer("trainable_params", [p for _, p in self.named_parameters_to_optim])
+        self.memory_tracker.record_buffer("param_copy", [p for _, p in self.named_parameters_to_optim_copy])
         # self.delta = [(name, param.clone()) for name, param in self.named_parameters_to_optim]
         # self.paramc = [(name, param.clone()) for name, param in self.named_parameters_to_optim]
         
@@ -1027,17 +990,53 @@ class OurTrainer(Trainer):
 
         # DiZO added: remove the unnecessary parameters to cpu for memory saving
         if args.enhanced in ['zo', 'fo']:
-            self.base_model = copy.deepcopy(self.model)
-            for name, param in self.base_model.named_parameters():
-                if name in self.exclude_list:
-                    param.data = param.data.to('cpu')
-            self.dizo_trainer = dizo_trainer(self.base_model, train_dataloader, 'l2norm', 0.1, 10, self.exclude_list)
+            with self.memory_tracker.phase("dizo"):
+                self.base_model = copy.deepcopy(self.model)
+                for name, param in self.base_model.named_parameters():
+                    if name in self.exclude_list:
+                        param.data = param.data.to('cpu')
+                self.dizo_trainer = dizo_trainer(self.base_model, train_dataloader, 'l2norm', 0.1, 10, self.exclude_list,
+                                                 prefetch=getattr(args, "device_prefetch", False))
+                self.dizo_trainer.memory_tracker = self.memory_tracker
+            self.memory_tracker.record_buffer("dizo_base_model", self.base_model)
 
         else:
             args.enhanced = None
 
         self.loss_list = []
         self.random_vector = {}
+        # Per-step metrics stay on device and are only copied to the host at logging/eval boundaries
+        metric_fields = {"loss": 1}
+        if args.trainer == "zo":
+            self._zo_init_parallel()
+            metric_fields["projected_grad"] = self.zo_total_directions
+            if getattr(args, "zo_compile", False):
+                from zo_compile import CompiledZOForward
+                self.zo_compiled_forward = CompiledZOForward(
+                    [int(b) for b in args.compile_length_buckets.split(",")], cache_dir=args.compile_cache_dir)
+        self.metric_buffer = DeviceRingBuffer(256, metric_fields, device=tr_loss.device, host_fields=("lr", "time"))
+        # Flushed metrics and eval results are appended to a memory-mapped run log (see run_log.load_run_log)
+        # instead of re-saving the whole history with np.save at every eval
+        # The run log and JSONL are appended synchronously; the slow sinks (e.g., wandb) are behind a bounded queue
+        # drained by a background thread, so that they never block a training step. Only the main process writes.
+        sinks = []
+        if self.is_world_process_zero():
+            # Under the output directory, so that the runs of a sweep (one output_dir each) keep their own logs
+            path = os.path.join(args.output_dir, 'loss_acc', '{}_{}_{}_enhanced_{}'.format(
+                self.args.task_name, args.trainer, 'lora' if args.lora else 'ft', args.enhanced))
+            run_log = RunLogWriter(
+                os.path.join(path, 'run_log_seed_{}.bin'.format(args.seed)),
+                run_log_dtype(metric_fields.get("projected_grad", 0)),
+                metadata={"task_name": self.args.task_name, "trainer": args.trainer, "seed": args.seed,
+                          "learning_rate": args.learning_rate, "zo_eps": getattr(args, "zo_eps", None)},
+                append=resume_from_checkpoint is not None,
+            )
+            sinks = [LoggerSink(), RunLogSink(run_log), JSONLSink(os.path.join(args.output_dir, "telemetry.jsonl"))]
+            wandb_sink = WandbSink()
+            if wandb_sink.enabled:
+                sinks.append(wandb_sink)
+        self.telemetry = Telemetry(sinks, max_queue=getattr(args, "telemetry_queue_size", 1024),
+                                   policy=getattr(args, "telemetry_drop_policy", "drop_oldest"))
 
         self.accuracy = []
 
@@ -1056,6 +1055,9 @@ class OurTrainer(Trainer):
                 train_dataloader.sampler.set_epoch(epoch)
             elif hasattr(train_dataloader, "dataset") and isinstance(train_dataloader.dataset, IterableDatasetShard):
                 train_dataloader.dataset.set_epoch(epoch)
+            elif hasattr(train_dataloader, "dataset") and hasattr(train_dataloader.dataset, "set_epoch"):
+                # e.g., the streamed training data (see streaming.py)
+                train_dataloader.dataset.set_epoch(epoch)
 
             if is_torch_tpu_available():
                 parallel_loader = pl.ParallelLoader(train_dataloader, [args.device]).per_device_loader(args.device)
@@ -1083,11 +1085,11 @@ class OurTrainer(Trainer):
                 self._load_rng_state(resume_from_checkpoint)
 
 
-            for step, inputs in enumerate(epoch_iterator):
-
-                # for i in range(torch.cuda.device_count()):
-                #     torch.cuda.reset_peak_memory_stats(i)
+            if getattr(args, "device_prefetch", False) and not is_torch_tpu_available():
+                # Collate, pin and copy the next batch while this step runs (see prefetch.py)
+                epoch_iterator = DevicePrefetcher(epoch_iterator, args.device)
 
+            for step, inputs in enumerate(self._timed_batches(epoch_iterator)):
 
                 # Skip past any already trained steps if resuming training
                 if steps_trained_in_current_epoch > 0:
@@ -1131,15 +1133,12 @@ class OurTrainer(Trainer):
                         tr_loss_step = self.forward_wrap_with_option_len(model, **inputs, return_dict=True).loss
                         # tr_loss_step = self.training_step(model, inputs)
 
-                if (
-                        args.logging_nan_inf_filter
-                        and not is_torch_tpu_available()
-                        and (torch.isnan(tr_loss_step) or torch.isinf(tr_loss_step))
-                ):
-                    # if loss is nan or inf simply add the average of previous logged losses
-                    tr_loss += tr_loss / (1 + self.state.global_step - self._globalstep_last_logged)
+                if args.logging_nan_inf_filter and not is_torch_tpu_available():
+                    # if loss is nan or inf simply add the average of previous logged losses (filtered on device)
+                    accumulate_finite(tr_loss, tr_loss_step,
+                                      tr_loss / (1 + self.state.global_step - self._globalstep_last_logged))
                 else:
-                    tr_loss += tr_loss_step
+                    tr_loss += tr_loss_step.detach().to(tr_loss.device)
 
                 self.current_flos += float(self.floating_point_ops(inputs))
 
@@ -1193,6 +1192,8 @@ class OurTrainer(Trainer):
                                 model.clip_grad_norm_(args.max_grad_norm)
                             else:
                                 # Revert to normal clipping otherwise, handling Apex or full precision
+                                if self.use_apex:
+                                    from apex import amp
                                 nn.utils.clip_grad_norm_(
                                     amp.master_params(self.optimizer) if self.use_apex else model.parameters(),
                                     args.max_grad_norm,
@@ -1227,60 +1228,61 @@ class OurTrainer(Trainer):
                     self.state.epoch = epoch + (step + 1) / steps_in_epoch
                     self.control = self.callback_handler.on_step_end(args, self.state, self.control)
 
-
-
-
-
-
-
-                    # for i in range(torch.cuda.device_count()):
-                    #     peak_mem_step = torch.cuda.max_memory_allocated(i) / (1024 ** 3)
-                    #     logger.info(f"[GPU {i}] Step {self.state.global_step} Peak memory: {peak_mem_step:.2f} GB")
-                    #     #wandb.log({f"gpu_{i}_step_peak_mem_gb": peak_mem_step, "global_step": self.state.global_step})
-                    #     torch.cuda.reset_peak_memory_stats(i)
-
-
-
-
-
-
+                    host_values = {"lr": self._get_learning_rate(), "time": time.time() - start_time}
+                    if args.trainer == "zo":
+                        self.metric_buffer.push(self.state.global_step, host_values, loss=tr_loss_step,
+                                                projected_grad=self.projected_grad)
+                    else:
+                        self.metric_buffer.push(self.state.global_step, host_values, loss=tr_loss_step)
 
                     log_step = 50 if args.trainer == 'zo' else 10
-                    if self.state.global_step % log_step == 0:
-                        avg_loss = tr_loss / (self.state.global_step - self._globalstep_last_logged + 1)
-                        logger.info(
-                            {'loss': round(tr_loss_step.item(), 4), 'epoch': epoch, 'lr': self._get_learning_rate()})
-            
-
-
-                    self.loss_list.append(tr_loss_step.item())
                     self.args.eval_steps = 100
+                    if self.state.global_step % log_step == 0 or self.state.global_step % self.args.eval_steps == 0:
+                        # Logging/eval boundary: the only place where per-step metrics are synchronized to the host
+                        flushed = self.metric_buffer.flush()
+                        self.loss_list.extend(flushed["loss"][:, 0].tolist())
+                        self.telemetry.emit("train", flushed)
 
-                    if self.state.global_step % self.args.eval_steps == 0:
+                    if self.state.global_step % log_step == 0:
+                        self.telemetry.emit(
+                            "log", {'loss': round(self.loss_list[-1], 4), 'epoch': epoch, 'lr': self._get_learning_rate()})
 
-                        path = 'loss_acc/{}_{}_{}_enhanced_{}'.format(self.args.task_name, args.trainer, 'lora' if args.lora else 'ft', args.enhanced)
-                        if not os.path.exists(path):
-                            os.makedirs(path)
-                        np.save(path + '/' + 'loss_list_seed_{}.npy'.format(args.seed), self.loss_list)
+                    if self.state.global_step % self.args.eval_steps == 0:
                         predictions = []
-                        for eval_sample in self.eval_dataset:
-                            predictions.append(
-                                self.one_step_pred([], eval_sample, verbose=False)
-                            )
+                        with self.memory_tracker.phase("eval"):
+                            if getattr(args, "max_tokens_per_batch", None) is not None and not self.task.generation:
+                                predictions, candidate_log_probs = predict_candidates(
+                                    self.model, self.tokenizer, self.task, args, [[]] * len(self.eval_dataset),
+                                    self.eval_dataset)
+                                # Eval loss (on the first candidate), as in one_step_pred
+                                self.eval_loss_list.extend(-lp[0].float().mean().item() for lp in candidate_log_probs)
+                            elif self.task.generation and getattr(args, "batch_generation", False):
+                                prompts = [encode_prompt(self.task, self.task.get_template(), [], eval_sample,
+                                                         self.tokenizer, max_length=args.max_length, generation=True,
+                                                         max_new_tokens=args.max_new_tokens)[0][0]
+                                           for eval_sample in self.eval_dataset]
+                                predictions = predict_generations(self.model, self.tokenizer, args, self.eval_dataset,
+                                                                  prompts)
+                            else:
+                                # The model has changed since the last eval: calibration scores are computed again
+                                self.sfc_cache = ScoreCache()
+                                for eval_sample in self.eval_dataset:
+                                    predictions.append(
+                                        self.one_step_pred([], eval_sample, verbose=False)
+                                    )
+                                self.sfc_cache = None
                         metric_name = getattr(self.task, "metric_name", "accuracy")
                         metrics = {metric_name: calculate_metric(predictions, metric_name)}
                         metrics["global_step"] = self.state.global_step
                         logger.info(f"Eval results: {metrics}")
                         self.accuracy.append(metrics[metric_name])
-
-                        wandb.log({"Eval accuracy": metrics[metric_name],"global_step": self.state.global_step})
+                        self.telemetry.emit("eval", {"step": self.state.global_step, "metric_name": metric_name,
+                                                     "metric": metrics[metric_name], "time": time.time() - start_time})
 
                         if hasattr(self, "eval_loss_list") and len(self.eval_loss_list) >= 50:
                             avg_eval_loss = np.mean(self.eval_loss_list[-50:])
                             logger.info(f"Average eval loss over last 50 eval samples: {avg_eval_loss:.4f}")
-                    
-
-                        np.save(path + '/' + 'accuracy_seed_{}.npy'.format(args.seed), self.accuracy)
+                        self.memory_tracker.log_summary()
 
                         if metrics[metric_name] >= self.objective:
                             logger.info("Best dev result: {}".format(metrics[metric_name]))
@@ -1289,6 +1291,9 @@ class OurTrainer(Trainer):
 
                             # Now we save this to (CPU) memory instead of disk <-- much faster
                             self.best_model_ckpt = {k: v.detach().cpu() for k, v in model.state_dict().items()}
+
+                        # Lets callbacks (e.g., sweep.SuccessiveHalvingCallback) stop the run after an eval
+                        self.control = self.callback_handler.on_evaluate(args, self.state, self.control, metrics=metrics)
                 else:
                     self.control = self.callback_handler.on_substep_end(args, self.state, self.control)
 
@@ -1334,6 +1339,10 @@ class OurTrainer(Trainer):
             self._load_best_model()
 
         # add remaining tr_loss
+        flushed = self.metric_buffer.flush()
+        self.loss_list.extend(flushed["loss"][:, 0].tolist())
+        self.telemetry.emit("train", flushed)
+        self.telemetry.close()
         self._total_loss_scalar += tr_loss.item()
         train_loss = self._total_loss_scalar / self.state.global_step
 
@@ -1347,6 +1356,9 @@ class OurTrainer(Trainer):
 
         self._memory_tracker.stop_and_update_metrics(metrics)
 
+        self.memory_tracker.log_summary()
+        self.memory_tracker.save(os.path.join(args.output_dir, "memory_profile.json"))
+
         self.log(metrics)
 
         run_dir = self._get_output_dir(trial)
@@ -1991,6 +2003,8 @@ class OurTrainer(Trainer):
         - num_options: a list of int indicating the number of options for each example (this will be #label
           words for classification tasks and #choices for multiple choice tasks), and a classification loss
           will be calculated.
+        - segment_ids (in kwargs): packed sequences (--pack_sequences, utils.PackingCollator), whose labels are
+          already restricted to the option tokens of each example
         """
         with torch.no_grad():
             outputs = self.forward(input_ids=input_ids, **kwargs)
@@ -1999,49 +2013,11 @@ class OurTrainer(Trainer):
             return outputs
         logits = outputs.logits
 
-        # Shift so that tokens < n predict n
-        shift_logits = logits[..., :-1, :].contiguous()
-        # Here we use input_ids (which should always = labels) bc sometimes labels are correct candidate IDs
-        shift_labels = torch.clone(input_ids)[..., 1:].contiguous()
-        shift_labels[shift_labels == self.config.pad_token_id] = -100
-
-        # Apply option len (do not calculate loss on the non-option part)
-        if option_len is not None:
-            for _i, _len in enumerate(option_len):
-                shift_labels[_i, :-_len] = -100
-
-        # Calculate the loss
-        loss_fct = CrossEntropyLoss(ignore_index=-100)
-        if num_options is not None:
-            # Train as a classification tasks
-            log_probs = F.log_softmax(shift_logits, dim=-1)
-            mask = shift_labels != -100  # Option part
-            shift_labels[~mask] = 0  # So that it doesn't mess up with indexing
-
-            selected_log_probs = torch.gather(log_probs, dim=-1, index=shift_labels.unsqueeze(-1)).squeeze(
-                -1)  # (bsz x num_options, len)
-            selected_log_probs = (selected_log_probs * mask).sum(-1) / mask.sum(-1)  # (bsz x num_options)
-
-            if any([x != num_options[0] for x in num_options]):
-                # Multi choice tasks with different number of options
-                loss = 0
-                start_id = 0
-                count = 0
-                while start_id < len(num_options):
-                    end_id = start_id + num_options[start_id]
-                    _logits = selected_log_probs[start_id:end_id].unsqueeze(0)  # (1, num_options)
-                    _labels = labels[start_id:end_id][0].unsqueeze(0)  # (1)
-                    loss = loss_fct(_logits, _labels) + loss
-                    count += 1
-                    start_id = end_id
-                loss = loss / count
-            else:
-                num_options = num_options[0]
-                selected_log_probs = selected_log_probs.view(-1, num_options)  # (bsz, num_options)
-                labels = labels.view(-1, num_options)[:, 0]  # Labels repeat so we only take the first one
-                loss = loss_fct(selected_log_probs, labels)
+        if kwargs.get("segment_ids") is not None:
+            loss = packed_lm_loss(logits, labels)
         else:
-            loss = loss_fct(shift_logits.view(-1, self.config.vocab_size), shift_labels.view(-1))
+            loss = option_len_loss(logits, input_ids, labels, option_len=option_len, num_options=num_options,
+                                   pad_token_id=self.config.pad_token_id)
 
         if not return_dict:
             output = (logits,) + outputs[1:]
@@ -2058,6 +2034,7 @@ class OurTrainer(Trainer):
     def zo_forward(self, model, inputs):
         """
         Get (no gradient) loss from the model. Dropout is turned off too.
+        inputs must already be on the device (zo_step prepares them once for all its forwards).
         """
         model.eval()
         if self.args.non_diff:
@@ -2065,38 +2042,86 @@ class OurTrainer(Trainer):
             return self.zo_forward_nondiff(model, inputs)
 
         with torch.inference_mode():
-            inputs = self._prepare_inputs(inputs)
             with self.compute_loss_context_manager():
                 with torch.no_grad():
                     # loss = self.compute_loss(model, inputs)
-                    loss = self.forward_wrap_with_option_len(model, **inputs, return_dict=True).loss
+                    loss = None
+                    if self.zo_compiled_forward is not None:
+                        loss = self.zo_compiled_forward(model, inputs)
+                    if loss is None:
+                        loss = self.forward_wrap_with_option_len(model, **inputs, return_dict=True).loss
+            if self.memory_tracker.enabled:
+                # Logits, their shifted contiguous copy and (classification) the log-softmax output
+                num_copies = 3 if inputs.get("num_options") is not None else 2
+                element_size = torch.tensor([], dtype=model.dtype).element_size()
+                self.memory_tracker.record_buffer(
+                    "logits", num_copies * inputs["input_ids"].numel() * model.config.vocab_size * element_size,
+                    device=inputs["input_ids"].device)
             if self.args.n_gpu > 1:
                 # Warning: this is copied from the original Huggingface Trainer. Untested.
                 loss = loss.mean()  # mean() to average on multi-gpu parallel training
         return loss.detach()
 
+    def _timed_batches(self, iterator):
+        """
+        Batches of iterator, with the time spent waiting for each one recorded as the "data_wait" phase
+        """
+        iterator = iter(iterator)
+        while True:
+            with self.memory_tracker.phase("data_wait"):
+                inputs = next(iterator, None)
+            if inputs is None:
+                return
+            yield inputs
+
+    def _zo_loss_weight(self, inputs):
+        """
+        With --max_tokens_per_batch, batches have different numbers of examples: the projected gradient (the (mean)
+        loss difference) is scaled by #examples / per_device_train_batch_size, so that every example weighs the same in
+        the ZO gradient estimate as with fixed-size batches. The logged loss stays the unweighted mean.
+        """
+        if getattr(self.args, "max_tokens_per_batch", None) is None:
+            return 1
+        num_options = inputs.get("num_options")
+        if num_options is not None:
+            # Each example has num_options rows
+            num_options = torch.as_tensor(num_options, device=inputs["input_ids"].device)
+            num_examples = (1.0 / num_options.float()).sum()
+        elif inputs.get("segment_ids") is not None:
+            # Packed sequences: one example per segment of each row
+            num_examples = inputs["segment_ids"].amax(-1).sum()
+        else:
+            num_examples = inputs["input_ids"].size(0)
+        return num_examples / self.args.per_device_train_batch_size
+
     def zo_forward_nondiff(self, model, inputs):
         """
-        Get (no gradient) non-diffiable loss from the model.
+        Get (no gradient) non-diffiable loss from the model (inputs already on the device, see zo_forward).
+        The answers of the batch are generated together (greedy decoding retires the rows that end, see
+        batch_generation.py), with at most option_len (the gold answer length) + --non_diff_answer_margin new tokens.
         """
         model.eval()
         assert self.args.task_name == "SQuAD", "Non differentiable objective only supports SQuAD for now."
 
         with torch.inference_mode():
-            inputs = self._prepare_inputs(inputs)
             args = self.args
-            outputs = self.model.generate(
-                inputs["input_ids"], do_sample=args.sampling, temperature=args.temperature,
-                num_beams=args.num_beams, top_p=args.top_p, top_k=args.top_k,
-                max_new_tokens=min(args.max_new_tokens, args.max_length - inputs["input_ids"].size(1)),
-                num_return_sequences=1,
-                eos_token_id=[self.tokenizer.encode(args.eos_token, add_special_tokens=False)[-1],
-                              self.tokenizer.eos_token_id],
-            )
-            output_text = []
-            for i in range(len(outputs)):
-                output_text.append(
-                    self.tokenizer.decode(outputs[i][inputs["input_ids"].size(1):], skip_special_tokens=True).strip())
+            input_ids, attention_mask = inputs["input_ids"], inputs["attention_mask"]
+            max_new_tokens = [min(args.max_new_tokens, args.max_length - input_ids.size(1))] * input_ids.size(0)
+            if getattr(args, "non_diff_answer_margin", None) is not None and "option_len" in inputs:
+                max_new_tokens = [min(cap, option_len + args.non_diff_answer_margin)
+                                  for cap, option_len in zip(max_new_tokens, inputs["option_len"].tolist())]
+            eos_ids = eos_token_ids(self.tokenizer, args.eos_token)
+            if plain_greedy(self.model, args):
+                outputs = greedy_generate(self.model, input_ids, attention_mask, max_new_tokens, eos_ids)
+            else:
+                outputs = self.model.generate(
+                    input_ids, attention_mask=attention_mask, do_sample=args.sampling, temperature=args.temperature,
+                    num_beams=args.num_beams, top_p=args.top_p, top_k=args.top_k,
+                    max_new_tokens=max(max_new_tokens), num_return_sequences=1, eos_token_id=eos_ids,
+                    pad_token_id=self.tokenizer.pad_token_id,
+                )
+                outputs = [output[:cap] for output, cap in zip(outputs[:, input_ids.size(1):].tolist(), max_new_tokens)]
+            output_text = [text.strip() for text in self.tokenizer.batch_decode(outputs, skip_special_tokens=True)]
             f1s = [f1(output_text[i], inputs['gold'][i]) for i in range(len(output_text))]
 
         return -torch.tensor(np.mean(f1s), dtype=torch.float32)
@@ -2108,9 +2133,19 @@ class OurTrainer(Trainer):
 
   
 
+        if self.zo_parallel == "pipeline":
+            return self.zo_pipeline_stage.zo_step(self, inputs)
+
+        # Moved to the device once; all the forwards of the step reuse the same tensors
+        inputs = self._prepare_inputs(inputs)
         args = self.args
         self.zo_random_seed = np.random.randint(1000000000)
         device = self.named_parameters_to_optim[0][1].device
+        if self.zo_parallel is not None:
+            # All the ranks must sample the same directions
+            seed = torch.tensor([self.zo_random_seed], dtype=torch.int64, device=self.zo_comm_device)
+            dist.broadcast(seed, src=0)
+            self.zo_random_seed = int(seed.item())
         
         #self.original_params = self.named_parameters_to_optim
 
@@ -2126,7 +2161,15 @@ class OurTrainer(Trainer):
 
    
 
-        for i in range(3): 
+        # Direction parallelism: rank r evaluates directions [r * zo_num_directions, (r + 1) * zo_num_directions).
+        # The directions of the other ranks are still applied and reverted (without forward passes): perturbing
+        # and reverting is not exact in floating point, and all the ranks must keep bit-identical parameters
+        first = self.zo_rank * self.zo_num_directions if self.zo_parallel == "direction" else 0
+        directions = range(first, first + self.zo_num_directions)
+        self.projected_grad = []
+        loss_weight = self._zo_loss_weight(inputs)
+        for i in range(self.zo_total_directions):
+            evaluate = i in directions
             torch.manual_seed(self.zo_random_seed - i)
 
 
@@ -2136,8 +2179,11 @@ class OurTrainer(Trainer):
             #self.z_dicts.append(z_dict) 
 
             # First function evaluation
-            self.zo_perturb_parameters(scaling_factor=1, judge=1)
-            loss1 = self.zo_forward(model, inputs) 
+            with self.memory_tracker.phase("perturb"):
+                self.zo_perturb_parameters(scaling_factor=1, judge=1)
+            if evaluate:
+                with self.memory_tracker.phase("forward"):
+                    loss1 = self.zo_forward(model, inputs) 
 
 
 
@@ -2145,19 +2191,23 @@ class OurTrainer(Trainer):
  
             torch.manual_seed(self.zo_random_seed - i)
             # Second function evaluation
-            self.zo_perturb_parameters(scaling_factor=-1, judge=-1)
-            loss2 = self.zo_forward(model, inputs)
+            with self.memory_tracker.phase("perturb"):
+                self.zo_perturb_parameters(scaling_factor=-1, judge=-1)
+            if evaluate:
+                with self.memory_tracker.phase("forward"):
+                    loss2 = self.zo_forward(model, inputs)
 
             torch.manual_seed(self.zo_random_seed - i)
             # self.zo_restore_parameters(scaling_factor=-1)
 
-            self.zo_perturb_parameters(scaling_factor=1, judge=0)
+            with self.memory_tracker.phase("perturb"):
+                self.zo_perturb_parameters(scaling_factor=1, judge=0)
 
-            self.projected_grad.append((loss1 - loss2) / (2 * self.args.zo_eps))  
-            
+            if evaluate:
+                self.projected_grad.append((loss1 - loss2) * loss_weight / (2 * self.args.zo_eps))
 
-        
-        
+        if self.zo_parallel is not None:
+            self.projected_grad = self._zo_all_reduce_projected_grad(directions, device)
 
         assert self.args.gradient_accumulation_steps == 1  
 
@@ -2166,10 +2216,52 @@ class OurTrainer(Trainer):
 
     
 
+    def _zo_init_parallel(self):
+        """
+        Multi-process ZO (--zo_parallel, launched with torchrun). Every rank holds the same parameters and applies
+        the same update, so the only communication is the broadcast of the step seed and the all-reduce of the
+        projected gradients (a few scalars per step); there is no DDP wrapping.
+        - direction: each rank evaluates zo_num_directions different directions on the same batch
+        - data: each rank evaluates the same directions on its own shard of the batch
+        - pipeline: each rank holds a stage of the model (see zo_pipeline.py) and perturbs/updates only its own
+          parameters; hidden states flow between the stages
+        """
+        mode = getattr(self.args, "zo_parallel", "none")
+        assert mode in ["none", "direction", "data", "pipeline"], f"Unknown zo_parallel mode {mode}"
+        self.zo_parallel, self.zo_world_size, self.zo_rank, self.zo_comm_device = None, 1, 0, None
+        if mode != "none":
+            if dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1:
+                self.zo_parallel = mode
+                self.zo_world_size, self.zo_rank = dist.get_world_size(), dist.get_rank()
+                # gloo only reduces CPU tensors
+                self.zo_comm_device = torch.device("cpu") if dist.get_backend() == "gloo" else self.args.device
+            else:
+                logger.warning(f"--zo_parallel {mode} needs a distributed launch (e.g., torchrun), running single-process")
+        if self.zo_parallel == "pipeline":
+            self.zo_pipeline_stage = getattr(self.model, "pipeline_stage", None)
+            assert self.zo_pipeline_stage is not None, "--zo_parallel pipeline needs a model partitioned by zo_pipeline.partition_model"
+        self.zo_total_directions = self.zo_num_directions * (self.zo_world_size if self.zo_parallel == "direction" else 1)
+
+    def _zo_all_reduce_projected_grad(self, directions, device):
+        """
+        Sum (direction parallelism) or average (data parallelism) the projected gradients of all the ranks
+        """
+        grads = torch.zeros(self.zo_total_directions, device=self.zo_comm_device)
+        grads[directions.start:directions.stop] = torch.stack(self.projected_grad).float().to(self.zo_comm_device)
+        dist.all_reduce(grads)
+        if self.zo_parallel == "data":
+            grads /= self.zo_world_size
+        return list(grads.to(device).unbind())
+
     def zo_update(self, args, model):
+        with self.memory_tracker.phase("update"):
+            self._zo_update(args, model)
+
+    def _zo_update(self, args, model):
 
         device = self.named_parameters_to_optim[0][1].device
-        self.projected_grad = torch.tensor(self.projected_grad, device=device)
+        # Keep the projected gradients on device (torch.tensor on a list of device scalars would sync)
+        self.projected_grad = torch.stack([g.to(device) for g in self.projected_grad])
 
         # if not hasattr(self, "zo_random_seeds") or not self.zo_random_seeds:
         #     raise RuntimeError("Error: `zo_random_seeds` is empty! Run `zo_step()` first.")
@@ -2180,7 +2272,7 @@ class OurTrainer(Trainer):
             for name, param in self.named_parameters_to_optim
         }
 
-        for i in range(3):
+        for i in range(self.zo_total_directions):
             torch.manual_seed(self.zo_random_seed-i)
             #np.random.seed(seed)
 
@@ -2192,11 +2284,14 @@ class OurTrainer(Trainer):
                 
                 grad_buffer[name] += self.projected_grad[i].to(param.device) * z.to(param.device) * kernel_function(k, 1)
 
+        self.memory_tracker.record_buffer("grad_buffer", grad_buffer)
+
        
         for (name, param), (c_name, c_param) in zip(self.named_parameters_to_optim, self.named_parameters_to_optim_copy):
-            avg_grad = grad_buffer[name] / 3
+            avg_grad = grad_buffer[name] / self.zo_total_directions
             #print(torch.norm(avg_grad,p=2))
-            avg_grad = min(1,(400000.0)/torch.norm(avg_grad,p=2)) * avg_grad
+            # Clip on device (Python min() on a tensor would synchronize)
+            avg_grad = torch.clamp((400000.0) / torch.norm(avg_grad, p=2), max=1) * avg_grad
 
             c_param.data -= self._get_learning_rate() * avg_grad
             param.data = c_param.data / self.beta_k + (1 - 1 / self.beta_k) * param.data
@@ -2206,6 +2301,88 @@ class OurTrainer(Trainer):
     
     ############## Misc overload functions ##############
 
+    def _wrap_model(self, model, training=True, dataloader=None):
+        """
+        Multi-process ZO does not need DDP (see _zo_init_parallel)
+        """
+        if self.args.trainer == "zo" and getattr(self.args, "zo_parallel", "none") != "none":
+            return model
+        return super()._wrap_model(model, training=training, dataloader=dataloader)
+
+    def get_train_dataloader(self):
+        """
+        --max_tokens_per_batch: batches of the examples drawn by the train sampler with a padded token budget instead
+        of a fixed number of examples (see token_budget.py)
+        """
+        if isinstance(self.train_dataset, IterableDataset) and self.args.trainer == "zo" and \
+                getattr(self.args, "zo_parallel", "none") in ["direction", "pipeline"]:
+            # Streamed training data (see streaming.py): all the ranks read the same stream (no IterableDatasetShard)
+            return DataLoader(
+                self.train_dataset,
+                batch_size=self._train_batch_size,
+                collate_fn=self._get_collator_with_removed_columns(self.data_collator, description="training"),
+                num_workers=self.args.dataloader_num_workers,
+                pin_memory=self.args.dataloader_pin_memory,
+            )
+        if getattr(self.args, "max_tokens_per_batch", None) is None:
+            return super().get_train_dataloader()
+        same_batches = self.args.trainer == "zo" and getattr(self.args, "zo_parallel", "none") in ["direction", "pipeline"]
+        if self.args.world_size > 1 and not same_batches:
+            # Each rank would pack its own shard (DistributedSampler, --zo_parallel data, DDP/FSDP) into a different
+            # number of batches, and the collectives would desync at the end of the epoch
+            raise ValueError("--max_tokens_per_batch with multiple processes only supports --zo_parallel direction/pipeline "
+                             "(ranks would get different numbers of batches)")
+
+        lengths = self._train_lengths()
+        rows = [len(self.train_dataset[i]) if isinstance(self.train_dataset[i], list) else 1
+                for i in range(len(self.train_dataset))]
+        batch_sampler = TokenBudgetBatchSampler(self._get_train_sampler(), lengths, self.args.max_tokens_per_batch, rows=rows)
+        return DataLoader(
+            self.train_dataset,
+            batch_sampler=batch_sampler,
+            collate_fn=self._get_collator_with_removed_columns(self.data_collator, description="training"),
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+            worker_init_fn=seed_worker,
+        )
+
+    def _get_train_sampler(self):
+        """
+        - With ZO direction/pipeline parallelism, all the ranks must see the same batches (instead of DistributedSampler
+          shards)
+        - --group_by_length: batches of examples of similar lengths (shuffled by groups of 50 batches), seeded with
+          data_seed (or seed) so that the order is reproducible
+        """
+        same_batches = self.args.trainer == "zo" and getattr(self.args, "zo_parallel", "none") in ["direction", "pipeline"]
+        seed = self.args.seed if self.args.data_seed is None else self.args.data_seed
+        if self.args.group_by_length:
+            batch_size = self.args.train_batch_size * self.args.gradient_accumulation_steps
+            lengths = self._train_lengths()
+            if self.args.world_size <= 1 or same_batches:
+                generator = torch.Generator()
+                generator.manual_seed(seed)
+                return LengthGroupedSampler(batch_size, lengths=lengths, generator=generator)
+            return DistributedLengthGroupedSampler(batch_size, num_replicas=self.args.world_size,
+                                                   rank=self.args.process_index, lengths=lengths, seed=seed)
+        if same_batches:
+            generator = torch.Generator()
+            generator.manual_seed(seed)
+            return RandomSampler(self.train_dataset, generator=generator)
+        return super()._get_train_sampler()
+
+    def _train_lengths(self):
+        """
+        Padded length of each training example (an example of a classification task is padded to its longest option)
+        """
+        lengths = []
+        for i in range(len(self.train_dataset)):
+            example = self.train_dataset[i]
+            if isinstance(example, list):
+                lengths.append(max(len(option["input_ids"]) for option in example))
+            else:
+                lengths.append(len(example["input_ids"]))
+        return lengths
+
     def _set_signature_columns_if_needed(self):
         """
         We overload this function for non-differentiable objective training to pass "gold" -- the gold text for the task
@@ -2217,6 +2394,10 @@ class OurTrainer(Trainer):
             # Labels may be named label or label_ids, the default data collator handles that.
             self._signature_columns += list(set(["label", "label_ids"] + self.label_names))
             self._signature_columns += ["gold"]
+            if getattr(self.args, "pack_sequences", False) or self.args.non_diff:
+                # PackingCollator folds option_len into the packed labels; the non-differentiable objective caps the
+                # generation with it
+                self._signature_columns += ["option_len"]
 
     def save_model(self, output_dir: Optional[str] = None, _internal_call: bool = False):
         """
@@ -2311,15 +2492,9 @@ class OurTrainer(Trainer):
         else:
             with torch.inference_mode():
                 self.model.eval()
-                logits = self.model(input_ids=input_ids).logits
-            labels = input_ids[0, 1:]
-            logits = logits[0, :-1]
-            log_probs = F.log_softmax(logits, dim=-1)
-
-            selected_log_probs = log_probs[torch.arange(len(labels)).to(labels.device), labels]
-            selected_log_probs = selected_log_probs.cpu().detach()
-            # Only return the option (candidate) part
-            return selected_log_probs[-option_len:]
+                # Only return the option (candidate) part
+                selected_log_probs = token_log_probs(self.model, input_ids, last=option_len)
+            return selected_log_probs[0].cpu().detach()
         
     def one_step_pred(self, train_samples, eval_sample, verbose=False):
         """
@@ -2386,13 +2561,12 @@ class OurTrainer(Trainer):
         # =============================
         else:
             # ===== Compute eval loss for first candidate =====
-            inputs = {
-                "input_ids": torch.tensor([encoded_candidates[0]]).to(self.model.device),
-                "labels": torch.tensor([encoded_candidates[0]]).to(self.model.device),
-                "option_len": [option_lens[0]],
-            }
+            # (option_len_loss from the option log-probabilities, which is all that --zo_parallel pipeline broadcasts)
+            input_ids = torch.tensor([encoded_candidates[0]]).to(self.model.device)
             with torch.no_grad():
-                loss = self.forward_wrap_with_option_len(self.model, **inputs, return_dict=True).loss
+                log_probs = token_log_probs(self.model, input_ids, last=option_lens[0])
+                not_pad = input_ids[:, -log_probs.size(-1):] != self.model.config.pad_token_id
+                loss = -log_probs[not_pad].float().mean()
                 
                 if hasattr(self, "eval_loss_list"):
                     self.eval_loss_list.append(loss.item())
@@ -2410,8 +2584,12 @@ class OurTrainer(Trainer):
                     logger.info(f"Log probabilities of option tokens: {selected_log_probs}")
 
                 if self.args.sfc or self.args.icl_sfc:
-                    sfc_selected_log_probs = self.forward(sfc_encoded_candidates[candidate_id],
-                                                        option_len=sfc_option_lens[candidate_id])
+                    if getattr(self, "sfc_cache", None) is not None:
+                        sfc_selected_log_probs = self.sfc_cache.score(sfc_encoded_candidates[candidate_id],
+                                                                      sfc_option_lens[candidate_id], self.forward)
+                    else:
+                        sfc_selected_log_probs = self.forward(sfc_encoded_candidates[candidate_id],
+                                                            option_len=sfc_option_lens[candidate_id])
                     if verbose:
                         logger.info(f"=== Candidate {candidate_id} (SFC) ===")
                         logger.info(self.tokenizer.decode(sfc_encoded_candidates[candidate_id]).split(self.task.train_sep)[-1])
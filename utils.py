@@ -1,3 +1,6 @@
+import dataclasses
+import hashlib
+import itertools
 import json
 import os
 import contextlib
@@ -28,40 +31,51 @@ from transformers.tokenization_utils_base import PreTrainedTokenizerBase
 logger = logging.getLogger(__name__)
 
 
-def forward_wrap_with_option_len(self, input_ids=None, labels=None, option_len=None, num_options=None, return_dict=None, **kwargs):
+def token_log_probs(model, input_ids, attention_mask=None, last=None):
     """
-    This is to replace the original forward function of Transformer models to enable:
-    (1) Partial target sequence: loss will only be calculated on part of the sequence
-    (2) Classification-style training: a classification loss (CE) will be calculated over several options
-    Input:
-    - input_ids, labels: same as the original forward function
-    - option_len: a list of int indicating the option lengths, and loss will be calculated only on the
-      last option_len tokens 
-    - num_options: a list of int indicating the number of options for each example (this will be #label
-      words for classification tasks and #choices for multiple choice tasks), and a classification loss
-      will be calculated.
+    Log-probability of each token of input_ids given the previous ones, for the last `last` tokens (all but the first if
+    None or 0, as [-option_len:]). With --zo_parallel pipeline, only these are broadcast from the last stage, not the
+    logits.
+    Output: (bsz, last) tensor
     """
-    # import code
-    # code.interact(local=locals())
-    outputs = self.original_forward(input_ids=input_ids, **kwargs)
+    stage = getattr(model, "pipeline_stage", None)
+    if stage is not None:
+        return stage.token_log_probs(input_ids, attention_mask, last=last)
+    logits = model(input_ids=input_ids, attention_mask=attention_mask).logits
+    return select_log_probs(logits, input_ids, last=last)
 
-    if labels is None:
-        return outputs
-    logits = outputs.logits
 
-    loss = None
+def select_log_probs(logits, input_ids, last=None):
+    """
+    token_log_probs from the logits of input_ids
+    """
+    last = min(last or input_ids.size(-1) - 1, input_ids.size(-1) - 1)
+    log_probs = F.log_softmax(logits[:, -last - 1:-1], dim=-1)
+    return torch.gather(log_probs, -1, input_ids[:, -last:].unsqueeze(-1)).squeeze(-1)
+
+
+def option_len_loss(logits, input_ids, labels, option_len=None, num_options=None, pad_token_id=None, reduction="mean"):
+    """
+    Loss used by forward_wrap_with_option_len (see its docstring for option_len/num_options)
+    Input:
+    - logits: (bsz, len, vocab) logits of input_ids
+    - reduction: "mean", or "sum" to get (sum of the loss terms, number of terms), e.g., to combine micro-batches
+    Output: loss, or (loss sum, count) with reduction="sum"
+    """
     # Shift so that tokens < n predict n
     shift_logits = logits[..., :-1, :].contiguous()
     # Here we use input_ids (which should always = labels) bc sometimes labels are correct candidate IDs
     shift_labels = torch.clone(input_ids)[..., 1:].contiguous()
-    shift_labels[shift_labels == self.config.pad_token_id] = -100
+    shift_labels[shift_labels == pad_token_id] = -100
 
-    # Apply option len (do not calculate loss on the non-option part)
-    for _i, _len in enumerate(option_len):
-        shift_labels[_i, :-_len] = -100
+    # Apply option len (do not calculate loss on the non-option part); same as shift_labels[i, :-option_len[i]] = -100
+    if option_len is not None:
+        option_len = torch.as_tensor(option_len, device=shift_labels.device).unsqueeze(-1)
+        positions = torch.arange(shift_labels.size(-1), device=shift_labels.device)
+        shift_labels[(positions < shift_labels.size(-1) - option_len) & (option_len != 0)] = -100
 
     # Calculate the loss
-    loss_fct = CrossEntropyLoss(ignore_index=-100)
+    loss_fct = CrossEntropyLoss(ignore_index=-100, reduction=reduction)
     if num_options is not None:
         # Train as a classification tasks
         log_probs = F.log_softmax(shift_logits, dim=-1)
@@ -83,14 +97,63 @@ def forward_wrap_with_option_len(self, input_ids=None, labels=None, option_len=N
                 loss = loss_fct(_logits, _labels) + loss
                 count += 1
                 start_id = end_id
-            loss = loss / count
+            if reduction == "mean":
+                loss = loss / count
         else:
             num_options = num_options[0]
             selected_log_probs = selected_log_probs.view(-1, num_options) # (bsz, num_options)
             labels = labels.view(-1, num_options)[:, 0] # Labels repeat so we only take the first one
             loss = loss_fct(selected_log_probs, labels)
+            count = labels.numel()
     else:
-        loss = loss_fct(shift_logits.view(-1, self.config.vocab_size), shift_labels.view(-1))
+        count = (shift_labels != -100).sum()
+        loss = loss_fct(shift_logits.view(-1, shift_logits.size(-1)), shift_labels.view(-1))
+
+    if reduction == "sum":
+        return loss, count
+    return loss
+
+
+def packed_lm_loss(logits, labels, reduction="mean"):
+    """
+    LM loss of packed sequences (PackingCollator): labels already hold the target tokens of each packed example
+    (-100 elsewhere), so this equals option_len_loss over the same examples unpacked
+    Input:
+    - logits: (rows, len, vocab) logits of the packed input_ids
+    - reduction: "mean", or "sum" to get (sum of the loss terms, number of terms)
+    """
+    shift_logits = logits[..., :-1, :].contiguous()
+    shift_labels = labels[..., 1:].contiguous()
+    loss = CrossEntropyLoss(ignore_index=-100, reduction=reduction)(
+        shift_logits.view(-1, shift_logits.size(-1)), shift_labels.view(-1))
+    if reduction == "sum":
+        return loss, (shift_labels != -100).sum()
+    return loss
+
+
+def forward_wrap_with_option_len(self, input_ids=None, labels=None, option_len=None, num_options=None, return_dict=None, **kwargs):
+    """
+    This is to replace the original forward function of Transformer models to enable:
+    (1) Partial target sequence: loss will only be calculated on part of the sequence
+    (2) Classification-style training: a classification loss (CE) will be calculated over several options
+    Input:
+    - input_ids, labels: same as the original forward function
+    - option_len: a list of int indicating the option lengths, and loss will be calculated only on the
+      last option_len tokens 
+    - num_options: a list of int indicating the number of options for each example (this will be #label
+      words for classification tasks and #choices for multiple choice tasks), and a classification loss
+      will be calculated.
+    """
+    # import code
+    # code.interact(local=locals())
+    outputs = self.original_forward(input_ids=input_ids, **kwargs)
+
+    if labels is None:
+        return outputs
+    logits = outputs.logits
+
+    loss = option_len_loss(logits, input_ids, labels, option_len=option_len, num_options=num_options,
+                           pad_token_id=self.config.pad_token_id)
 
     if not return_dict:
         output = (logits,) + outputs[1:]
@@ -105,28 +168,38 @@ def forward_wrap_with_option_len(self, input_ids=None, labels=None, option_len=N
     )
 
 
-def encode_prompt(task, template, train_samples, eval_sample, tokenizer, max_length, sfc=False, icl_sfc=False, generation=False, generation_with_gold=False, max_new_tokens=None):
+def prompt_texts(task, template, train_samples, eval_sample, sfc=False, icl_sfc=False, generation=False, generation_with_gold=False):
     """
-    Encode prompts for eval_sample
-    Input: 
-    - task, template: task and template class
-    - train_samples, eval_sample: demonstrations and the actual sample
-    - tokenizer, max_length: tokenizer and max length
-    - sfc: generate prompts for calibration (surface form competition; https://arxiv.org/abs/2104.08315)
-    - icl_sfc: generate prompts for ICL version calibration
-    - generation: whether it is an generation task
-    - generation_with_gold: whether to include the generation-task gold answers (for training)
-    - max_new_tokens: max number of new tokens to generate so that we can save enough space 
-      (only for generation tasks)
+    Prompts encode_prompt tokenizes (same arguments)
     Output:
-    - encodings: a list of N lists of tokens. N is the number of options for classification/multiple-choice.
-    - option_lens: a list of N integers indicating the number of option tokens.
+    - final_prompts: a list of N prompts (one per option, or one for generation tasks)
+    - option_texts: (unverbalized eval prompt, list of N verbalized eval prompts); the option length of prompt i is
+      the number of tokens verbalized prompt i adds to the unverbalized one. None if the option lengths are 0.
     """
 
     # Demonstrations for ICL
     train_prompts = [template.verbalize(sample, sample.correct_candidate).strip() for sample in train_samples]
     train_prompts = task.train_sep.join(train_prompts).strip()
-    
+
+    eval_prompts, option_texts = eval_prompt_texts(template, eval_sample, sfc=sfc, icl_sfc=icl_sfc,
+                                                   generation=generation, generation_with_gold=generation_with_gold)
+    if sfc:
+        # Without demonstrations
+        final_prompts = eval_prompts
+    else:
+        # With demonstrations
+        final_prompts = [(train_prompts + task.train_sep + eval_prompt).lstrip().strip(' ') for eval_prompt in eval_prompts]
+
+    return final_prompts, option_texts
+
+
+def eval_prompt_texts(template, eval_sample, sfc=False, icl_sfc=False, generation=False, generation_with_gold=False):
+    """
+    Eval sample part of the prompts of prompt_texts (same arguments)
+    Output:
+    - eval_prompts: the text after the demonstrations (and task.train_sep) in each final prompt
+    - option_texts: see prompt_texts
+    """
 
     # template_inst = template()  
     # if sfc or icl_sfc:
@@ -148,29 +221,33 @@ def encode_prompt(task, template, train_samples, eval_sample, tokenizer, max_len
         # We generate one prompt for each candidate (different classes in classification)
         # or different choices in multiple-choice tasks
         verbalized_eval_prompts = [verbalize_fn(eval_sample, cand).strip(' ') for cand in eval_sample.candidates]
-        unverbalized_eval_prompt_length = len(tokenizer.encode(unverbalized_eval_prompt))
-        option_lens = [(len(tokenizer.encode(verbalized_eval_prompt)) - unverbalized_eval_prompt_length) for verbalized_eval_prompt in verbalized_eval_prompts]
-
-        if sfc:
-            # Without demonstrations
-            final_prompts = verbalized_eval_prompts 
-        else:
-            # With demonstrations
-            final_prompts = [(train_prompts + task.train_sep + eval_prompt).lstrip().strip(' ') for eval_prompt in verbalized_eval_prompts] 
+        option_texts = (unverbalized_eval_prompt, verbalized_eval_prompts)
+        eval_prompts = verbalized_eval_prompts
     else:
         assert not sfc and not icl_sfc, "Generation tasks do not support SFC"
         if generation_with_gold:
             verbalized_eval_prompts = [verbalize_fn(eval_sample, eval_sample.correct_candidate)]
-            unverbalized_eval_prompt_length = len(tokenizer.encode(unverbalized_eval_prompt))
-            option_lens = [(len(tokenizer.encode(verbalized_eval_prompt)) - unverbalized_eval_prompt_length) for verbalized_eval_prompt in verbalized_eval_prompts]
-            final_prompts = [(train_prompts + task.train_sep + eval_prompt).lstrip().strip(' ') for eval_prompt in verbalized_eval_prompts] 
+            option_texts = (unverbalized_eval_prompt, verbalized_eval_prompts)
+            eval_prompts = verbalized_eval_prompts
         else:
-            option_lens = [0]
-            final_prompts = [(train_prompts + task.train_sep + unverbalized_eval_prompt).lstrip().strip(' ')]
+            option_texts = None
+            eval_prompts = [unverbalized_eval_prompt]
+
+    return eval_prompts, option_texts
+
+
+def keeps_first_token(tokenizer):
+    """
+    Whether left truncation keeps the first token (BOS) of the encodings (see truncate_encodings)
+    """
+    tokenizer_name = tokenizer.__class__.__name__.lower()
+    return "gpt" in tokenizer_name or "opt" in tokenizer_name or "llama" in tokenizer_name or "Llama" in tokenizer_name
 
-    # Tokenize 
-    encodings = [tokenizer.encode(final_prompt) for final_prompt in final_prompts]
 
+def truncate_encodings(encodings, tokenizer, max_length, generation=False, max_new_tokens=None):
+    """
+    Truncate the encodings of encode_prompt to max_length tokens (minus max_new_tokens for generation tasks)
+    """
     # Truncate (left truncate as demonstrations are less important)
     if generation and max_new_tokens is not None:
         max_length = max_length - max_new_tokens
@@ -178,12 +255,52 @@ def encode_prompt(task, template, train_samples, eval_sample, tokenizer, max_len
     if any([len(encoding) > max_length for encoding in encodings]):
         logger.warn("Exceed max length")
     
-    tokenizer_name = tokenizer.__class__.__name__.lower()
-    if "gpt" in tokenizer_name or "opt" in tokenizer_name or "llama" in tokenizer_name or "Llama" in tokenizer_name:
+    if keeps_first_token(tokenizer):
         encodings = [encoding[0:1] + encoding[1:][-(max_length-1):] for encoding in encodings]
     else:
         encodings = [encoding[-max_length:] for encoding in encodings]
 
+    return encodings
+
+
+def option_lengths(option_texts, tokenizer):
+    """
+    Option lengths (in tokens) of the prompts of prompt_texts, from its option_texts
+    """
+    if option_texts is None:
+        return [0]
+    unverbalized_eval_prompt, verbalized_eval_prompts = option_texts
+    unverbalized_eval_prompt_length = len(tokenizer.encode(unverbalized_eval_prompt))
+    return [(len(tokenizer.encode(verbalized_eval_prompt)) - unverbalized_eval_prompt_length) for verbalized_eval_prompt in verbalized_eval_prompts]
+
+
+def encode_prompt(task, template, train_samples, eval_sample, tokenizer, max_length, sfc=False, icl_sfc=False, generation=False, generation_with_gold=False, max_new_tokens=None):
+    """
+    Encode prompts for eval_sample
+    Input: 
+    - task, template: task and template class
+    - train_samples, eval_sample: demonstrations and the actual sample
+    - tokenizer, max_length: tokenizer and max length
+    - sfc: generate prompts for calibration (surface form competition; https://arxiv.org/abs/2104.08315)
+    - icl_sfc: generate prompts for ICL version calibration
+    - generation: whether it is an generation task
+    - generation_with_gold: whether to include the generation-task gold answers (for training)
+    - max_new_tokens: max number of new tokens to generate so that we can save enough space 
+      (only for generation tasks)
+    Output:
+    - encodings: a list of N lists of tokens. N is the number of options for classification/multiple-choice.
+    - option_lens: a list of N integers indicating the number of option tokens.
+    """
+
+    final_prompts, option_texts = prompt_texts(task, template, train_samples, eval_sample, sfc=sfc, icl_sfc=icl_sfc,
+                                               generation=generation, generation_with_gold=generation_with_gold)
+    option_lens = option_lengths(option_texts, tokenizer)
+
+    # Tokenize 
+    encodings = [tokenizer.encode(final_prompt) for final_prompt in final_prompts]
+
+    encodings = truncate_encodings(encodings, tokenizer, max_length, generation=generation, max_new_tokens=max_new_tokens)
+
     # if tokenizer.add_bos_token:
     #     encodings = [encoding[0:1] + encoding[1:][-(max_length-1):] for encoding in encodings]  
     # else:
@@ -288,6 +405,39 @@ class ICLCollator:
         return batch
 
 
+def padded_length(longest, padding=True, max_length=None, pad_to_multiple_of=None):
+    """
+    Length a batch is padded to, with the same padding arguments as tokenizer.pad
+    """
+    length = longest
+    if padding in ["max_length", PaddingStrategy.MAX_LENGTH] and max_length is not None:
+        length = max(max_length, longest)
+    if pad_to_multiple_of is not None and length % pad_to_multiple_of != 0:
+        length = (length // pad_to_multiple_of + 1) * pad_to_multiple_of
+    return length
+
+
+def pad_sequences(sequences, pad_value, length, padding_side="right"):
+    """
+    Pad 1D int sequences into one preallocated (len(sequences), length) int64 array, in one shot
+    Output: padded array, boolean mask of the non-padding positions
+    """
+    lens = np.fromiter((len(s) for s in sequences), dtype=np.int64, count=len(sequences))
+    positions = np.arange(length)
+    if padding_side == "right":
+        mask = positions < lens[:, None]
+    else:
+        mask = positions >= (length - lens)[:, None]
+    padded = np.full((len(sequences), length), pad_value, dtype=np.int64)
+    # Boolean-mask assignment fills the rows in order, so the concatenated sequences land in place
+    if len(sequences) > 0 and isinstance(sequences[0], np.ndarray):
+        # e.g., memory-mapped token cache views
+        padded[mask] = np.concatenate(sequences)
+    else:
+        padded[mask] = np.fromiter(itertools.chain.from_iterable(sequences), dtype=np.int64, count=int(lens.sum()))
+    return padded, mask
+
+
 @dataclass
 class DataCollatorWithPaddingAndNesting:
     """
@@ -302,19 +452,15 @@ class DataCollatorWithPaddingAndNesting:
 
     def __call__(self, features: List[Dict[str, Any]]) -> Dict[str, Any]:
         features = [ff for f in features for ff in f]
-        batch = self.tokenizer.pad(
-            features,
-            padding=self.padding,
-            max_length=self.max_length,
-            pad_to_multiple_of=self.pad_to_multiple_of,
-            return_tensors=self.return_tensors,
-        )
-        if "label" in batch:
-            batch["labels"] = batch["label"]
-            del batch["label"]
-        if "label_ids" in batch:
-            batch["labels"] = batch["label_ids"]
-            del batch["label_ids"]
+        input_ids = [f["input_ids"] for f in features]
+        length = padded_length(max(len(x) for x in input_ids), self.padding, self.max_length, self.pad_to_multiple_of)
+        padded, mask = pad_sequences(input_ids, self.tokenizer.pad_token_id, length, self.tokenizer.padding_side)
+        batch = {"input_ids": torch.from_numpy(padded), "attention_mask": torch.from_numpy(mask.astype(np.int64))}
+        for key in features[0]:
+            if key in batch:
+                continue
+            # Per-example scalars (labels, option_len, num_options)
+            batch["labels" if key in ["label", "label_ids"] else key] = torch.tensor([f[key] for f in features])
         return batch
 
 
@@ -331,47 +477,111 @@ class NondiffCollator(DataCollatorMixin):
     return_tensors: str = "pt"
 
     def torch_call(self, features):
-        import torch
-
         label_name = "label" if "label" in features[0].keys() else "labels"
-        labels = [feature[label_name] for feature in features] if label_name in features[0].keys() else None
+        padding_side = self.tokenizer.padding_side
 
-        no_labels_features = [{k: v for k, v in feature.items() if k != label_name and k != "gold"} for feature in features]
+        input_ids = [f["input_ids"] for f in features]
+        length = padded_length(max(len(x) for x in input_ids), self.padding, self.max_length, self.pad_to_multiple_of)
+        padded, mask = pad_sequences(input_ids, self.tokenizer.pad_token_id, length, padding_side)
+        batch = {"input_ids": torch.from_numpy(padded), "attention_mask": torch.from_numpy(mask.astype(np.int64))}
+        for key in features[0]:
+            if key not in batch and key not in [label_name, "gold"]:
+                batch[key] = torch.tensor([f[key] for f in features])
+
+        if label_name in features[0]:
+            labels, _ = pad_sequences([f[label_name] for f in features], self.label_pad_token_id, length, padding_side)
+            batch[label_name] = torch.from_numpy(labels)
+        if "gold" in features[0]:
+            batch["gold"] = [feature["gold"] for feature in features]
 
-        batch = self.tokenizer.pad(
-            no_labels_features,
-            padding=self.padding,
-            max_length=self.max_length,
-            pad_to_multiple_of=self.pad_to_multiple_of,
-            return_tensors="pt",
-        )
+        return batch
 
-        if labels is None:
-            return batch
 
-        sequence_length = batch["input_ids"].shape[1]
-        padding_side = self.tokenizer.padding_side
+@dataclass
+class LengthBucketCollator:
+    """
+    Pad every batch of a collator (with tokenizer.pad-style padding/max_length/pad_to_multiple_of fields) to the
+    smallest of a fixed set of lengths that fits it, so that a compiled forward only sees a few sequence lengths.
+    Batches longer than the largest bucket are padded by the wrapped collator as usual.
+    """
+    collator: Any
+    buckets: List[int]
+
+    def __post_init__(self):
+        self.buckets = sorted(self.buckets)
+        self._bucket_collators = {}
+
+    def __call__(self, features):
+        # DataCollatorWithPaddingAndNesting gets a list of options per example
+        flat = [ff for f in features for ff in f] if isinstance(features[0], list) else features
+        longest = max(len(f["input_ids"]) for f in flat)
+        bucket = next((b for b in self.buckets if b >= longest), None)
+        if bucket is None:
+            return self.collator(features)
+        if bucket not in self._bucket_collators:
+            self._bucket_collators[bucket] = dataclasses.replace(
+                self.collator, padding="max_length", max_length=bucket, pad_to_multiple_of=None)
+        return self._bucket_collators[bucket](features)
 
-        def to_list(tensor_or_iterable):
-            if isinstance(tensor_or_iterable, torch.Tensor):
-                return tensor_or_iterable.tolist()
-            return list(tensor_or_iterable)
 
-        if padding_side == "right":
-            batch[label_name] = [
-                to_list(label) + [self.label_pad_token_id] * (sequence_length - len(label)) for label in labels
-            ]
-        else:
-            batch[label_name] = [
-                [self.label_pad_token_id] * (sequence_length - len(label)) + to_list(label) for label in labels
-            ]
+@dataclass
+class PackingCollator:
+    """
+    Pack LM-style training examples (dicts with input_ids and, with --only_train_option, option_len) into rows of at
+    most pack_length tokens (first fit, in batch order), padded on the right to the longest row.
+    Output:
+    - input_ids, attention_mask
+    - segment_ids: 1, 2, ... for the examples of a row, 0 for padding (block-diagonal causal mask and per-example
+      positions in ht_opt.OPTForCausalLM)
+    - labels: the tokens the loss is calculated on (the last option_len tokens of each example, or all its tokens but
+      the first, as in option_len_loss), -100 elsewhere
+    The packed loss equals option_len_loss on the unpacked (left-padded) batch, except for the term of the first token
+    of padded rows, which option_len_loss predicts from the padding token before it.
+    """
+    tokenizer: PreTrainedTokenizerBase
+    pack_length: int
+    pad_to_multiple_of: Optional[int] = 8
+
+    def __call__(self, features):
+        rows, free = [], []
+        for feature in features:
+            length = len(feature["input_ids"])
+            if length > self.pack_length:
+                raise ValueError(f"Example of {length} tokens does not fit in packed rows of {self.pack_length} tokens")
+            row = next((r for r, f in enumerate(free) if f >= length), None)
+            if row is None:
+                rows.append([])
+                free.append(self.pack_length)
+                row = len(rows) - 1
+            rows[row].append(feature)
+            free[row] -= length
+
+        pad_token_id = self.tokenizer.pad_token_id
+        length = padded_length(self.pack_length - min(free), pad_to_multiple_of=self.pad_to_multiple_of)
+        input_ids = np.full((len(rows), length), pad_token_id, dtype=np.int64)
+        segment_ids = np.zeros((len(rows), length), dtype=np.int64)
+        labels = np.full((len(rows), length), -100, dtype=np.int64)
+        for r, row in enumerate(rows):
+            start = 0
+            for segment, feature in enumerate(row, start=1):
+                ids = np.asarray(feature["input_ids"], dtype=np.int64)
+                end = start + len(ids)
+                input_ids[r, start:end] = ids
+                segment_ids[r, start:end] = segment
+                # The first token of an example is never a target (in particular not of the previous example)
+                option_len = feature.get("option_len") or 0
+                first = max(1, len(ids) - option_len) if option_len > 0 else 1
+                labels[r, start + first:end] = ids[first:]
+                start = end
+        labels[input_ids == pad_token_id] = -100
+
+        return {
+            "input_ids": torch.from_numpy(input_ids),
+            "attention_mask": torch.from_numpy((segment_ids > 0).astype(np.int64)),
+            "segment_ids": torch.from_numpy(segment_ids),
+            "labels": torch.from_numpy(labels),
+        }
 
-        batch[label_name] = torch.tensor(batch[label_name], dtype=torch.int64)
-        if "gold" in features[0]:
-            batch["gold"] = [feature["gold"] for feature in features]
-        
-        return batch
-        
 
 class SIGUSR1Callback(transformers.TrainerCallback):
     """
@@ -426,6 +636,42 @@ def temp_seed(seed):
         np.random.set_state(state)
 
 
+def sequence_key(sequence, option_len):
+    """
+    Key of a scored (sequence, option_len): a digest of the tokens instead of the tokens themselves
+    """
+    digest = hashlib.blake2b(np.asarray(sequence, dtype=np.int64).tobytes(), digest_size=16).digest()
+    return len(sequence), option_len, digest
+
+
+class ScoreCache:
+    """
+    Option log-probabilities of the sequences scored during one evaluation, e.g., of the calibration (SFC) prompts,
+    which often do not depend on the eval sample (" It was great" for SST2), or only on the demonstrations (ICL SFC):
+    each distinct prompt is then scored once per evaluation instead of once per eval sample. Clear it when the model
+    changes.
+    """
+
+    def __init__(self):
+        self.scores = {}
+        self.hits = 0
+
+    def clear(self):
+        self.scores = {}
+        self.hits = 0
+
+    def score(self, sequence, option_len, forward):
+        """
+        forward(sequence, option_len=option_len), cached
+        """
+        key = sequence_key(sequence, option_len)
+        if key in self.scores:
+            self.hits += 1
+        else:
+            self.scores[key] = forward(sequence, option_len=option_len)
+        return self.scores[key]
+
+
 class EnhancedJSONEncoder(json.JSONEncoder):
     def default(self, o):
         if is_dataclass(o):
@@ -0,0 +1,175 @@
+"""
+Compiled ZO forward (--zo_compile): the model forward and the option-restricted loss are compiled together with
+torch.compile (static shapes). The collator pads the training batches to a few fixed lengths (--compile_length_buckets,
+utils.LengthBucketCollator), so there is one graph per (batch rows, bucket) instead of one per padded length.
+Compiled graphs are saved in the inductor cache (--compile_cache_dir) and reused by later runs.
+
+The eager forward is used instead for what the compiled path does not support: torch < 2.0, pipeline-parallel models,
+packed sequences (--pack_sequences), batches longer than the largest bucket, multiple-choice batches with different
+numbers of options, and any compilation error (after which compilation is disabled for the run).
+
+Steady-state speedup on CPU (inductor) for a small random OPT:
+    python zo_compile.py --hidden_size 256 --num_layers 4 --batch_size 16 --buckets 32,64,96,128 --cache_dir /tmp/inductor
+"""
+import argparse
+import logging
+import os
+import time
+
+import torch
+
+from utils import option_len_loss
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def configure_compile_cache(cache_dir=None):
+    """
+    Persist the compiled graphs (inductor FX graph cache) under cache_dir, so that later runs skip compilation
+    """
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        os.environ["TORCHINDUCTOR_CACHE_DIR"] = os.path.abspath(cache_dir)
+    import torch._inductor.config as inductor_config
+    inductor_config.fx_graph_cache = True
+
+
+def option_loss_forward(model, input_ids, attention_mask, labels, option_len, num_options, pad_token_id):
+    """
+    Forward + option-restricted loss (OurTrainer.forward_wrap_with_option_len), as one function to compile
+    """
+    logits = model(input_ids=input_ids, attention_mask=attention_mask).logits
+    return option_len_loss(logits, input_ids, labels, option_len=option_len, num_options=num_options,
+                           pad_token_id=pad_token_id)
+
+
+class CompiledZOForward:
+    """
+    Callable used by OurTrainer.zo_forward: returns the loss, or None when the eager forward should be used
+    """
+
+    def __init__(self, buckets, cache_dir=None, mode=None):
+        self.buckets = set(buckets)
+        self.enabled = hasattr(torch, "compile")
+        self._warned = set()
+        self._num_options = (None, None)
+        if not self.enabled:
+            self._fallback("torch.compile needs torch>=2.0")
+            return
+        configure_compile_cache(cache_dir)
+        # One graph per (rows, bucket): a full batch and a last partial batch per bucket, at least
+        import torch._dynamo.config as dynamo_config
+        dynamo_config.cache_size_limit = max(dynamo_config.cache_size_limit, 4 * len(self.buckets))
+        self._fn = torch.compile(option_loss_forward, dynamic=False, mode=mode)
+
+    def _fallback(self, reason):
+        if reason not in self._warned:
+            self._warned.add(reason)
+            logger.warning(f"Eager ZO forward: {reason}")
+        return None
+
+    def _uniform_num_options(self, num_options):
+        """
+        Output: number of options of every example, or 0 if they differ. Memoized, as zo_step forwards the same batch
+        several times (and checking device tensors synchronizes)
+        """
+        if num_options is not self._num_options[0]:
+            values = num_options.tolist() if isinstance(num_options, torch.Tensor) else list(num_options)
+            self._num_options = (num_options, values[0] if all(v == values[0] for v in values) else 0)
+        return self._num_options[1]
+
+    def __call__(self, model, inputs):
+        if not self.enabled:
+            return None
+        if hasattr(model, "pipeline_stage"):
+            return self._fallback("pipeline-parallel model")
+        if inputs.get("segment_ids") is not None:
+            return self._fallback("packed sequences")
+        if inputs["input_ids"].size(1) not in self.buckets:
+            return self._fallback("batches longer than the largest length bucket")
+        num_options = inputs.get("num_options")
+        if num_options is not None:
+            num_options = self._uniform_num_options(num_options)
+            if num_options == 0:
+                return self._fallback("examples with different numbers of options")
+            num_options = [num_options]
+
+        try:
+            return self._fn(model, inputs["input_ids"], inputs.get("attention_mask"), inputs["labels"],
+                            inputs.get("option_len"), num_options, model.config.pad_token_id)
+        except Exception as e:
+            self.enabled = False
+            logger.warning(f"torch.compile failed, using the eager ZO forward for the rest of the run: {e}")
+            return None
+
+
+def main():
+    from transformers import OPTConfig, OPTForCausalLM
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--hidden_size", type=int, default=256)
+    parser.add_argument("--num_layers", type=int, default=4)
+    parser.add_argument("--vocab_size", type=int, default=8192)
+    parser.add_argument("--batch_size", type=int, default=16, help="rows per batch (examples x options)")
+    parser.add_argument("--num_options", type=int, default=2)
+    parser.add_argument("--buckets", default="32,64,96,128")
+    parser.add_argument("--num_batches", type=int, default=8, help="batches with random lengths up to the largest bucket")
+    parser.add_argument("--repeats", type=int, default=3, help="passes over the batches (after the compilation pass)")
+    parser.add_argument("--cache_dir", default=None, help="inductor cache (run twice to see the cached compile time)")
+    parser.add_argument("--num_threads", type=int, default=os.cpu_count())
+    bench_args = parser.parse_args()
+    torch.set_num_threads(bench_args.num_threads)
+
+    torch.manual_seed(0)
+    config = OPTConfig(vocab_size=bench_args.vocab_size, hidden_size=bench_args.hidden_size,
+                       num_hidden_layers=bench_args.num_layers, ffn_dim=4 * bench_args.hidden_size,
+                       num_attention_heads=max(1, bench_args.hidden_size // 64), word_embed_proj_dim=bench_args.hidden_size)
+    model = OPTForCausalLM(config).eval()
+    buckets = sorted(int(b) for b in bench_args.buckets.split(","))
+
+    # Same batch contents padded two ways: to a multiple of 8 (eager baseline) and to a bucket (compiled)
+    def make_batch(length, padded):
+        input_ids = torch.randint(4, bench_args.vocab_size, (bench_args.batch_size, padded))
+        attention_mask = torch.ones_like(input_ids)
+        attention_mask[:, :padded - length] = 0
+        input_ids[attention_mask == 0] = config.pad_token_id
+        return {"input_ids": input_ids, "attention_mask": attention_mask,
+                "labels": torch.arange(bench_args.batch_size) % bench_args.num_options,
+                "option_len": torch.full((bench_args.batch_size,), 2),
+                "num_options": torch.full((bench_args.batch_size,), bench_args.num_options)}
+
+    lengths = torch.randint(8, buckets[-1] + 1, (bench_args.num_batches,)).tolist()
+    eager_batches = [make_batch(n, (n + 7) // 8 * 8) for n in lengths]
+    bucket_batches = [make_batch(n, next(b for b in buckets if b >= n)) for n in lengths]
+
+    def eager(batch):
+        return option_loss_forward(model, batch["input_ids"], batch["attention_mask"], batch["labels"],
+                                   batch["option_len"], batch["num_options"].tolist(), config.pad_token_id)
+
+    compiled = CompiledZOForward(buckets, cache_dir=bench_args.cache_dir)
+
+    def timed(fn, batches, repeats):
+        start = time.time()
+        with torch.inference_mode():
+            for _ in range(repeats):
+                for batch in batches:
+                    fn(batch)
+        return (time.time() - start) / (repeats * len(batches))
+
+    compile_time = timed(lambda b: compiled(model, b), bucket_batches, 1) * len(bucket_batches)
+    if not compiled.enabled:
+        print("Compilation failed, see the warning above")
+        return
+    eager_time = timed(eager, eager_batches, bench_args.repeats)
+    eager_bucket_time = timed(eager, bucket_batches, bench_args.repeats)
+    compiled_time = timed(lambda b: compiled(model, b), bucket_batches, bench_args.repeats)
+    print(f"first pass (compilation of {len(set(b['input_ids'].size(1) for b in bucket_batches))} shapes): {compile_time:.1f}s")
+    print(f"eager, padded to a multiple of 8: {eager_time * 1000:.1f}ms/forward")
+    print(f"eager, padded to a bucket:        {eager_bucket_time * 1000:.1f}ms/forward")
+    print(f"compiled, padded to a bucket:     {compiled_time * 1000:.1f}ms/forward "
+          f"(speedup {eager_time / compiled_time:.2f}x over eager with multiple-of-8 padding)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+Scaling benchmark of multi-process ZO (--zo_parallel) on a single CPU box with gloo.
+
+    python zo_dist_bench.py --world_sizes 1,2,4 --modes direction,data --steps 10
+
+For each (mode, world size), the processes run OurTrainer.zo_step/zo_update on a small random OPT model and report
+- direction: directions evaluated per second (every rank evaluates zo_num_directions directions on the same batch)
+- data: examples per second (the global batch is split across the ranks)
+and the speedup over one process using all the cores. It also checks that all the ranks end with identical weights.
+"""
+import argparse
+import json
+import os
+import socket
+import tempfile
+import time
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.optim.lr_scheduler import LambdaLR
+from transformers import OPTConfig, OPTForCausalLM
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _worker(rank, world_size, mode, bench_args, port, results):
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(port)
+    torch.set_num_threads(max(1, bench_args.num_threads // world_size))
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+
+    from memory_tracker import PhaseMemoryTracker
+    from run import OurArguments
+    from trainer import OurTrainer
+
+    torch.manual_seed(0)
+    config = OPTConfig(vocab_size=bench_args.vocab_size, hidden_size=bench_args.hidden_size,
+                       num_hidden_layers=bench_args.num_layers, ffn_dim=4 * bench_args.hidden_size,
+                       num_attention_heads=max(1, bench_args.hidden_size // 64), word_embed_proj_dim=bench_args.hidden_size)
+    model = OPTForCausalLM(config)
+    args = OurArguments(output_dir=tempfile.mkdtemp(), trainer="zo", no_cuda=True, report_to=[],
+                        zo_parallel=mode if world_size > 1 else "none", learning_rate=1e-6, zo_eps=1e-3)
+
+    trainer = OurTrainer(model=model, args=args)
+    trainer._zo_init_parallel()
+    trainer.memory_tracker = PhaseMemoryTracker(enabled=False)
+    trainer.named_parameters_to_optim = [(n, p) for n, p in model.named_parameters() if p.requires_grad]
+    trainer.named_parameters_to_optim_copy = [(n, p.clone()) for n, p in trainer.named_parameters_to_optim]
+    trainer.create_optimizer_and_scheduler(num_training_steps=bench_args.steps)
+    trainer.lr_scheduler = LambdaLR(trainer.optimizer, lambda step: 1)
+    trainer.beta_k = 1
+
+    # Same global batch on every rank; data parallelism takes a shard of it
+    generator = torch.Generator().manual_seed(1)
+    batch = torch.randint(4, bench_args.vocab_size, (bench_args.batch_size, bench_args.seq_len), generator=generator)
+    if trainer.zo_parallel == "data":
+        batch = batch.chunk(world_size)[rank]
+    inputs = {"input_ids": batch, "labels": batch}
+
+    times = []
+    for step in range(bench_args.warmup + bench_args.steps):
+        dist.barrier()
+        start = time.time()
+        trainer.zo_step(model, inputs)
+        trainer.zo_update(args, model)
+        trainer.state.global_step += 1
+        trainer.beta_k = 1 + trainer.state.global_step / 6
+        dist.barrier()
+        if step >= bench_args.warmup:
+            times.append(time.time() - start)
+
+    # All the ranks must hold the same weights
+    checksum = torch.stack([p.detach().double().sum() for _, p in trainer.named_parameters_to_optim]).sum().reshape(1)
+    checksums = [torch.zeros_like(checksum) for _ in range(world_size)]
+    dist.all_gather(checksums, checksum)
+    if rank == 0:
+        results.put({"step_time": sum(times) / len(times), "directions": trainer.zo_total_directions,
+                     "consistent": all(torch.equal(c, checksums[0]) for c in checksums)})
+    dist.destroy_process_group()
+
+
+def run(mode, world_size, bench_args):
+    results = mp.get_context("spawn").SimpleQueue()
+    mp.spawn(_worker, args=(world_size, mode, bench_args, _free_port(), results), nprocs=world_size, join=True)
+    return results.get()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--world_sizes", default="1,2,4")
+    parser.add_argument("--modes", default="direction,data")
+    parser.add_argument("--steps", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--seq_len", type=int, default=64)
+    parser.add_argument("--hidden_size", type=int, default=256)
+    parser.add_argument("--num_layers", type=int, default=4)
+    parser.add_argument("--vocab_size", type=int, default=8192)
+    parser.add_argument("--num_threads", type=int, default=os.cpu_count(), help="total number of threads (split across ranks)")
+    parser.add_argument("--output", default=None, help="save the scaling curve as JSON")
+    bench_args = parser.parse_args()
+
+    curve = []
+    for mode in bench_args.modes.split(","):
+        base = None
+        for world_size in [int(w) for w in bench_args.world_sizes.split(",")]:
+            r = run(mode, world_size, bench_args)
+            if mode == "direction":
+                throughput, unit = r["directions"] / r["step_time"], "directions/s"
+            else:
+                throughput, unit = bench_args.batch_size / r["step_time"], "examples/s"
+            base = base or throughput
+            curve.append({"mode": mode, "world_size": world_size, "step_time": r["step_time"],
+                          "throughput": throughput, "unit": unit, "speedup": throughput / base,
+                          "consistent": r["consistent"]})
+            print(f"{mode:9s} world {world_size}: {r['step_time']:.3f}s/step, {throughput:.1f} {unit}, "
+                  f"speedup {throughput / base:.2f}x, ranks consistent: {r['consistent']}")
+
+    if bench_args.output is not None:
+        with open(bench_args.output, "w") as f:
+            json.dump(curve, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
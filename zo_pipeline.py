@@ -0,0 +1,393 @@
+"""
+Pipeline-parallel ZO (--zo_parallel pipeline, launched with torchrun): the decoder layers are partitioned across the
+processes, so each process only holds its share of the model (with --mmap_load, the layers of the other stages are
+never even read from disk).
+
+- Stage 0 holds the embeddings, the last stage the final layer norm and the LM head, and every stage a contiguous
+  block of decoder layers. The input embeddings (which ZO does not train) are kept on the last stage if they are
+  tied to the LM head.
+- Each stage perturbs and restores only its own parameters, with the step seed offset by the stage index, so z is
+  never communicated: the concatenation of the stage perturbations is the perturbation of the full model.
+- The 2 * zo_num_directions perturbed forwards of a step are split into micro-batches and streamed through the
+  stages: a stage sends its hidden states asynchronously and moves on to the next micro-batch (and, when a forward is
+  done, to the next perturbation) without waiting, so the pipeline fills and drains once per step, not once per
+  forward.
+- The last stage computes the option-restricted loss (utils.option_len_loss) and broadcasts the projected gradients;
+  every stage then applies the usual ZO update (OurTrainer._zo_update) to its own parameters.
+
+Evaluation runs the same partitioned forward without perturbation. The last stage computes the log-probabilities of
+the scored tokens (utils.token_log_probs, used by Framework.forward, OurTrainer.forward and token_budget.score_options)
+and broadcasts only those, so classification and multiple-choice evaluation work unchanged on every rank. The model's
+forward still returns full logits on every rank (broadcast: batch x length x vocab). Generation (KV cache) is not
+supported.
+
+Self-test on CPU (checks the partitioned forward against the full model and times ZO steps):
+    python zo_pipeline.py --num_stages 2 --zo_num_directions 2 --micro_batches 4
+"""
+import argparse
+import functools
+import logging
+import os
+import socket
+import tempfile
+import time
+
+import numpy as np
+import torch
+import torch.distributed as dist
+from torch import nn
+from transformers.modeling_outputs import CausalLMOutputWithPast
+
+from ht_opt import prepare_decoder_attention_mask
+from utils import option_len_loss, select_log_probs, token_log_probs
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Seed offset between stages (stage s uses step_seed + s * STAGE_SEED_STRIDE - i for direction i)
+STAGE_SEED_STRIDE = 1 << 20
+# Number of asynchronous hidden-state sends a stage may have in flight
+MAX_IN_FLIGHT = 2
+# Inputs that are split into micro-batches along the batch dimension
+BATCH_KEYS = ["input_ids", "attention_mask", "labels", "option_len", "num_options"]
+
+
+def partition_layers(num_layers, num_stages):
+    """
+    Contiguous [start, end) layer ranges, one per stage, as balanced as possible (the earlier stages get the extra
+    layers, as the last stage also computes the LM head)
+    """
+    assert num_layers >= num_stages, f"Cannot split {num_layers} layers into {num_stages} stages"
+    base, extra = divmod(num_layers, num_stages)
+    bounds, start = [], 0
+    for stage in range(num_stages):
+        end = start + base + (1 if stage < extra else 0)
+        bounds.append((start, end))
+        start = end
+    return bounds
+
+
+def micro_batch_bounds(inputs, num_micro_batches):
+    """
+    Split the rows of a batch into at most num_micro_batches contiguous [start, end) ranges, without separating the
+    options of a classification/multiple-choice example
+    """
+    rows = inputs["input_ids"].size(0)
+    num_options = inputs.get("num_options")
+    if num_options is None:
+        starts = list(range(rows))
+    else:
+        # Same grouping as option_len_loss
+        starts, start_id = [], 0
+        while start_id < rows:
+            starts.append(start_id)
+            start_id += int(num_options[start_id])
+    groups = np.array_split(np.arange(len(starts)), min(num_micro_batches, len(starts)))
+    return [(starts[g[0]], starts[g[-1] + 1] if g[-1] + 1 < len(starts) else rows) for g in groups]
+
+
+class PipelineStage:
+    """
+    One stage of a partitioned OPT model (see partition_model). Ranks are stages: rank r receives hidden states from
+    rank r - 1 and sends them to rank r + 1.
+    """
+
+    def __init__(self, model, stage, num_stages, layer_range, comm_device, micro_batches=1):
+        self.model = model
+        self.decoder = model.model.decoder
+        self.stage, self.num_stages = stage, num_stages
+        self.first, self.last = stage == 0, stage == num_stages - 1
+        self.layer_range = layer_range
+        self.comm_device = comm_device
+        self.micro_batches = micro_batches
+        self._in_flight = []
+
+    @property
+    def dtype(self):
+        return next(self.model.parameters()).dtype
+
+    def _run(self, input_ids, attention_mask, hidden_states=None):
+        """
+        Forward of this stage's modules: hidden states, or logits on the last stage
+        """
+        decoder = self.decoder
+        if attention_mask is None:
+            attention_mask = torch.ones(input_ids.shape, dtype=torch.long, device=input_ids.device)
+        if self.first:
+            inputs_embeds = decoder.embed_tokens(input_ids)
+            pos_embeds = decoder.embed_positions(attention_mask, 0)
+            if decoder.project_in is not None:
+                inputs_embeds = decoder.project_in(inputs_embeds)
+            hidden_states = inputs_embeds + pos_embeds
+
+        causal_attention_mask = prepare_decoder_attention_mask(attention_mask, input_ids.shape, hidden_states, 0)
+        for layer in decoder.layers:
+            hidden_states = layer(hidden_states, attention_mask=causal_attention_mask)[0]
+
+        if not self.last:
+            return hidden_states
+        if decoder.final_layer_norm is not None:
+            hidden_states = decoder.final_layer_norm(hidden_states)
+        if decoder.project_out is not None:
+            hidden_states = decoder.project_out(hidden_states)
+        return self.model.lm_head(hidden_states).contiguous()
+
+    def _send(self, tensor):
+        tensor = tensor.to(self.comm_device).contiguous()
+        self._in_flight.append((dist.isend(tensor, self.stage + 1), tensor))
+        while len(self._in_flight) > MAX_IN_FLIGHT:
+            self._in_flight.pop(0)[0].wait()
+
+    def _drain(self):
+        for work, _ in self._in_flight:
+            work.wait()
+        self._in_flight = []
+
+    def _recv(self, input_ids):
+        hidden_states = torch.empty(*input_ids.shape, self.model.config.hidden_size, dtype=self.dtype,
+                                    device=self.comm_device)
+        dist.recv(hidden_states, self.stage - 1)
+        return hidden_states.to(input_ids.device)
+
+    def _stream(self, input_ids, attention_mask):
+        """
+        Run this stage on one micro-batch: receive, compute, send. Output: logits on the last stage, None otherwise
+        """
+        hidden_states = None if self.first else self._recv(input_ids)
+        output = self._run(input_ids, attention_mask, hidden_states)
+        if self.last:
+            return output
+        self._send(output)
+        return None
+
+    def _evaluate(self, input_ids, attention_mask, shape, dtype, output=None):
+        """
+        Unperturbed partitioned forward, to be called on every rank with the same inputs: output(logits) computed on
+        the last stage and broadcast to every rank
+        """
+        with torch.no_grad():
+            logits = self._stream(input_ids, attention_mask)
+            self._drain()
+            if logits is None:
+                result = torch.empty(*shape, dtype=dtype, device=self.comm_device)
+            else:
+                result = (logits if output is None else output(logits)).to(self.comm_device, dtype).contiguous()
+            dist.broadcast(result, src=self.num_stages - 1)
+        return result.to(input_ids.device)
+
+    def forward(self, input_ids=None, attention_mask=None, past_key_values=None, use_cache=None, **kwargs):
+        """
+        Unperturbed partitioned forward (for evaluation), to be called on every rank with the same inputs.
+        Output: CausalLMOutputWithPast with the logits of the full model on every rank
+        """
+        if past_key_values is not None or use_cache:
+            raise NotImplementedError("Generation (KV cache) is not supported with --zo_parallel pipeline")
+        logits = self._evaluate(input_ids, attention_mask, (*input_ids.shape, self.model.config.vocab_size), self.dtype)
+        return CausalLMOutputWithPast(logits=logits)
+
+    def token_log_probs(self, input_ids, attention_mask=None, last=None):
+        """
+        utils.token_log_probs, with only the (bsz, last) log-probabilities broadcast from the last stage
+        """
+        last = min(last or input_ids.size(-1) - 1, input_ids.size(-1) - 1)
+        return self._evaluate(input_ids, attention_mask, (input_ids.size(0), last), self.dtype,
+                              output=lambda logits: select_log_probs(logits, input_ids, last=last))
+
+    def zo_step(self, trainer, inputs):
+        """
+        Pipelined OurTrainer.zo_step. Sets trainer.projected_grad (on every rank) and returns the loss of the last
+        f(theta + z). trainer.named_parameters_to_optim must only hold this stage's parameters.
+        """
+        self.model.eval()
+        inputs = trainer._prepare_inputs(inputs)
+        device = inputs["input_ids"].device
+        q = trainer.zo_num_directions
+        assert q < STAGE_SEED_STRIDE
+
+        seed = torch.tensor([np.random.randint(1000000000)], dtype=torch.int64, device=self.comm_device)
+        dist.broadcast(seed, src=0)
+        trainer.zo_random_seed = int(seed.item()) + self.stage * STAGE_SEED_STRIDE
+
+        micro_batches = [{k: inputs[k][start:end] for k in BATCH_KEYS if inputs.get(k) is not None}
+                         for start, end in micro_batch_bounds(inputs, self.micro_batches)]
+        loss_sums = torch.zeros(2 * q, dtype=torch.float32, device=device)
+        loss_counts = torch.zeros(2 * q, dtype=torch.float32, device=device)
+
+        for i in range(q):
+            for j, (scaling_factor, judge) in enumerate([(1, 1), (-1, -1)]):
+                torch.manual_seed(trainer.zo_random_seed - i)
+                with trainer.memory_tracker.phase("perturb"):
+                    trainer.zo_perturb_parameters(scaling_factor=scaling_factor, judge=judge)
+                with trainer.memory_tracker.phase("forward"), torch.no_grad():
+                    for batch in micro_batches:
+                        logits = self._stream(batch["input_ids"], batch.get("attention_mask"))
+                        if logits is not None:
+                            loss_sum, count = option_len_loss(
+                                logits, batch["input_ids"], batch["labels"], option_len=batch.get("option_len"),
+                                num_options=batch.get("num_options"), pad_token_id=self.model.config.pad_token_id,
+                                reduction="sum")
+                            loss_sums[2 * i + j] += loss_sum.float()
+                            loss_counts[2 * i + j] += count
+            torch.manual_seed(trainer.zo_random_seed - i)
+            with trainer.memory_tracker.phase("perturb"):
+                trainer.zo_perturb_parameters(scaling_factor=1, judge=0)
+        self._drain()
+
+        # The last stage has the losses: broadcast the projected gradients and the loss
+        result = torch.zeros(q + 1, dtype=torch.float32, device=self.comm_device)
+        if self.last:
+            losses = loss_sums / loss_counts
+            result[:q] = ((losses[0::2] - losses[1::2]) * trainer._zo_loss_weight(inputs)
+                          / (2 * trainer.args.zo_eps)).to(self.comm_device)
+            result[q] = losses[-2].to(self.comm_device)
+        dist.broadcast(result, src=self.num_stages - 1)
+        result = result.to(device)
+        trainer.projected_grad = list(result[:q].unbind())
+        return result[q]
+
+
+def partition_model(model, stage, num_stages, comm_device, micro_batches=1):
+    """
+    Keep only the modules of this stage in an OPT causal LM (in place; the other layers are freed, or never read with
+    memory-mapped weights) and route model.forward through the pipeline.
+    Output: the model, with model.pipeline_stage set
+    """
+    if not hasattr(model, "model") or not hasattr(model.model, "decoder"):
+        raise NotImplementedError("Pipeline parallelism only supports OPT models")
+    decoder = model.model.decoder
+    layer_range = partition_layers(len(decoder.layers), num_stages)[stage]
+    tied = model.lm_head.weight is decoder.embed_tokens.weight
+
+    decoder.layers = nn.ModuleList(list(decoder.layers)[layer_range[0]:layer_range[1]])
+    if stage != 0:
+        decoder.embed_positions = None
+        decoder.project_in = None
+        if not (tied and stage == num_stages - 1):
+            decoder.embed_tokens = None
+    if stage != num_stages - 1:
+        decoder.final_layer_norm = None
+        decoder.project_out = None
+        model.lm_head = None
+
+    pipeline_stage = PipelineStage(model, stage, num_stages, layer_range, comm_device, micro_batches=micro_batches)
+
+    @functools.wraps(model.forward)
+    def forward(input_ids=None, attention_mask=None, **kwargs):
+        return pipeline_stage.forward(input_ids=input_ids, attention_mask=attention_mask, **kwargs)
+
+    model.forward = forward
+    model.pipeline_stage = pipeline_stage
+    num_bytes = sum(p.nbytes for p in model.parameters())
+    logger.info(f"Pipeline stage {stage}/{num_stages}: layers [{layer_range[0]}, {layer_range[1]}), "
+                f"{num_bytes / 1024 ** 3:.3f}GB of parameters")
+    return model
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _self_test_worker(rank, world_size, test_args, port, results):
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(port)
+    torch.set_num_threads(max(1, test_args.num_threads // world_size))
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+
+    from torch.optim.lr_scheduler import LambdaLR
+    from transformers import OPTConfig, OPTForCausalLM
+
+    from memory_tracker import PhaseMemoryTracker
+    from run import OurArguments
+    from trainer import OurTrainer
+
+    torch.manual_seed(0)
+    config = OPTConfig(vocab_size=test_args.vocab_size, hidden_size=test_args.hidden_size,
+                       num_hidden_layers=test_args.num_layers, ffn_dim=4 * test_args.hidden_size,
+                       num_attention_heads=max(1, test_args.hidden_size // 64), word_embed_proj_dim=test_args.hidden_size)
+    model = OPTForCausalLM(config).eval()
+
+    # Classification-style batch (2 options per example), left-padded
+    generator = torch.Generator().manual_seed(1)
+    input_ids = torch.randint(4, test_args.vocab_size, (test_args.batch_size, test_args.seq_len), generator=generator)
+    attention_mask = torch.ones_like(input_ids)
+    attention_mask[::3, :test_args.seq_len // 4] = 0
+    input_ids[attention_mask == 0] = config.pad_token_id
+    inputs = {"input_ids": input_ids, "attention_mask": attention_mask, "labels": torch.arange(len(input_ids)) % 2,
+              "option_len": [2] * len(input_ids), "num_options": [2] * len(input_ids)}
+    with torch.no_grad():
+        reference = model(input_ids=input_ids, attention_mask=attention_mask).logits
+
+    partition_model(model, rank, world_size, torch.device("cpu"), micro_batches=test_args.micro_batches)
+    logits = model(input_ids=input_ids, attention_mask=attention_mask).logits
+    max_diff = (logits - reference).abs().max().item()
+    # Option log-probabilities (what evaluation broadcasts)
+    log_probs = token_log_probs(model, input_ids, attention_mask, last=2)
+    max_log_prob_diff = (log_probs - select_log_probs(reference, input_ids, last=2)).abs().max().item()
+
+    args = OurArguments(output_dir=tempfile.mkdtemp(), trainer="zo", no_cuda=True, report_to=[],
+                        zo_parallel="pipeline", learning_rate=1e-6, zo_eps=1e-3)
+    trainer = OurTrainer(model=model, args=args)
+    trainer.zo_num_directions = test_args.zo_num_directions
+    trainer._zo_init_parallel()
+    trainer.memory_tracker = PhaseMemoryTracker(enabled=False)
+    trainer.named_parameters_to_optim = [(n, p) for n, p in model.named_parameters()
+                                         if p.requires_grad and "embed_tokens" not in n]
+    trainer.named_parameters_to_optim_copy = [(n, p.clone()) for n, p in trainer.named_parameters_to_optim]
+    trainer.create_optimizer_and_scheduler(num_training_steps=test_args.steps)
+    trainer.lr_scheduler = LambdaLR(trainer.optimizer, lambda step: 1)
+    trainer.beta_k = 1
+
+    times, losses = [], []
+    for step in range(test_args.warmup + test_args.steps):
+        dist.barrier()
+        start = time.time()
+        losses.append(trainer.zo_step(model, inputs).item())
+        trainer.zo_update(args, model)
+        trainer.state.global_step += 1
+        trainer.beta_k = 1 + trainer.state.global_step / 6
+        dist.barrier()
+        if step >= test_args.warmup:
+            times.append(time.time() - start)
+
+    stats = torch.tensor([sum(p.nbytes for p in model.parameters())], dtype=torch.float64)
+    all_stats = [torch.zeros_like(stats) for _ in range(world_size)]
+    dist.all_gather(all_stats, stats)
+    if rank == 0:
+        results.put({"max_logit_diff": max_diff, "max_log_prob_diff": max_log_prob_diff, "step_time": sum(times) / len(times), "losses": losses,
+                     "stage_bytes": [int(s.item()) for s in all_stats]})
+    dist.destroy_process_group()
+
+
+def main():
+    import torch.multiprocessing as mp
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_stages", type=int, default=2)
+    parser.add_argument("--micro_batches", type=int, default=4)
+    parser.add_argument("--zo_num_directions", type=int, default=2)
+    parser.add_argument("--steps", type=int, default=5)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--seq_len", type=int, default=64)
+    parser.add_argument("--hidden_size", type=int, default=256)
+    parser.add_argument("--num_layers", type=int, default=4)
+    parser.add_argument("--vocab_size", type=int, default=8192)
+    parser.add_argument("--num_threads", type=int, default=os.cpu_count(), help="total number of threads (split across stages)")
+    test_args = parser.parse_args()
+
+    results = mp.get_context("spawn").SimpleQueue()
+    mp.spawn(_self_test_worker, args=(test_args.num_stages, test_args, _free_port(), results),
+             nprocs=test_args.num_stages, join=True)
+    r = results.get()
+    forwards = 2 * test_args.zo_num_directions * test_args.micro_batches
+    print(f"{test_args.num_stages} stages: max |logits - full model logits| = {r['max_logit_diff']:.2e}, "
+          f"max |option log-probs - full model's| = {r['max_log_prob_diff']:.2e}")
+    print(f"parameters per stage: {', '.join(f'{b / 1024 ** 2:.1f}MB' for b in r['stage_bytes'])}")
+    print(f"{r['step_time']:.3f}s/step, pipeline bubble {(test_args.num_stages - 1) / (forwards + test_args.num_stages - 1):.0%}, "
+          f"losses {', '.join(f'{l:.4f}' for l in r['losses'])}")
+
+
+if __name__ == "__main__":
+    main()